@@ -0,0 +1,726 @@
+#!/usr/bin/env python3
+# fgosccnt の各処理の速度と結果の一致を計測する
+import argparse
+import gc
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+import fgosccnt
+import makemodels
+import pageinfo
+
+logger = logging.getLogger(__name__)
+
+
+def iter_files(filenames):
+    """
+    ファイルとフォルダの指定を展開してスクショのファイル名を返す
+    """
+    for filename in filenames:
+        if os.path.isdir(filename):
+            for child in sorted(os.listdir(filename)):
+                path = os.path.join(filename, child)
+                if Path(path).suffix.upper() in ['.PNG', '.JPG', '.JPEG']:
+                    yield path
+        else:
+            yield filename
+
+
+def measure(func, *args, repeat=10):
+    """
+    func を repeat 回実行し、結果と1回あたりの最短時間(秒)を返す
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def legacy_img2num(sc, img, img_th, pts, char_w, end):
+    """
+    ScreenShot.img2num の画素ループ版 (比較用)
+    """
+    height, width = img.shape[:2]
+    c_center = int(pts[0] + (pts[2] - pts[0])/2)
+    newimg = img[:, max(int(c_center - char_w/2), 0):min(int(c_center + char_w/2), width)]
+
+    threshold2 = 10
+    ret, newimg_th = cv2.threshold(newimg,
+                                   threshold2,
+                                   255,
+                                   cv2.THRESH_BINARY)
+    for w in range(min(int(c_center + char_w/2), width) - max(int(c_center - char_w/2), 0)):
+        for h in range(end):
+            newimg_th[h, w] = img_th[h, w + int(c_center - char_w/2)]
+        newimg_th[height - 1, w] = 0
+        newimg_th[height - 2, w] = 0
+        newimg_th[height - 3, w] = 0
+
+    return sc.pred_dcnt(newimg_th)
+
+
+def legacy_ocr_dcnt(sc, drop_count_img):
+    """
+    ScreenShot.ocr_dcnt の画素ループ版 (比較用)
+    """
+    char_w = 28
+    threshold = 80
+    kernel = np.ones((4, 4), np.uint8)
+    img = cv2.cvtColor(drop_count_img, cv2.COLOR_BGR2GRAY)
+    _, img_th = cv2.threshold(img, threshold, 255, cv2.THRESH_BINARY)
+    img_th = cv2.dilate(img_th, kernel, iterations=1)
+    height, width = img_th.shape[:2]
+
+    end = -1
+    for i in range(height):
+        if end == -1 and img_th[height - i - 1, width - 1] == 255:
+            end = height - i
+            break
+    start = end - 7
+
+    for j in range(width):
+        for k in range(end - start):
+            img_th[start + k, j] = 0
+
+    contours = cv2.findContours(img_th,
+                                cv2.RETR_EXTERNAL,
+                                cv2.CHAIN_APPROX_SIMPLE)[0]
+    item_pts = []
+    for cnt in contours:
+        ret = cv2.boundingRect(cnt)
+        pt = [ret[0], ret[1], ret[0] + ret[2], ret[1] + ret[3]]
+        if ret[1] > 0 and ret[3] > 8 and ret[1] + ret[3] == start \
+           and 12 < ret[2] < char_w + 4 and ret[0] + ret[2] != width:
+            item_pts.append(pt)
+
+    if len(item_pts) == 0:
+        return -1
+    item_pts.sort()
+
+    res = legacy_img2num(sc, img, img_th, item_pts[-1], char_w, end)
+    if len(item_pts) >= 2:
+        if item_pts[-1][0] - item_pts[-2][2] < char_w / (2 / 3):
+            res2 = legacy_img2num(sc, img, img_th, item_pts[-2], char_w, end)
+            res = res2 * 10 + res
+
+    return res
+
+
+def legacy_ocr_tresurechest(sc, drop_count_img):
+    """
+    ScreenShot.ocr_tresurechest の画素ループ版 (比較用)
+    """
+    threshold = 80
+    img_gray = cv2.cvtColor(drop_count_img, cv2.COLOR_BGR2GRAY)
+    _, img_num = cv2.threshold(img_gray,
+                               threshold, 255, cv2.THRESH_BINARY)
+    im_th = cv2.bitwise_not(img_num)
+    h, w = im_th.shape[:2]
+
+    for y in range(h):
+        im_th[y, 0] = 255
+    for x in range(w):
+        im_th[0, x] = 255
+    return sc.ocr_text(im_th)
+
+
+class DropCountProbe(fgosccnt.ScreenShot):
+    """
+    ドロップ数OCRに渡された画像を記録する ScreenShot
+    """
+    def ocr_tresurechest(self, drop_count_img):
+        self.chest_img = drop_count_img
+        return super().ocr_tresurechest(drop_count_img)
+
+    def ocr_dcnt(self, drop_count_img):
+        self.dcnt_img = drop_count_img
+        return super().ocr_dcnt(drop_count_img)
+
+
+def bench_dcnt(args):
+    """
+    ドロップ数OCRの画素ループ版とスライス版を比較する
+    """
+    fgosccnt.calc_dist_local()
+    svm, svm_chest, svm_dcnt, svm_card = fgosccnt.load_svms()
+
+    mismatch = 0
+    total_legacy = 0.0
+    total_new = 0.0
+    count = 0
+    print('filename,chestnum,legacy_chestnum,legacy_ms,new_ms')
+    for filename in iter_files(args.filename):
+        img_rgb = fgosccnt.imread(filename)
+        if img_rgb is None:
+            logger.warning('Cannot read file: %s', filename)
+            continue
+        try:
+            sc = DropCountProbe(args, img_rgb,
+                                svm, svm_chest, svm_dcnt, svm_card,
+                                Path(filename).suffix)
+        except Exception as e:
+            logger.warning('%s: %s', filename, e)
+            continue
+        targets = []
+        if hasattr(sc, 'chest_img'):
+            targets.append((sc.ocr_tresurechest, legacy_ocr_tresurechest,
+                            sc.chest_img))
+        if hasattr(sc, 'dcnt_img'):
+            targets.append((sc.ocr_dcnt, legacy_ocr_dcnt, sc.dcnt_img))
+
+        new_time = legacy_time = 0.0
+        new_res = legacy_res = -1
+        for new_func, legacy_func, img in targets:
+            res, t = measure(new_func, img, repeat=args.repeat)
+            new_res = res if new_res == -1 else new_res
+            new_time += t
+            res, t = measure(legacy_func, sc, img, repeat=args.repeat)
+            legacy_res = res if legacy_res == -1 else legacy_res
+            legacy_time += t
+        if new_res != legacy_res or new_res != sc.chestnum:
+            mismatch += 1
+        total_new += new_time
+        total_legacy += legacy_time
+        count += 1
+        print('{},{},{},{:.3f},{:.3f}'.format(filename, new_res, legacy_res,
+                                              legacy_time * 1000,
+                                              new_time * 1000))
+
+    if count == 0:
+        logger.error('No screenshot was processed')
+        return 1
+    logger.info('files: %d, mismatch: %d', count, mismatch)
+    logger.info('legacy: %.3f ms/file, new: %.3f ms/file, speedup: x%.2f',
+                total_legacy * 1000 / count, total_new * 1000 / count,
+                total_legacy / total_new if total_new > 0 else 0)
+    return 1 if mismatch > 0 else 0
+
+
+def guess_pageinfo_or_error(im, fast):
+    try:
+        return pageinfo.guess_pageinfo(im, fast=fast)
+    except pageinfo.TooManyAreasDetectedError:
+        return 'too many areas'
+
+
+def bench_pageinfo(args):
+    """
+    スクロールバー検出の従来の閾値ループと列範囲を絞った検出を比較する
+    """
+    mismatch = 0
+    total_legacy = 0.0
+    total_new = 0.0
+    count = 0
+    print('filename,pageinfo,legacy_pageinfo,legacy_ms,new_ms')
+    for filename in iter_files(args.filename):
+        im = fgosccnt.imread(filename)
+        if im is None:
+            logger.warning('Cannot read file: %s', filename)
+            continue
+        legacy_res, legacy_time = measure(guess_pageinfo_or_error, im, False,
+                                          repeat=args.repeat)
+        new_res, new_time = measure(guess_pageinfo_or_error, im, True,
+                                    repeat=args.repeat)
+        if new_res != legacy_res:
+            mismatch += 1
+        total_new += new_time
+        total_legacy += legacy_time
+        count += 1
+        print('{},"{}","{}",{:.3f},{:.3f}'.format(filename, new_res,
+                                                  legacy_res,
+                                                  legacy_time * 1000,
+                                                  new_time * 1000))
+
+    if count == 0:
+        logger.error('No screenshot was processed')
+        return 1
+    logger.info('files: %d, mismatch: %d', count, mismatch)
+    logger.info('legacy: %.3f ms/file, new: %.3f ms/file, speedup: x%.2f',
+                total_legacy * 1000 / count, total_new * 1000 / count,
+                total_legacy / total_new if total_new > 0 else 0)
+    return 1 if mismatch > 0 else 0
+
+
+def detect_qp_region_or_error(im, downscale):
+    try:
+        return pageinfo.detect_qp_region(im, downscale=downscale)
+    except pageinfo.TooManyAreasDetectedError:
+        return 'too many areas'
+
+
+def guess_pageinfo_downscale_or_error(im, downscale):
+    try:
+        # 矩形は縮小率の分だけずれるので、比べるのは推定結果だけ
+        return tuple(pageinfo.guess_pageinfo(im, downscale=downscale))
+    except pageinfo.TooManyAreasDetectedError:
+        return 'too many areas'
+
+
+def bench_downscale(args):
+    """
+    QP 領域とスクロールバーの検出を元の解像度と縮小画像で比較する
+    """
+    mismatch = 0
+    totals = {'qp': [0.0, 0.0], 'pageinfo': [0.0, 0.0]}
+    count = 0
+    print('filename,qp,downscaled_qp,qp_ms,downscaled_qp_ms,'
+          'pageinfo,downscaled_pageinfo,pageinfo_ms,downscaled_pageinfo_ms')
+    for filename in iter_files(args.filename):
+        im = fgosccnt.imread(filename)
+        if im is None:
+            logger.warning('Cannot read file: %s', filename)
+            continue
+        row = [filename]
+        for name, func in [('qp', detect_qp_region_or_error),
+                           ('pageinfo', guess_pageinfo_downscale_or_error)]:
+            full_res, full_time = measure(func, im, 1, repeat=args.repeat)
+            down_res, down_time = measure(func, im, args.factor,
+                                          repeat=args.repeat)
+            if full_res != down_res:
+                mismatch += 1
+                logger.warning('%s: %s %s -> %s', filename, name, full_res,
+                               down_res)
+            totals[name][0] += full_time
+            totals[name][1] += down_time
+            row += ['"{}"'.format(full_res), '"{}"'.format(down_res),
+                    '{:.3f}'.format(full_time * 1000),
+                    '{:.3f}'.format(down_time * 1000)]
+        count += 1
+        print(','.join(row))
+
+    if count == 0:
+        logger.error('No screenshot was processed')
+        return 1
+    logger.info('files: %d, mismatch: %d, factor: %d', count, mismatch,
+                args.factor)
+    for name, (total_full, total_down) in totals.items():
+        logger.info('%s: full %.3f ms/call, downscaled %.3f ms/call, '
+                    'speedup: x%.2f', name, total_full * 1000 / count,
+                    total_down * 1000 / count,
+                    total_full / total_down if total_down > 0 else 0)
+    return 1 if mismatch > 0 else 0
+
+
+def parse_size(s):
+    """
+    "120x60" を (120, 60) にする
+    """
+    w, h = s.lower().split('x')
+    return (int(w), int(h))
+
+
+def assign_folds(labels, k):
+    """
+    ラベル順に並べて順番に fold を割り当てる
+    (サンプルの少ないラベルもなるべく別々の fold に入る)
+    """
+    folds = np.zeros(len(labels), dtype=int)
+    order = np.argsort(labels, kind='stable')
+    folds[order] = np.arange(len(labels)) % k
+    return folds
+
+
+def evaluate_svm(images, labels, config, cs, k):
+    """
+    config の HOG 特徴量で C ごとに k-fold 交差検証を行い、
+    (C, 正解率, 特徴量計算時間(ms/枚), 予測時間(ms/枚)) を返す
+    """
+    hog = config.make_hog()
+    start = time.perf_counter()
+    features = np.array([makemodels.compute_feature_from_image(img, config, hog)
+                         for img in images], dtype=np.float32)
+    extract_ms = (time.perf_counter() - start) * 1000 / len(images)
+    folds = assign_folds(labels, k)
+    for c in cs:
+        correct = 0
+        predict_time = 0.0
+        for fold in range(k):
+            test = np.flatnonzero(folds == fold)
+            train = np.flatnonzero(folds != fold)
+            if len(test) == 0:
+                continue
+            svm = makemodels.train_svm(features[train], labels[train], c)
+            for i in test:
+                # fgosccnt と同じく1枚ずつ予測する
+                start = time.perf_counter()
+                pred = svm.predict(features[i:i + 1])[1]
+                predict_time += time.perf_counter() - start
+                if int(pred[0][0]) == labels[i]:
+                    correct += 1
+        yield c, correct / len(images), extract_ms, predict_time * 1000 / len(images)
+
+
+def pareto_front(rows):
+    """
+    正解率が高く、1枚あたりの時間が短い方向のパレート最適な行を返す
+    """
+    front = []
+    for row in rows:
+        dominated = any(
+            other['accuracy'] >= row['accuracy'] and other['ms'] <= row['ms']
+            and (other['accuracy'] > row['accuracy'] or other['ms'] < row['ms'])
+            for other in rows)
+        if not dominated:
+            front.append(row)
+    return front
+
+
+def bench_svm(args):
+    """
+    SVM の HOG 特徴量の形状と C を k-fold 交差検証で比較し、
+    正解率と1枚あたりの時間のパレート最適な設定を出力する
+    """
+    configs = []
+    for win_size in args.win_sizes:
+        for block_size in args.block_sizes:
+            for block_stride in args.block_strides:
+                for cell_size in args.cell_sizes:
+                    config = makemodels.HogConfig(win_size, block_size,
+                                                  block_stride, cell_size,
+                                                  args.bins)
+                    if not config.is_valid():
+                        logger.debug('skip invalid HOG: %s', config)
+                        continue
+                    configs.append(config)
+    if makemodels.DEFAULT_HOG not in configs:
+        configs.insert(0, makemodels.DEFAULT_HOG)
+    cs = sorted(set(args.C) | {makemodels.SVM_C})
+
+    print('model,win_size,block_size,block_stride,cell_size,bins,C,dims,'
+          'accuracy,extract_ms,predict_ms,pareto,selected')
+    status = 0
+    for name in args.models:
+        samples = makemodels.list_samples(name)
+        if len(samples) == 0:
+            logger.error('No training data: %s', name)
+            status = 1
+            continue
+        images = [makemodels.read_gray(path) for path, _ in samples]
+        labels = np.array([lbl for _, lbl in samples], dtype=int)
+        k = min(args.folds, len(samples))
+        rows = []
+        for config in configs:
+            dims = config.make_hog().getDescriptorSize()
+            for c, accuracy, extract_ms, predict_ms in \
+                    evaluate_svm(images, labels, config, cs, k):
+                rows.append({'config': config, 'C': c, 'dims': dims,
+                             'accuracy': accuracy, 'extract_ms': extract_ms,
+                             'predict_ms': predict_ms,
+                             'ms': extract_ms + predict_ms})
+        baseline = next(row for row in rows
+                        if row['config'] == makemodels.DEFAULT_HOG
+                        and row['C'] == makemodels.SVM_C)
+        front = pareto_front(rows)
+        # 現行の設定と同等以上の正解率のうち、特徴量の計算が一番速い形状で
+        # 一番正解率の高いもの (線形 SVM の予測時間は C によらないので、
+        # 同じ形状の C 違いは予測時間の揺れで比べない)
+        candidates = [row for row in front
+                      if row['accuracy'] >= baseline['accuracy'] - args.tolerance]
+        selected = min(candidates, key=lambda row: (row['extract_ms'],
+                                                    -row['accuracy'],
+                                                    row['predict_ms']))
+
+        for row in rows:
+            config = row['config']
+            print('{},{},{},{},{},{},{},{},{:.4f},{:.4f},{:.4f},{},{}'.format(
+                name, 'x'.join(map(str, config.win_size)),
+                'x'.join(map(str, config.block_size)),
+                'x'.join(map(str, config.block_stride)),
+                'x'.join(map(str, config.cell_size)), config.bins, row['C'],
+                row['dims'], row['accuracy'], row['extract_ms'],
+                row['predict_ms'], int(row in front), int(row is selected)))
+        logger.info('%s: %d samples, %d-fold, baseline accuracy %.4f '
+                    '(%.3f ms/glyph)', name, len(samples), k,
+                    baseline['accuracy'], baseline['ms'])
+        logger.info('%s: selected %s C=%s accuracy %.4f (%.3f ms/glyph)',
+                    name, selected['config'], selected['C'],
+                    selected['accuracy'], selected['ms'])
+        if args.write:
+            os.makedirs(args.write, exist_ok=True)
+            output = makemodels.build_model(name, output_dir=args.write,
+                                            config=selected['config'],
+                                            c=selected['C'])
+            logger.info('wrote %s', output)
+    return status
+
+
+@contextmanager
+def scratch_item_dirs(catalog):
+    """
+    計測中に見つかった新しいアイテムのファイルを一時フォルダに作る
+    既存のファイルは一時フォルダに複製し、catalog の検索先を差し替える
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dirs = {}
+        for category, search_dir in catalog.SEARCH_DIRS.items():
+            dirs[category] = Path(tmpdir) / search_dir.name
+            if search_dir.is_dir():
+                shutil.copytree(search_dir, dirs[category])
+            else:
+                dirs[category].mkdir()
+        catalog.SEARCH_DIRS = dirs
+        try:
+            yield
+        finally:
+            del catalog.SEARCH_DIRS
+
+
+def bench_policy(args):
+    """
+    ExecutionPolicy の候補ごとに fgosccnt の処理時間を計測し、
+    最も速いものを policy.json に保存する
+    """
+    files = list(iter_files(args.filename))
+    if len(files) == 0:
+        logger.error('No screenshot was specified')
+        return 1
+    cpus = os.cpu_count() or 1
+    candidates = [fgosccnt.ExecutionPolicy('threads')]
+    if cpus > 1:
+        candidates.append(fgosccnt.ExecutionPolicy('threads',
+                                                   cell_threads=min(cpus, 8)))
+    jobs = 2
+    while jobs < cpus:
+        candidates.append(fgosccnt.ExecutionPolicy('processes', jobs))
+        jobs *= 2
+    if cpus > 1:
+        candidates.append(fgosccnt.ExecutionPolicy('processes', cpus))
+
+    # 計測中は fgosccnt の INFO ログを抑える
+    fgosccnt.logger.setLevel(logging.WARNING)
+    best = None
+    print('mode,jobs,cv_threads,cell_threads,seconds,ms_per_file')
+    with scratch_item_dirs(fgosccnt.default_catalog):
+        for policy in candidates:
+            _, t = measure(fgosccnt.get_output, files, args, policy,
+                           repeat=args.repeat)
+            print('{},{},{},{},{:.3f},{:.3f}'.format(policy.mode, policy.jobs,
+                                                    policy.cv_threads,
+                                                    policy.cell_threads, t,
+                                                    t * 1000 / len(files)))
+            if best is None or t < best[1]:
+                best = (policy, t)
+
+    logger.info('best: %s', best[0])
+    if not args.dry_run:
+        best[0].save(args.output)
+        logger.info('saved to %s', args.output)
+    return 0
+
+
+def bench_memory(args):
+    """
+    スクショ一枚あたりのメモリ使用量を計測する
+    peak: 認識中の最大, screenshot: ScreenShot を保持した場合,
+    result: Result だけを保持した場合 (いずれも numpy 配列を含む)
+    """
+    engine = fgosccnt.Engine(fgosccnt.Options(lang=args.lang))
+    recognizer = engine.recognizer
+    tracemalloc.start()
+    count = 0
+    totals = [0, 0, 0]
+    print('filename,peak_kib,screenshot_kib,result_kib')
+    for filename in iter_files(args.filename):
+        img_rgb = fgosccnt.imread(filename)
+        if img_rgb is None:
+            logger.warning('Cannot read file: %s', filename)
+            continue
+        gc.collect()
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        try:
+            sc = recognizer.recognize_image(img_rgb, Path(filename).suffix)
+        except Exception as e:
+            logger.warning('%s: %s', filename, e)
+            continue
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+        screenshot = current - before
+        result = fgosccnt.Result(sc, filename=filename)
+        del sc
+        gc.collect()
+        kept = tracemalloc.get_traced_memory()[0] - before
+        del result
+        values = [peak - before, screenshot, kept]
+        totals = [t + v for t, v in zip(totals, values)]
+        count += 1
+        print('{},{:.1f},{:.1f},{:.1f}'.format(filename,
+                                               *[v / 1024 for v in values]))
+    tracemalloc.stop()
+
+    if count == 0:
+        logger.error('No screenshot was processed')
+        return 1
+    logger.info('files: %d, peak: %.1f KiB, screenshot: %.1f KiB, '
+                'result: %.1f KiB (per file)',
+                count, *[t / 1024 / count for t in totals])
+    return 0
+
+
+def bench_ingest(args):
+    """
+    フォルダ入力の処理で使うメモリがファイル数に比例しないことを確認する
+    空のファイル (Not Supported になる) を並べたフォルダを作成し、
+    ファイル数ごとに CSV 出力までの tracemalloc の最大値を計測する
+    """
+    fgosccnt.logger.setLevel(logging.WARNING)
+    print('files,ordering,peak_kib,seconds')
+    workdir = tempfile.mkdtemp()
+    try:
+        created = 0
+        for count in sorted(args.counts):
+            for i in range(created, count):
+                open(os.path.join(workdir, 'f{:07d}.txt'.format(i)),
+                     'w').close()
+            created = max(created, count)
+            for ordering in args.ordering:
+                with open(os.devnull, 'w', encoding='UTF-8') as devnull:
+                    gc.collect()
+                    tracemalloc.start()
+                    start = time.perf_counter()
+                    fgosccnt.write_csv(
+                        fgosccnt.iter_folder(workdir, ordering,
+                                             args.chunk_size),
+                        args, devnull)
+                    elapsed = time.perf_counter() - start
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                print('{},{},{:.1f},{:.3f}'.format(count, ordering,
+                                                   peak / 1024, elapsed))
+    finally:
+        shutil.rmtree(workdir)
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark for fgosccnt')
+    subparsers = parser.add_subparsers()
+
+    def add_common_arguments(p):
+        p.add_argument('filename', nargs='+')
+        p.add_argument('--lang', default=fgosccnt.DEFAULT_ITEM_LANG,
+                       choices=('jpn', 'eng'))
+        p.add_argument('-r', '--repeat', type=int, default=10,
+                       help='number of repetitions per measurement [default: 10]')
+        p.add_argument('-l', '--loglevel',
+                       choices=('debug', 'info', 'warning'), default='info')
+
+    dcnt_parser = subparsers.add_parser('dcnt',
+                                        help='drop count OCR (chestnum)')
+    add_common_arguments(dcnt_parser)
+    dcnt_parser.set_defaults(func=bench_dcnt)
+
+    pageinfo_parser = subparsers.add_parser('pageinfo',
+                                            help='scrollbar detection '
+                                                 '(pagenum, pages, lines)')
+    add_common_arguments(pageinfo_parser)
+    pageinfo_parser.set_defaults(func=bench_pageinfo)
+
+    downscale_parser = subparsers.add_parser('downscale',
+                                             help='qp region and scrollbar '
+                                                  'detection on downscaled '
+                                                  'image')
+    add_common_arguments(downscale_parser)
+    downscale_parser.add_argument('-f', '--factor', type=int, default=2,
+                                  choices=(2, 4),
+                                  help='downscale factor [default: 2]')
+    downscale_parser.set_defaults(func=bench_downscale)
+
+    memory_parser = subparsers.add_parser('memory',
+                                          help='memory per screenshot')
+    add_common_arguments(memory_parser)
+    memory_parser.set_defaults(func=bench_memory)
+
+    ingest_parser = subparsers.add_parser('ingest',
+                                          help='memory of folder input')
+    ingest_parser.add_argument('counts', nargs='*', type=int,
+                               default=[1000, 10000, 100000],
+                               help='number of files '
+                                    '[default: 1000 10000 100000]')
+    ingest_parser.add_argument('--ordering', nargs='+',
+                               type=fgosccnt.Ordering,
+                               default=list(fgosccnt.Ordering))
+    ingest_parser.add_argument('--chunk-size', type=int,
+                               default=fgosccnt.SORT_CHUNK_SIZE)
+    ingest_parser.add_argument('--lang', default=fgosccnt.DEFAULT_ITEM_LANG,
+                               choices=('jpn', 'eng'))
+    ingest_parser.add_argument('-t', '--timeout', type=int,
+                               default=fgosccnt.TIMEOUT)
+    ingest_parser.add_argument('--adaptive', action='store_true')
+    ingest_parser.add_argument('-l', '--loglevel',
+                               choices=('debug', 'info', 'warning'),
+                               default='info')
+    ingest_parser.set_defaults(func=bench_ingest, policy='threads', jobs=None,
+                               cell_threads=None)
+
+    svm_parser = subparsers.add_parser('svm',
+                                       help='k-fold evaluation of HOG + SVM '
+                                            'models over data/*/input')
+    svm_parser.add_argument('models', nargs='*',
+                            default=list(makemodels.MODELS),
+                            help='models to evaluate [default: all]')
+    svm_parser.add_argument('-k', '--folds', type=int, default=5,
+                            help='number of folds [default: 5]')
+    svm_parser.add_argument('--win-sizes', nargs='+', type=parse_size,
+                            default=[(120, 60), (80, 40), (60, 30), (40, 20)],
+                            help='HOG window sizes (WxH) '
+                                 '[default: 120x60 80x40 60x30 40x20]')
+    svm_parser.add_argument('--block-sizes', nargs='+', type=parse_size,
+                            default=[(16, 16)],
+                            help='HOG block sizes [default: 16x16]')
+    svm_parser.add_argument('--block-strides', nargs='+', type=parse_size,
+                            default=[(4, 4), (8, 8)],
+                            help='HOG block strides [default: 4x4 8x8]')
+    svm_parser.add_argument('--cell-sizes', nargs='+', type=parse_size,
+                            default=[(4, 4), (8, 8)],
+                            help='HOG cell sizes [default: 4x4 8x8]')
+    svm_parser.add_argument('--bins', type=int, default=9)
+    svm_parser.add_argument('--C', nargs='+', type=float,
+                            default=[0.1, 0.5, 1.0, 10.0],
+                            help='SVM C values [default: 0.1 0.5 1 10]')
+    svm_parser.add_argument('--tolerance', type=float, default=0.0,
+                            help='accuracy loss allowed for the selected '
+                                 'configuration [default: 0]')
+    svm_parser.add_argument('--write', metavar='DIR',
+                            help='write the selected models to DIR')
+    svm_parser.add_argument('-l', '--loglevel',
+                            choices=('debug', 'info', 'warning'),
+                            default='info')
+    svm_parser.set_defaults(func=bench_svm)
+
+    policy_parser = subparsers.add_parser('policy',
+                                          help='execution policy for fgosccnt.py'
+                                               ' (writes policy.json)')
+    add_common_arguments(policy_parser)
+    policy_parser.set_defaults(func=bench_policy, repeat=1)
+    policy_parser.add_argument('-o', '--output', default=fgosccnt.policy_file,
+                               help='policy file [default: policy.json]')
+    policy_parser.add_argument('-n', '--dry-run', action='store_true',
+                               help='do not write the policy file')
+    policy_parser.add_argument('-t', '--timeout', type=int,
+                               default=fgosccnt.TIMEOUT)
+    policy_parser.add_argument('--adaptive', action='store_true')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
+    logger.setLevel(args.loglevel.upper())
+    if not hasattr(args, 'func'):
+        logger.error('subcommand is required')
+        sys.exit(2)
+    sys.exit(args.func(args))
@@ -3,33 +3,13 @@
 import csv
 import sys
 import argparse
-from pathlib import Path
-import json
 import re
 import logging
 
-import fgosccnt
+import dropdata
 
 logger = logging.getLogger(__name__)
 
-basedir = Path(__file__).resolve().parent
-drop_file = basedir / Path("fgoscdata/hash_drop.json")
-with open(drop_file, encoding='UTF-8') as f:
-    drop_item = json.load(f)
-
-shortname2id = {
-                item["shortname"]: item["id"]
-                for item in drop_item if "shortname" in item.keys()
-                }
-name2id = {
-           item["name"]: item["id"]
-           for item in drop_item if "name" in item.keys()
-           }
-id2type = {item["id"]: item["type"] for item in drop_item}
-item_shortname = {item["id"]: item["shortname"] for item in drop_item
-                  if "shortname" in item.keys()}
-fgosccnt.calc_dist_local()
-
 ID_GEM_MIN = 6001
 ID_GEM_MAX = 6007
 ID_MAGIC_GEM_MIN = 6101
@@ -49,6 +29,42 @@ output = ""
 ce_exp_list = []
 ce_list = []
 jyohakyu_flag = False
+# item フォルダの画像を読み込んだ Catalog (hash_drop.json に無い名前が出たときに作る)
+local_catalog = None
+
+
+def get_local_catalog():
+    """
+    item フォルダのユーザー定義アイテムを登録した Catalog を返す
+    画像処理の準備が必要なので、hash_drop.json で名前が引けないときだけ使う
+    """
+    global local_catalog
+    if local_catalog is None:
+        import fgosccnt
+        fgosccnt.calc_dist_local()
+        local_catalog = fgosccnt.default_catalog
+    return local_catalog
+
+
+def item2id(item):
+    """
+    CSV の列名からアイテムの id を返す
+    """
+    name = delete_brackets(item)
+    id = dropdata.get_item_index().find_id(name)
+    if id is None:
+        id = get_local_catalog().name2id[name]
+    return id
+
+
+def item2type(id):
+    """
+    アイテムの種別を返す
+    """
+    id2type = dropdata.get_item_index().id2type
+    if id in id2type:
+        return id2type[id]
+    return get_local_catalog().item_type[id]
 
 
 def delete_brackets(s):
@@ -92,7 +108,7 @@ def output_warning(lines):
 {}###############################################""".format(warning))
 
 
-def place2id(place, freequest):
+def place2id(place):
     """
     フリクエと修練場のidが変換できればよい
     """
@@ -102,18 +118,10 @@ def place2id(place, freequest):
         name = tmp[1]
     else:
         return -1
-    for fq in freequest:
-        if chapter == fq["chapter"] and name == fq["name"]:
-            # 北米以外のフリクエ
-            return fq["id"]
-        elif chapter == fq["chapter"] and name == fq["place"]:
-            # 北米以外のフリクエ(同じ場所に二つクエストがある場合)
-            # 修練場もここで判定
-            return fq["id"]
-        elif chapter == fq["place"] and name == fq["name"]:
-            # 北米
-            return fq["id"]
-    return -1
+    fq = dropdata.get_quest_index().find_place(chapter, name)
+    if fq is None:
+        return -1
+    return fq["id"]
 
 
 def output_header(lines):
@@ -125,34 +133,21 @@ def output_header(lines):
     place = ""
     if lines[0]["filename"] != "合計" and len(lines) > 2:
         # fgosccnt がクエスト名判別に成功した
-        eventquest_dir = basedir / Path("fgoscdata/data/json/")
-        freequest = []
-        eventfiles = eventquest_dir.glob('**/*.json')
-        for eventfile in eventfiles:
-            try:
-                with open(eventfile, encoding='UTF-8') as f:
-                    event = json.load(f)
-                    freequest = freequest + event
-            except (OSError, UnicodeEncodeError) as e:
-                logger.exception(e)
-
         place = lines[0]["filename"]
         # 場所からドロップリストを決定
         if " 序" in place or " 破" in place or " 急" in place:
             jyohakyu_flag = True
         drop = []
-        questid = place2id(place, freequest)
+        questid = place2id(place)
         logger.debug("questid: %d", questid)
 
         if not (ID_FREEQUEST_MIN <= questid <= ID_FREEQUEST_MAX) \
            and not (ID_SYUERNQUEST_MIN <= questid <= ID_SYURENQUEST_MAX):
            # 通常フリクエと修練場は除く
             logger.debug("フリクエでも修練場でもないクエスト")
-            for fq in freequest:
-                if "shortname" in fq.keys():
-                    if place == fq["shortname"]:
-                        drop = fq["drop"]
-                        break
+            fq = dropdata.get_quest_index().find_shortname(place)
+            if fq is not None:
+                drop = fq["drop"]
             if drop == []:
                 logger.critical("dropの取得に失敗")
                 exit()
@@ -182,19 +177,12 @@ def output_ce(lines):
     global output
     # 礼装出力
     if len(ce_list) > 0:
+        item_shortname = dropdata.get_item_index().item_shortname
         ce_output = {item_shortname[k["id"]]: 0 for k in ce_list}
         logger.debug("ce_output: %s", ce_output)
         for i, item in enumerate(lines[0].keys()):
             if i > 2:
-                if delete_brackets(item) in shortname2id.keys():
-                    id = shortname2id[delete_brackets(item)]
-                elif delete_brackets(item) in name2id.keys():
-                    id = name2id[delete_brackets(item)]
-                else:
-                    id = [
-                          k for k, v in fgosccnt.item_name.items()
-                          if v == delete_brackets(item)
-                          ][0]
+                id = item2id(item)
                 # logger.debug("i: %s", i)
                 # logger.debug("item: %s", item)
                 # logger.debug("id: %s", id)
@@ -205,7 +193,7 @@ def output_ce(lines):
                     break
                 # 礼装複数ドロップで一部のみドロップしているとき
                 # 礼装じゃないアイテムがでてきたら終了
-                if id2type[id] == "Craft Essence" and not item.endswith("EXP礼装"):
+                if item2type(id) == "Craft Essence" and not item.endswith("EXP礼装"):
                     ce_output[item] = lines[0][item]
                 else:
                     for ce in ce_output.keys():
@@ -224,28 +212,21 @@ def output_ce_exp(lines):
     global output
     # EXP礼装出力
     if len(ce_exp_list) > 0:
+        item_shortname = dropdata.get_item_index().item_shortname
         ce_exp_output = {item_shortname[k["id"]]: 0 for k in ce_exp_list}
         logger.debug("ce_exp_output: %s", ce_exp_output)
         for i, item in enumerate(lines[0].keys()):
             if i > 2:
-                if delete_brackets(item) in shortname2id.keys():
-                    id = shortname2id[delete_brackets(item)]
-                elif delete_brackets(item) in name2id.keys():
-                    id = name2id[delete_brackets(item)]
-                else:
-                    id = [
-                          k for k, v in fgosccnt.item_name.items()
-                          if v == delete_brackets(item)
-                          ][0]
+                id = item2id(item)
                 # logger.debug("i: %s", i)
                 # logger.debug("item: %s", item)
                 # logger.debug("id: %s", id)
                 # 礼装複数ドロップで一部のみドロップしているとき
                 # 礼装じゃないアイテムがでてきたら終了
                 logger.debug(item)
-                if id2type[id] == "Craft Essence" and not item.endswith("EXP礼装"):
+                if item2type(id) == "Craft Essence" and not item.endswith("EXP礼装"):
                     continue
-                elif id2type[id] == "Craft Essence" and item.endswith("EXP礼装"):
+                elif item2type(id) == "Craft Essence" and item.endswith("EXP礼装"):
                     ce_exp_output[item] = lines[0][item]
                 else:
                     for ce_exp in ce_exp_output.keys():
@@ -263,20 +244,12 @@ def otuput_item(lines):
     # 礼装以外のアイテム出力
     for i, item in enumerate(lines[0].keys()):
         if i > 2:
-            if delete_brackets(item) in shortname2id.keys():
-                id = shortname2id[delete_brackets(item)]
-            elif delete_brackets(item) in name2id.keys():
-                id = name2id[delete_brackets(item)]
-            else:
-                id = [
-                      k for k, v in fgosccnt.item_name.items()
-                      if v == delete_brackets(item)
-                      ][0]
+            id = item2id(item)
             # logger.debug("i: %s", i)
             # logger.debug("item: %s", item)
             # logger.debug("id: %s", id)
             if not item.startswith("item"):
-                if id2type[id] == "Craft Essence":
+                if item2type(id) == "Craft Essence":
                     continue
             # 改行出力ルーチン
             if stditem_flag is False \
@@ -300,7 +273,7 @@ def otuput_item(lines):
             elif monyupi_flag and not (ID_PIECE_MIN <= id <= ID_MONUMENT_MAX):
                 output = output[:-1] + "\n"
                 monyupi_flag = False
-            type = fgosccnt.item_type[id]
+            type = item2type(id)
             if type == "Point" and point_flag is False:
                 output = output[:-1] + "\n"
                 point_flag = True
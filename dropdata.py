@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# fgoscdata のアイテム (hash_drop.json) とクエスト (data/json/**/*.json) の読み込み
+#
+# 画像処理のモジュールを読み込まないので、CSV を変換するだけのスクリプトからも使える。
+# 各ファイルは最初に使われたときに一度だけ読み込み、同じプロセス内の
+# fgosccnt.py と csv2counter.py で共有する。
+import json
+import logging
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+basedir = Path(__file__).resolve().parent
+drop_file = basedir / Path("fgoscdata/hash_drop.json")
+eventquest_dir = basedir / Path("fgoscdata/data/json/")
+
+_lock = threading.Lock()
+_drop_item = None
+_freequest = None
+_item_index = None
+_quest_index = None
+
+
+def load_drop_items():
+    """
+    hash_drop.json のアイテムのリスト (変更しないこと)
+    """
+    global _drop_item
+    with _lock:
+        if _drop_item is None:
+            with open(drop_file, encoding='UTF-8') as f:
+                _drop_item = json.load(f)
+        return _drop_item
+
+
+def load_freequests():
+    """
+    クエストの JSON を全て連結したリスト (変更しないこと)
+    """
+    global _freequest
+    with _lock:
+        if _freequest is None:
+            freequest = []
+            for eventfile in eventquest_dir.glob('**/*.json'):
+                try:
+                    with open(eventfile, encoding='UTF-8') as f:
+                        freequest.extend(json.load(f))
+                except (OSError, UnicodeEncodeError) as e:
+                    logger.exception(e)
+            _freequest = freequest
+        return _freequest
+
+
+class ItemIndex:
+    """
+    hash_drop.json のアイテムの名前・略称・種別の辞書
+    """
+
+    def __init__(self, drop_item):
+        self.shortname2id = {item["shortname"]: item["id"]
+                             for item in drop_item if "shortname" in item}
+        self.name2id = {item["name"]: item["id"]
+                        for item in drop_item if "name" in item}
+        self.id2type = {item["id"]: item["type"] for item in drop_item}
+        self.item_shortname = {item["id"]: item["shortname"]
+                               for item in drop_item if "shortname" in item}
+
+    def find_id(self, name):
+        """
+        略称か名前が name のアイテムの id を返す 無ければ None
+        """
+        id = self.shortname2id.get(name)
+        if id is None:
+            id = self.name2id.get(name)
+        return id
+
+
+class QuestIndex:
+    """
+    クエストを場所の表記や略称から引くための辞書
+    同じ表記のクエストが複数あれば JSON で先に出たものを返す
+    """
+
+    def __init__(self, freequest):
+        self.freequest = freequest
+        # 表記 -> freequest の位置
+        self.by_chapter_name = {}
+        self.by_chapter_place = {}
+        self.by_place_name = {}
+        self.by_shortname = {}
+        for i, fq in enumerate(freequest):
+            self.by_chapter_name.setdefault((fq.get("chapter"), fq.get("name")), i)
+            self.by_chapter_place.setdefault((fq.get("chapter"), fq.get("place")), i)
+            self.by_place_name.setdefault((fq.get("place"), fq.get("name")), i)
+            if "shortname" in fq:
+                self.by_shortname.setdefault(fq["shortname"], i)
+
+    def find_place(self, chapter, name):
+        """
+        "章 クエスト名" (同じ場所に二つクエストがある場合や修練場は "章 場所"、
+        北米は "場所 クエスト名") で表記されたクエストを返す 無ければ None
+        """
+        found = [index.get(key) for index, key
+                 in ((self.by_chapter_name, (chapter, name)),
+                     (self.by_chapter_place, (chapter, name)),
+                     (self.by_place_name, (chapter, name)))]
+        found = [i for i in found if i is not None]
+        if len(found) == 0:
+            return None
+        return self.freequest[min(found)]
+
+    def find_shortname(self, shortname):
+        """
+        略称が shortname のクエストを返す 無ければ None
+        """
+        i = self.by_shortname.get(shortname)
+        if i is None:
+            return None
+        return self.freequest[i]
+
+
+def get_item_index():
+    global _item_index
+    drop_item = load_drop_items()
+    with _lock:
+        if _item_index is None:
+            _item_index = ItemIndex(drop_item)
+        return _item_index
+
+
+def get_quest_index():
+    global _quest_index
+    freequest = load_freequests()
+    with _lock:
+        if _quest_index is None:
+            _quest_index = QuestIndex(freequest)
+        return _quest_index
@@ -1,24 +1,35 @@
 #!/usr/bin/env python3
 import sys
+import os
+import io
 import re
 import argparse
 from pathlib import Path
-from collections import Counter
+from collections import Counter, ChainMap, deque
 import csv
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
 import itertools
 import json
 from operator import itemgetter
 import math
+import heapq
+import tempfile
 import datetime
 import logging
+import multiprocessing
+import time
+import threading
+import uuid
+import struct
+from contextlib import contextmanager
 
 import cv2
 import numpy as np
 import pytesseract
 from PIL import Image
-from PIL.ExifTags import TAGS
 
+import dropdata
 import pageinfo
 
 PROGNAME = "FGOスクショカウント"
@@ -35,6 +46,7 @@ class Ordering(Enum):
     NOTSPECIFIED = 'notspecified'   # 指定なし
     FILENAME = 'filename'           # ファイル名
     TIMESTAMP = 'timestamp'         # 作成日時
+    CAPTURETIME = 'capturetime'     # 撮影日時 (Exif / PNG tIME)
 
     def __str__(self):
         return str(self.value)
@@ -48,11 +60,19 @@ train_item = basedir / Path("item.xml")  # item stack & bonus
 train_chest = basedir / Path("chest.xml")  # drop_coount (Old UI)
 train_dcnt = basedir / Path("dcnt.xml")  # drop_coount (New UI)
 train_card = basedir / Path("card.xml")  # card name
-drop_file = basedir / Path("fgoscdata/hash_drop.json")
-eventquest_dir = basedir / Path("fgoscdata/data/json/")
+drop_file = dropdata.drop_file
+eventquest_dir = dropdata.eventquest_dir
 items_img = basedir / Path("data/misc/items_img.png")
+policy_file = basedir / Path("policy.json")  # benchmark.py policy が作成
+# SVM に入力する HOG 特徴量の形状
+# モデルと同じ名前の .json (makemodels.py が作成) がなければこれを使う
+DEFAULT_HOG = {"win_size": (120, 60), "block_size": (16, 16),
+               "block_stride": (4, 4), "cell_size": (4, 4), "bins": 9}
 
 hasher = cv2.img_hash.PHash_create()
+hasher_local = threading.local()
+items_template = None
+items_template_coarse = None
 
 FONTSIZE_UNDEFINED = -1
 FONTSIZE_NORMAL = 0
@@ -68,6 +88,12 @@ PRIORITY_SECRET_GEM_MIN = 6294
 PRIORITY_PIECE_MIN = 5194
 PRIORITY_REWARD_QP = 9012
 ID_START = 9500000
+ID_PROVISIONAL_START = 99000000  # 並列処理中の仮の id
+SORT_CHUNK_SIZE = 10000  # フォルダ内のファイルを並べ替えるときの一時ファイル単位
+CHECKPOINT_INTERVAL = 100  # チェックポイントを書き出すファイル数の間隔
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+EXIF_IFD = 0x8769
+EXIF_DATETIME_ORIGINAL = 36867
 ID_QP = 1
 ID_REWARD_QP = 5
 ID_GEM_MIN = 6001
@@ -97,25 +123,18 @@ class GainedQPandDropMissMatchError(FgosccntError):
     pass
 
 
-with open(drop_file, encoding='UTF-8') as f:
-    drop_item = json.load(f)
+class CannotReadImageError(FgosccntError):
+    pass
+
+
+class CheckpointError(FgosccntError):
+    pass
+
+
+drop_item = dropdata.load_drop_items()
 
 # JSONファイルから各辞書を作成
-item_name = {item["id"]: item["name"] for item in drop_item}
-item_name_eng = {item["id"]: item["name_eng"] for item in drop_item
-                 if "name_eng" in item.keys()}
-item_shortname = {item["id"]: item["shortname"] for item in drop_item
-                  if "shortname" in item.keys()}
-item_dropPriority = {item["id"]: item["dropPriority"] for item in drop_item}
-item_background = {item["id"]: item["background"] for item in drop_item
-                   if "background" in item.keys()}
-item_type = {item["id"]: item["type"] for item in drop_item}
-dist_item = {item["phash_battle"]: item["id"] for item in drop_item
-             if item["type"] == "Item" and "phash_battle" in item.keys()}
-dist_ce = {item["phash"]: item["id"] for item in drop_item
-           if item["type"] == "Craft Essence"}
-dist_ce_narrow = {item["phash_narrow"]: item["id"] for item in drop_item
-                  if item["type"] == "Craft Essence"}
+# アイテム名・dropPriority などと pHash の辞書は Catalog が持つ
 dist_secret_gem = {item["id"]: item["phash_class"] for item in drop_item
                    if 6200 < item["id"] < 6208
                    and "phash_class" in item.keys()}
@@ -138,28 +157,32 @@ dist_exp_class_sold = {item["phash_class_sold"]: item["id"]
                        if item["type"] == "Exp. UP" and "phash_class_sold"
                        in item.keys()}
 dist_exp_class.update(dist_exp_class_sold)
-dist_point = {item["phash_battle"]: item["id"]
-              for item in drop_item
-              if item["type"] == "Point" and "phash_battle" in item.keys()}
 
-with open(drop_file, encoding='UTF-8') as f:
-    drop_item = json.load(f)
-
-freequest = []
-evnetfiles = eventquest_dir.glob('**/*.json')
-for evnetfile in evnetfiles:
-    try:
-        with open(evnetfile, encoding='UTF-8') as f:
-            event = json.load(f)
-            freequest = freequest + event
-    except (OSError, UnicodeEncodeError) as e:
-        logger.exception(e)
+freequest = dropdata.load_freequests()
 
 npz = np.load(basedir / Path('background.npz'))
 hist_zero = npz["hist_zero"]
 hist_gold = npz["hist_gold"]
 hist_silver = npz["hist_silver"]
 hist_bronze = npz["hist_bronze"]
+# 背景判別用の参照ヒストグラム行列 (背景, チャンネル, 256)
+BACKGROUNDS = ["zero", "gold", "silver", "bronze"]
+hist_background = np.stack([hist_zero, hist_gold, hist_silver, hist_bronze]
+                           ).reshape(len(BACKGROUNDS), 3, 256).astype(np.float64)
+# 最も近い背景と二番目に近い背景の距離の差がこれ未満なら判別が曖昧とみなす
+BACKGROUND_MARGIN_MIN = 0.05
+# クエストのドロップだけから探すとき (--adaptive) に一致とみなす pHash の距離
+# 別のアイテムでも距離 8〜10 になる例があるので、全アイテムから探すときの 12
+# より十分小さくし、これを超えるときは全アイテムから探し直す
+NARROWING_THRESHOLD = 4
+# 地域判定 ('items_img.png' との照合) でこれ以上一致すれば 'na'
+AREA_MATCH_THRESHOLD = 0.9
+# 'jp' の hint があるとき、1/2 に縮小した照合の一致度が
+# AREA_MATCH_THRESHOLD - AREA_COARSE_MARGIN 未満なら全解像度の照合を省く
+# 縮小した照合の一致度は全解像度より最大 0.09 程度低くなる
+# (テンプレートの位置・±5% の拡大縮小・ノイズを変えた 400 通りで測定)
+# ので、十分な余裕をとる
+AREA_COARSE_MARGIN = 0.4
 
 
 def has_intersect(a, b):
@@ -171,20 +194,555 @@ def has_intersect(a, b):
         and max(a[1], b[1]) < min(a[3], b[3])
 
 
+# 0-255 の各値の立っているビット数 (ハミング距離の計算用)
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class HashIndex:
+    """
+    pHash の辞書 {hex: id} を背景ごとに分け、dropPriority の降順に並べた
+    検索用インデックス
+    catalog が更新されると次の検索時に作り直す
+    """
+
+    def __init__(self, catalog, dist_dic):
+        self.catalog = catalog
+        self.dist_dic = dist_dic
+        # (背景ごとの配列, 作成時の catalog.version) の組で差し替える
+        self.snapshot = (None, -1)
+
+    def build(self):
+        """
+        背景ごとに (ハッシュ行列, id, dropPriority, 登録順) を作成する
+        """
+        version = self.catalog.version
+        entries = {}
+        for order, (hash_hex, itemid) in enumerate(self.dist_dic.items()):
+            bg = self.catalog.item_background.get(itemid)
+            entries.setdefault(bg, []).append(
+                (hex2hash(hash_hex)[0], itemid,
+                 self.catalog.item_dropPriority[itemid], order))
+        buckets = {}
+        for bg, rows in entries.items():
+            rows.sort(key=lambda x: (-x[2], x[3]))
+            buckets[bg] = (np.array([r[0] for r in rows], dtype=np.uint8),
+                           np.array([r[1] for r in rows], dtype=np.int64),
+                           np.array([-r[2] for r in rows]),
+                           np.array([r[3] for r in rows]))
+        self.snapshot = (buckets, version)
+        return buckets
+
+    def search(self, hash_item, backgrounds, threshold, max_priority=None):
+        """
+        hash_item との距離が threshold 以下の候補を近い順に返す
+        戻り値は [(id, 距離), ...] (同じ id に複数の pHash があれば最も近いもの)
+        max_priority を指定すると dropPriority がそれ以下の候補のみ検索する
+        """
+        buckets, version = self.snapshot
+        if buckets is None or version != self.catalog.version:
+            buckets = self.build()
+        ids = []
+        dists = []
+        orders = []
+        for bg in backgrounds:
+            if bg not in buckets:
+                continue
+            hashes, bucket_ids, neg_priorities, bucket_orders = buckets[bg]
+            start = 0
+            if max_priority is not None:
+                # dropPriority の降順なので条件を満たすのは後方の連続区間
+                start = np.searchsorted(neg_priorities, -max_priority,
+                                        side='left')
+            d = POPCOUNT[hashes[start:] ^ hash_item[0]].sum(axis=1)
+            hit = np.flatnonzero(d <= threshold)
+            ids.append(bucket_ids[start:][hit])
+            dists.append(d[hit])
+            orders.append(bucket_orders[start:][hit])
+        if len(ids) == 0:
+            return []
+        ids = np.concatenate(ids)
+        dists = np.concatenate(dists)
+        orders = np.concatenate(orders)
+        rank = np.lexsort((orders, dists))
+        found = {}
+        for k in rank:
+            found.setdefault(int(ids[k]), int(dists[k]))
+        return list(found.items())
+
+    def narrow(self, ids):
+        """
+        ids に含まれるアイテムだけを対象にしたインデックスを返す
+        """
+        return HashIndex(self.catalog,
+                         {k: v for k, v in self.dist_dic.items() if v in ids})
+
+    def search_with_priority(self, hash_item, backgrounds, threshold,
+                             max_priority):
+        """
+        まず dropPriority が max_priority 以下の候補から探し、
+        見つからなければ全候補から探す
+        """
+        found = self.search(hash_item, backgrounds, threshold, max_priority)
+        if len(found) == 0:
+            logger.debug("no candidate under dropPriority %s, use all",
+                         max_priority)
+            found = self.search(hash_item, backgrounds, threshold)
+        return found
+
+
+class Catalog:
+    """
+    アイテムの名前・dropPriority・種別・背景と pHash の辞書を保持するクラス
+    hash_drop.json の内容は変更せず、item フォルダの画像や新しく見つかった
+    アイテムは上に重ねた辞書に登録する
+    重ねた辞書は登録のたびに複製して差し替えるので、参照側はロック不要
+    (まとめて登録する batch() の間は複製を一度だけにする)
+    """
+    DIST_NAMES = {"Item": "dist_item", "Craft Essence": "dist_ce",
+                  "Point": "dist_point"}
+    DROP_PRIORITIES = {"Item": PRIORITY_ITEM, "Craft Essence": PRIORITY_CE,
+                       "Point": PRIORITY_POINT}
+    SEARCH_DIRS = {"Item": Item_dir, "Craft Essence": CE_dir,
+                   "Point": Point_dir}
+    FILE_PREFIXES = {"Item": "item", "Craft Essence": "ce", "Point": "point"}
+
+    def __init__(self, drop_item):
+        self.lock = threading.RLock()
+        self.version = 0
+        self.next_id = ID_START
+        # ワーカー用の複製では新しいアイテムを pending に溜める
+        self.token = None
+        self.pending = None
+        # チェックポイント用に item フォルダから読んだファイルと
+        # 新しく作ったアイテムを記録する
+        self.loaded = []
+        self.created = []
+        self.restore = None
+        # batch() の間に複製済みの重ねた辞書 (ChainMap の id)
+        self.batch_copied = None
+        self.item_name = ChainMap({}, {item["id"]: item["name"]
+                                       for item in drop_item})
+        self.item_name_eng = {item["id"]: item["name_eng"]
+                              for item in drop_item if "name_eng" in item}
+        self.item_shortname = {item["id"]: item["shortname"]
+                               for item in drop_item if "shortname" in item}
+        self.item_dropPriority = ChainMap({}, {item["id"]: item["dropPriority"]
+                                               for item in drop_item})
+        self.item_background = ChainMap({}, {item["id"]: item["background"]
+                                             for item in drop_item
+                                             if "background" in item})
+        self.item_type = ChainMap({}, {item["id"]: item["type"]
+                                       for item in drop_item})
+        self.dist_item = ChainMap({}, {item["phash_battle"]: item["id"]
+                                       for item in drop_item
+                                       if item["type"] == "Item"
+                                       and "phash_battle" in item})
+        self.dist_ce = ChainMap({}, {item["phash"]: item["id"]
+                                     for item in drop_item
+                                     if item["type"] == "Craft Essence"})
+        self.dist_ce_narrow = ChainMap({}, {item["phash_narrow"]: item["id"]
+                                            for item in drop_item
+                                            if item["type"] == "Craft Essence"})
+        self.dist_point = ChainMap({}, {item["phash_battle"]: item["id"]
+                                        for item in drop_item
+                                        if item["type"] == "Point"
+                                        and "phash_battle" in item})
+        # ファイル名から id を引くための逆引き (同名なら先に出たものを使う)
+        name2id = {}
+        for k, v in self.item_name.items():
+            name2id.setdefault(v, k)
+        self.name2id = ChainMap({}, name2id)
+        self.shortname2id = {}
+        for k, v in self.item_shortname.items():
+            self.shortname2id.setdefault(v, k)
+        self.index_item = HashIndex(self, self.dist_item)
+        self.index_point = HashIndex(self, self.dist_point)
+
+    def fork(self):
+        """
+        並列処理のワーカー用の複製を返す
+        hash_drop.json 由来の辞書は共有し、重ねた辞書だけ複製する
+        複製では新しいアイテムのファイルを作らず、仮の id で登録して
+        pending に記録する (NewItemRegistry.resolve で確定させる)
+        """
+        worker = Catalog.__new__(Catalog)
+        with self.lock:
+            worker.__dict__.update(self.__dict__)
+            for name, value in self.__dict__.items():
+                if isinstance(value, ChainMap):
+                    setattr(worker, name,
+                            ChainMap(dict(value.maps[0]), *value.maps[1:]))
+        worker.lock = threading.RLock()
+        worker.batch_copied = None
+        worker.next_id = ID_PROVISIONAL_START
+        worker.token = uuid.uuid4().hex
+        worker.pending = []
+        worker.index_item = HashIndex(worker, worker.dist_item)
+        worker.index_point = HashIndex(worker, worker.dist_point)
+        # 作成済みの配列は複製せずに共有する (登録があれば作り直す)
+        worker.index_item.snapshot = self.index_item.snapshot
+        worker.index_point.snapshot = self.index_point.snapshot
+        return worker
+
+    def build_indexes(self):
+        """
+        検索用インデックスを作成しておく
+        ワーカーを fork する前に呼ぶと配列をワーカー間で共有できる
+        """
+        self.index_item.build()
+        self.index_point.build()
+
+    def take_pending(self):
+        """
+        仮登録した新しいアイテムを取り出す
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        return pending
+
+    def apply_additions(self, additions):
+        """
+        NewItemRegistry が確定させたアイテムを登録する
+        """
+        with self.batch():
+            for added in additions:
+                if added["id"] in self.item_name:
+                    continue
+                self.register(added["name"], added["category"],
+                              added["hash_hex"], added["background"],
+                              added["hash_hex_narrow"], id=added["id"])
+
+    @contextmanager
+    def batch(self):
+        """
+        まとめて登録する間は、重ねた辞書を最初の更新で一度だけ複製して
+        差し替え、以降はその複製を直接更新する (登録数の二乗にしない)
+        認識と並行して呼ばないこと (起動時とワーカーのファイル間で使う)
+        """
+        with self.lock:
+            if self.batch_copied is not None:
+                # 入れ子の batch() は外側に含める
+                yield
+                return
+            self.batch_copied = set()
+            try:
+                yield
+            finally:
+                self.batch_copied = None
+
+    def update(self, chain, values):
+        """
+        重ねた辞書を複製して更新し、差し替える
+        self.lock を取得してから呼ぶこと
+        """
+        if self.batch_copied is None:
+            overlay = dict(chain.maps[0])
+            overlay.update(values)
+            chain.maps[0] = overlay
+        elif id(chain) in self.batch_copied:
+            chain.maps[0].update(values)
+        else:
+            overlay = dict(chain.maps[0])
+            overlay.update(values)
+            chain.maps[0] = overlay
+            self.batch_copied.add(id(chain))
+
+    def allocate_id(self):
+        """
+        未使用の id を返す
+        self.lock を取得してから呼ぶこと
+        """
+        while self.next_id in self.item_name:
+            self.next_id += 1
+        id = self.next_id
+        self.next_id += 1
+        return id
+
+    def find_id(self, name):
+        """
+        名前か略称が name のアイテムの id を返す 無ければ None
+        """
+        id = self.name2id.get(name)
+        if id is None:
+            id = self.shortname2id.get(name)
+        return id
+
+    def register(self, name, category, hash_hex, background=None,
+                 hash_hex_narrow=None, id=None):
+        """
+        ユーザー定義アイテムを登録して id を返す
+        同じ名前のアイテムが既にあればその id に pHash を追加する
+        id を指定するとその id で新しく登録する
+        """
+        with self.lock:
+            if id is None:
+                id = self.find_id(name)
+                if id is None:
+                    id = self.allocate_id()
+            if id not in self.item_name:
+                # priotiry は固定
+                self.update(self.item_name, {id: name})
+                self.update(self.name2id, {name: id})
+                self.update(self.item_dropPriority,
+                            {id: self.DROP_PRIORITIES[category]})
+                self.update(self.item_type, {id: category})
+            if background is not None:
+                self.update(self.item_background, {id: background})
+            # 参照側は pHash の辞書からアイテムを見つけるので最後に更新する
+            if hash_hex_narrow is not None:
+                self.update(self.dist_ce_narrow, {hash_hex_narrow: id})
+            self.update(getattr(self, self.DIST_NAMES[category]),
+                        {hash_hex: id})
+            self.version += 1
+        return id
+
+    def image_entry(self, name, category, img, background=None):
+        """
+        画像から pHash を計算して register の引数を辞書で返す
+        """
+        if category == "Craft Essence":
+            return {"name": name, "category": category,
+                    "hash_hex": hash2hex(compute_hash_ce(img)),
+                    "background": None,
+                    "hash_hex_narrow": hash2hex(compute_hash_ce_narrow(img))}
+        return {"name": name, "category": category,
+                "hash_hex": hash2hex(compute_hash(img)),
+                "background": background, "hash_hex_narrow": None}
+
+    def register_image(self, name, category, img, background=None):
+        """
+        画像から pHash を計算して register する
+        """
+        return self.register(**self.image_entry(name, category, img,
+                                                background))
+
+    def get_state(self):
+        return {"loaded": self.loaded, "created": self.created}
+
+    def set_state(self, state):
+        """
+        チェックポイントから再開するときに calc_dist_local の前に呼ぶ
+        中断前と同じファイルだけを読み、作ったアイテムは同じ id で登録する
+        """
+        self.restore = state
+
+    def restore_files(self, category, files):
+        """
+        中断前に読んだファイルだけを返す
+        チェックポイントの後に作られたアイテムのファイルは .bak を付けて
+        退避する (再開後に同じファイル名で作り直す)
+        """
+        loaded = {name for c, name in self.restore["loaded"] if c == category}
+        created = {added["name"] for added in self.restore["created"]
+                   if added["category"] == category}
+        pattern = re.compile(re.escape(self.FILE_PREFIXES[category])
+                             + r"\d{3}$")
+        kept = []
+        for fname in files:
+            if fname.stem in loaded:
+                kept.append(fname)
+            elif fname.stem in created:
+                pass
+            elif pattern.match(fname.stem):
+                backup = fname.with_name(fname.name + ".bak")
+                i = 1
+                while backup.exists():
+                    backup = fname.with_name(fname.name + ".bak" + str(i))
+                    i += 1
+                logger.warning("move %s to %s: created after the checkpoint",
+                               fname, backup.name)
+                fname.rename(backup)
+            else:
+                logger.warning("skip %s: added after the checkpoint", fname)
+        return kept
+
+    def search_file(self, category):
+        """
+        Item, Craft Essence, Pointの各ファイルを探す
+        """
+        files = list(self.SEARCH_DIRS[category].glob('**/*.png'))
+        if self.restore is not None:
+            files = self.restore_files(category, files)
+        self.loaded.extend((category, fname.stem) for fname in files)
+        imgs = [imread(fname) for fname in files]
+        if category == "Item" or category == "Point":
+            backgrounds = [b[0] for b in classify_backgrounds(imgs)]
+        else:
+            backgrounds = [None] * len(imgs)
+        for fname, img, background in zip(files, imgs, backgrounds):
+            self.register_image(fname.stem, category, img, background)
+
+    def calc_dist_local(self):
+        """
+        既所持のアイテム画像の距離(一次元配列)の辞書を作成して保持
+        """
+        with self.batch():
+            self.search_file("Item")
+            self.search_file("Craft Essence")
+            self.search_file("Point")
+            if self.restore is not None:
+                self.apply_additions(self.restore["created"])
+                self.created = list(self.restore["created"])
+                self.restore = None
+
+    def make_new_file(self, img, category):
+        """
+        新しいアイテムの画像を保存して登録し、id を返す
+        """
+        search_dir = self.SEARCH_DIRS[category]
+        initial = self.FILE_PREFIXES[category]
+        if self.pending is not None:
+            return self.register_provisional(img, category)
+        with self.lock:
+            # ファイル名候補を探す
+            for i in range(999):
+                itemfile = search_dir / (initial
+                                         + '{:0=3}'.format(i + 1) + '.png')
+                if itemfile.is_file():
+                    continue
+                cv2.imwrite(itemfile.as_posix(), img)
+                entry = self.image_entry(itemfile.stem, category, img,
+                                         classify_background(img))
+                id = self.register(**entry)
+                self.created.append(dict(entry, id=id))
+                return id
+
+    def register_provisional(self, img, category):
+        """
+        ファイルを作らずに仮の id で登録して pending に記録する
+        """
+        new = {"category": category,
+               "img": img,
+               "background": classify_background(img)}
+        if category == "Craft Essence":
+            new["hash_hex"] = hash2hex(compute_hash_ce(img))
+            new["hash_hex_narrow"] = hash2hex(compute_hash_ce_narrow(img))
+        else:
+            new["hash_hex"] = hash2hex(compute_hash(img))
+            new["hash_hex_narrow"] = None
+        with self.lock:
+            id = self.allocate_id()
+            new["id"] = id
+            self.register(self.FILE_PREFIXES[category] + "?", category,
+                          new["hash_hex"], new["background"],
+                          new["hash_hex_narrow"], id=id)
+            self.pending.append(new)
+        return id
+
+    def out_name(self, lang, id):
+        if lang == "eng":
+            if id in self.item_name_eng:
+                return self.item_name_eng[id]
+        if id in self.item_shortname:
+            return self.item_shortname[id]
+        return self.item_name[id]
+
+
+default_catalog = Catalog(drop_item)
+# 既存のスクリプトから参照できるように catalog の辞書をモジュール変数にも置く
+item_name = default_catalog.item_name
+item_name_eng = default_catalog.item_name_eng
+item_shortname = default_catalog.item_shortname
+item_dropPriority = default_catalog.item_dropPriority
+item_background = default_catalog.item_background
+item_type = default_catalog.item_type
+dist_item = default_catalog.dist_item
+dist_ce = default_catalog.dist_ce
+dist_ce_narrow = default_catalog.dist_ce_narrow
+dist_point = default_catalog.dist_point
+
+
+class NewItemRegistry:
+    """
+    並列処理中に見つかった新しいアイテムを入力順に確定させる
+    ワーカーは Catalog.fork() の複製に仮の id で登録し、結果を受け取った
+    側が入力順に resolve() を呼ぶ
+    pHash が近いものは同じアイテムとしてまとめ、ファイル名と id は
+    逐次処理と同じ順に割り当てる
+    """
+    THRESHOLDS = {"Item": 12, "Craft Essence": 12, "Point": 12}
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.mapping = {}
+        self.additions = []
+
+    def find(self, new):
+        """
+        既に確定させたアイテムから pHash が最も近いものの id を返す
+        """
+        hash = hex2hash(new["hash_hex"])
+        found = None
+        for added in self.additions:
+            if added["category"] != new["category"]:
+                continue
+            if new["category"] != "Craft Essence" \
+                    and added["background"] != new["background"]:
+                continue
+            d = hasher.compare(hash, hex2hash(added["hash_hex"]))
+            if d <= self.THRESHOLDS[new["category"]] \
+                    and (found is None or d < found[0]):
+                found = (d, added["id"])
+        return None if found is None else found[1]
+
+    def resolve(self, token, pending, itemlist):
+        """
+        token のワーカーが仮登録したアイテムを確定させ、
+        itemlist の仮の id と名前を書き換える
+        """
+        for new in pending:
+            id = self.find(new)
+            if id is None:
+                id = self.catalog.make_new_file(new["img"], new["category"])
+                self.additions.append({
+                    "id": id,
+                    "name": self.catalog.item_name[id],
+                    "category": new["category"],
+                    "hash_hex": new["hash_hex"],
+                    "hash_hex_narrow": new["hash_hex_narrow"],
+                    "background": new["background"],
+                    })
+            self.mapping[(token, new["id"])] = id
+        for item in itemlist:
+            id = self.mapping.get((token, item["id"]))
+            if id is not None:
+                item["id"] = id
+                item["name"] = self.catalog.item_name[id]
+        return itemlist
+
+    def additions_since(self, n):
+        """
+        n 件目以降に確定させたアイテムを返す (ワーカーへの通知用)
+        """
+        return self.additions[n:]
+
+    def get_state(self):
+        return {"additions": self.additions}
+
+    def set_state(self, state):
+        self.additions = list(state["additions"])
+
+
 class ScreenShot:
     """
     戦利品スクリーンショットを表すクラス
     """
+    TRAINING_IMG_WIDTH = 1755
 
     def __init__(self, args, img_rgb, svm, svm_chest, svm_dcnt, svm_card,
-                 fileextention, reward_only=False):
+                 fileextention, area_hint=None,
+                 narrowing=None, catalog=None, executor=None):
         self.ui_type = "new"
-        TRAINING_IMG_WIDTH = 1755
+        self.catalog = default_catalog if catalog is None else catalog
         threshold = 80
         try:
-            self.pagenum, self.pages, self.lines = pageinfo.guess_pageinfo(img_rgb)
-        except pageinfo.TooManyAreasDetectedError:
-            self.pagenum, self.pages, self.lines = (-1, -1, -1)
+            self.pageinfo = pageinfo.guess_pageinfo(img_rgb)
+        except pageinfo.TooManyAreasDetectedError as e:
+            self.pageinfo = pageinfo.PageInfo(-1, -1, -1, scrollbar=e.scrollbar)
+        self.pagenum, self.pages, self.lines = self.pageinfo
+        # correct_pageinfo で推定をやり直したときの記録
+        self.pageinfo_diag = None
         self.img_rgb_orig = img_rgb
         self.img_gray_orig = cv2.cvtColor(img_rgb, cv2.COLOR_BGR2GRAY)
         self.img_hsv_orig = cv2.cvtColor(img_rgb, cv2.COLOR_BGR2HSV)
@@ -195,32 +753,12 @@ class ScreenShot:
         if logger.isEnabledFor(logging.DEBUG):
             cv2.imwrite('game_screen.png', game_screen)
 
-        _, width_g, _ = game_screen.shape
-        wscale = (1.0 * width_g) / TRAINING_IMG_WIDTH
-        resizeScale = 1 / wscale
-
-        if resizeScale > 1:
-            self.img_rgb = cv2.resize(game_screen, (0, 0),
-                                      fx=resizeScale, fy=resizeScale,
-                                      interpolation=cv2.INTER_CUBIC)
-            if self.ui_type == "old":
-                dcnt_old_rs = cv2.resize(dcnt_old, (0, 0),
-                                         fx=resizeScale, fy=resizeScale,
-                                         interpolation=cv2.INTER_CUBIC)
-            dcnt_new_rs = cv2.resize(dcnt_new, (0, 0),
-                                     fx=resizeScale, fy=resizeScale,
-                                     interpolation=cv2.INTER_CUBIC)
-        else:
-            self.img_rgb = cv2.resize(game_screen, (0, 0),
-                                      fx=resizeScale, fy=resizeScale,
-                                      interpolation=cv2.INTER_AREA)
-            if self.ui_type == "old":
-                dcnt_old_rs = cv2.resize(dcnt_old, (0, 0),
-                                         fx=resizeScale, fy=resizeScale,
-                                         interpolation=cv2.INTER_AREA)
-            dcnt_new_rs = cv2.resize(dcnt_new, (0, 0),
-                                     fx=resizeScale, fy=resizeScale,
-                                     interpolation=cv2.INTER_AREA)
+        self.resize_scale = training_scale(game_screen,
+                                           self.TRAINING_IMG_WIDTH)
+        self.img_rgb = resize_screen(game_screen, self.resize_scale)
+        if self.ui_type == "old":
+            dcnt_old_rs = resize_screen(dcnt_old, self.resize_scale)
+        dcnt_new_rs = resize_screen(dcnt_new, self.resize_scale)
 
         if logger.isEnabledFor(logging.DEBUG):
             cv2.imwrite('game_screen_resize.png', self.img_rgb)
@@ -231,7 +769,7 @@ class ScreenShot:
         self.img_gray = cv2.cvtColor(self.img_rgb, cv2.COLOR_BGR2GRAY)
         _, self.img_th = cv2.threshold(self.img_gray,
                                        threshold, 255, cv2.THRESH_BINARY)
-        mode = self.area_select()
+        mode = self.area_select(area_hint)
         logger.debug("Area Mode: %s", mode)
         self.svm = svm
         self.svm_chest = svm_chest
@@ -251,10 +789,7 @@ class ScreenShot:
 
         self.items = []
         self.current_dropPriority = PRIORITY_REWARD_QP
-        if reward_only:
-            # qpsplit.py で利用
-            item_pts = item_pts[0:1]
-        prev_item = None
+        cells = []
         for i, pt in enumerate(item_pts):
             lx, _ = self.find_edge(self.img_th[pt[1]: pt[3],
                                                pt[0]: pt[2]], reverse=True)
@@ -270,13 +805,32 @@ class ScreenShot:
                                           pt[0] + lx: pt[2] + lx]
             if logger.isEnabledFor(logging.DEBUG):
                 cv2.imwrite('item' + str(i) + '.png', item_img_rgb)
+            cells.append((item_img_rgb, item_img_gray))
+        # 背景判別は全アイテム分まとめて行う
+        backgrounds = classify_backgrounds([c[0] for c in cells])
+        if executor is not None:
+            # 前のアイテムに依存しない特徴量はスレッドプールで先に計算する
+            features = list(executor.map(
+                lambda c: CellFeatures(c[0], c[1], svm_card), cells))
+        else:
+            features = [None] * len(cells)
+
+        prev_item = None
+        for i, (cell, background, feature) in enumerate(zip(cells,
+                                                            backgrounds,
+                                                            features)):
+            item_img_rgb, item_img_gray = cell
             dropitem = Item(args, i, prev_item, item_img_rgb, item_img_gray,
                             svm, svm_card, fileextention,
-                            self.current_dropPriority, mode)
+                            self.current_dropPriority, mode, background,
+                            narrowing, self.catalog, feature)
             if dropitem.id == -1:
                 break
-            self.current_dropPriority = item_dropPriority[dropitem.id]
-            self.items.append(dropitem)
+            self.current_dropPriority = \
+                self.catalog.item_dropPriority[dropitem.id]
+            self.items.append(dropitem.to_record())
+            # 次のアイテムが参照しない画像はここで解放する
+            dropitem.release()
             prev_item = dropitem
 
         self.itemlist = self.makeitemlist()
@@ -291,8 +845,7 @@ class ScreenShot:
         if self.qp_gained > 0 and len(self.itemlist) == 0:
             raise GainedQPandDropMissMatchError
         self.pagenum, self.pages, self.lines = self.correct_pageinfo()
-        if not reward_only:
-            self.check_page_mismatch()
+        self.check_page_mismatch()
 
     def check_page_mismatch(self):
         count_miss = False
@@ -318,13 +871,38 @@ class ScreenShot:
             logger.warning("drops_count = %d", self.chestnum)
             logger.warning("drops_found = %d", len(self.itemlist))
 
+    def scroll_bar_region(self):
+        '''
+        detect_scroll_bar が調べる領域 (リサイズ後の座標)
+        '''
+        width = self.width
+        return (width - 90, 81), (width, 2 + 753)
+
+    def reuse_scroll_bar(self):
+        '''
+        guess_pageinfo が検出したスクロールバーの矩形を detect_scroll_bar と
+        同じ座標 (調べる領域の上端からの y, 高さ) にして返す
+        矩形が無いか調べる領域から外れている場合は (-1, -1)
+        '''
+        if self.pageinfo.scrollbar is None:
+            return -1, -1
+        x, y, w, h = self.pageinfo.scrollbar
+        ox, oy = self.game_screen_origin
+        x = (x - ox) * self.resize_scale
+        y = (y - oy) * self.resize_scale
+        w = w * self.resize_scale
+        h = h * self.resize_scale
+        topleft, bottomright = self.scroll_bar_region()
+        if x < topleft[0] or x + w > bottomright[0] \
+                or y < topleft[1] or y + h > bottomright[1]:
+            return -1, -1
+        return int(y) - topleft[1], int(h)
+
     def detect_scroll_bar(self):
         '''
         Modified from determine_scroll_position()
         '''
-        width = self.img_rgb.shape[1]
-        topleft = (width - 90, 81)
-        bottomright = (width, 2 + 753)
+        topleft, bottomright = self.scroll_bar_region()
 
         if logger.isEnabledFor(logging.DEBUG):
             img_copy = self.img_rgb.copy()
@@ -372,17 +950,33 @@ class ScreenShot:
         return True
 
     def correct_pageinfo(self):
+        '''
+        pageinfo が正しくなければスクロール可能領域を固定の位置として推定し直す
+        スクロールバーは guess_pageinfo が検出したものを使い、
+        無い場合だけ detect_scroll_bar で検出する
+        '''
         if self.valid_pageinfo() is False:
-            logger.warning("pageinfo validation failed")
-            asr_y, actual_height = self.detect_scroll_bar()
+            source = "guess_pageinfo"
+            asr_y, actual_height = self.reuse_scroll_bar()
+            if asr_y == -1:
+                source = "detect_scroll_bar"
+                asr_y, actual_height = self.detect_scroll_bar()
             if asr_y == -1 or actual_height == -1:
-                return 1, 1, 0
-            entire_height = 649
-            esr_y = 17
-            pagenum = pageinfo.guess_pagenum(asr_y, esr_y, entire_height)
-            pages = pageinfo.guess_pages(actual_height, entire_height)
-            lines = pageinfo.guess_lines(actual_height, entire_height)
-            return pagenum, pages, lines
+                corrected = (1, 1, 0)
+                source = "none"
+            else:
+                entire_height = 649
+                esr_y = 17
+                pagenum = pageinfo.guess_pagenum(asr_y, esr_y, entire_height)
+                pages = pageinfo.guess_pages(actual_height, entire_height)
+                lines = pageinfo.guess_lines(actual_height, entire_height)
+                corrected = (pagenum, pages, lines)
+            logger.warning("pageinfo validation failed: %s -> %s (%s)",
+                           tuple(self.pageinfo), corrected, source)
+            self.pageinfo_diag = {"guess": tuple(self.pageinfo),
+                                  "corrected": corrected,
+                                  "source": source}
+            return corrected
         else:
             return self.pagenum, self.pages, self.lines
 
@@ -733,6 +1327,7 @@ class ScreenShot:
         bottom_y = bottom_y + int(124*scale/924)
         logger.debug(bottom_y)
         game_screen = self.img_rgb_orig[upper_y: bottom_y, left_x: right_x]
+        self.game_screen_origin = (left_x, upper_y)
         dcnt_old = None
         if self.ui_type == "old":
             left_dxo = left_x + int(1446*scale/924)
@@ -760,25 +1355,57 @@ class ScreenShot:
 
         return game_screen, dcnt_old, dcnt_new
 
-    def area_select(self):
+    def area_select(self, hint=None):
         """
         FGOアプリの地域を選択
         'na', 'jp'に対応
 
         'items_img.png' とのオブジェクトマッチングで判定
+        hint に同じ実行で判定済みの (地域, 一致位置) を渡すと
+        まず安価な確認のみ行い、確認できなかったときだけ全域を照合する
         """
         img_gray = self.img_gray[0:100, 0:500]
-        template = imread(items_img, 0)
+        template = get_items_template()
+        threshold = AREA_MATCH_THRESHOLD
+        if hint is not None:
+            mode, loc = hint
+            if mode == 'na':
+                # 前回一致した位置の周辺だけ照合する
+                margin = 4
+                t_h, t_w = template.shape[:2]
+                left = max(loc[0] - margin, 0)
+                top = max(loc[1] - margin, 0)
+                roi = img_gray[top: loc[1] + t_h + margin,
+                               left: loc[0] + t_w + margin]
+                if roi.shape[0] >= t_h and roi.shape[1] >= t_w:
+                    res = cv2.matchTemplate(roi, template,
+                                            cv2.TM_CCOEFF_NORMED)
+                    _, max_val, _, max_loc = cv2.minMaxLoc(res)
+                    if max_val >= threshold:
+                        self.area_hint = ('na', (max_loc[0] + left,
+                                                 max_loc[1] + top))
+                        return 'na'
+            else:
+                # 1/2 に縮小して照合し、明らかに一致しなければ 'jp' とする
+                # 閾値に近いときは全解像度で照合する
+                res = cv2.matchTemplate(cv2.pyrDown(img_gray),
+                                        get_items_template(coarse=True),
+                                        cv2.TM_CCOEFF_NORMED)
+                _, max_val, _, _ = cv2.minMaxLoc(res)
+                if max_val < threshold - AREA_COARSE_MARGIN:
+                    logger.debug("area: jp by coarse match (%.3f)", max_val)
+                    self.area_hint = hint
+                    return 'jp'
         res = cv2.matchTemplate(
                                 img_gray,
                                 template,
                                 cv2.TM_CCOEFF_NORMED
                                 )
-        threshold = 0.9
-        loc = np.where(res >= threshold)
-        for pt in zip(*loc[::-1]):
+        _, max_val, _, max_loc = cv2.minMaxLoc(res)
+        if max_val >= threshold:
+            self.area_hint = ('na', max_loc)
             return 'na'
-            break
+        self.area_hint = ('jp', None)
         return 'jp'
 
     def makeitemlist(self):
@@ -790,8 +1417,8 @@ class ScreenShot:
             tmp = {}
             tmp['id'] = item.id
             tmp['name'] = item.name
-            tmp['dropPriority'] = item_dropPriority[item.id]
-            tmp['dropnum'] = int(item.dropnum[1:])
+            tmp['dropPriority'] = self.catalog.item_dropPriority[item.id]
+            tmp['dropnum'] = item.dropnum
             tmp['bonus'] = item.bonus
             tmp['category'] = item.category
             itemlist.append(tmp)
@@ -835,29 +1462,13 @@ class ScreenShot:
         logger.debug("ocr item_pts: %s", item_pts)
         logger.debug("ドロップ桁数(OCR): %d", len(item_pts))
 
-        # Hog特徴のパラメータ
-        win_size = (120, 60)
-        block_size = (16, 16)
-        block_stride = (4, 4)
-        cell_size = (4, 4)
-        bins = 9
-
         res = ""
         for pt in item_pts:
-            test = []
-
             if pt[0] == 0:
                 tmpimg = im_th[pt[1]:pt[3], pt[0]:pt[2]+1]
             else:
                 tmpimg = im_th[pt[1]:pt[3], pt[0]-1:pt[2]+1]
-            tmpimg = cv2.resize(tmpimg, (win_size))
-            hog = cv2.HOGDescriptor(win_size, block_size,
-                                    block_stride, cell_size, bins)
-            test.append(hog.compute(tmpimg))  # 特徴量の格納
-            test = np.array(test)
-
-            pred = self.svm_chest.predict(test)
-            res = res + str(int(pred[1][0][0]))
+            res = res + str(self.svm_chest.predict(tmpimg))
 
         return int(res)
 
@@ -870,37 +1481,17 @@ class ScreenShot:
         _, img_num = cv2.threshold(img_gray,
                                    threshold, 255, cv2.THRESH_BINARY)
         im_th = cv2.bitwise_not(img_num)
-        h, w = im_th.shape[:2]
 
         # 情報ウィンドウが数字とかぶった部分を除去する
-        for y in range(h):
-            im_th[y, 0] = 255
-        for x in range(w):  # ドロップ数7のときバグる対策 #54
-            im_th[0, x] = 255
+        im_th[:, 0] = 255
+        im_th[0, :] = 255  # ドロップ数7のときバグる対策 #54
         return self.ocr_text(im_th)
 
     def pred_dcnt(self, img):
         """
         for JP new UI
         """
-        # Hog特徴のパラメータ
-        win_size = (120, 60)
-        block_size = (16, 16)
-        block_stride = (4, 4)
-        cell_size = (4, 4)
-        bins = 9
-        char = []
-
-        tmpimg = cv2.resize(img, (win_size))
-        hog = cv2.HOGDescriptor(win_size, block_size,
-                                block_stride, cell_size, bins)
-        char.append(hog.compute(tmpimg))  # 特徴量の格納
-        char = np.array(char)
-
-        pred = self.svm_dcnt.predict(char)
-        res = str(int(pred[1][0][0]))
-
-        return int(res)
+        return self.svm_dcnt.predict(img)
 
     def img2num(self, img, img_th, pts, char_w, end):
         """実際より小さく切り抜かれた数字画像を補正して認識させる
@@ -908,8 +1499,9 @@ class ScreenShot:
         """
         height, width = img.shape[:2]
         c_center = int(pts[0] + (pts[2] - pts[0])/2)
+        left = int(c_center - char_w/2)
         # newimg = img[:, item_pts[-1][0]-1:item_pts[-1][2]+1]
-        newimg = img[:, max(int(c_center - char_w/2), 0):min(int(c_center + char_w/2), width)]
+        newimg = img[:, max(left, 0):min(int(c_center + char_w/2), width)]
 
         threshold2 = 10
         ret, newimg_th = cv2.threshold(newimg,
@@ -917,14 +1509,10 @@ class ScreenShot:
                                        255,
                                        cv2.THRESH_BINARY)
         # 上部はもとのやつを上書き
-        # for w in range(item_pts[-1][2] - item_pts[-1][0] + 2):
-        for w in range(min(int(c_center + char_w/2), width) - max(int(c_center - char_w/2), 0)):
-            for h in range(end):
-                newimg_th[h, w] = img_th[h, w + int(c_center - char_w/2)]
-        #        newimg_th[h, w] = img_th[h, w + item_pts[-1][0]]
-            newimg_th[height - 1, w] = 0
-            newimg_th[height - 2, w] = 0
-            newimg_th[height - 3, w] = 0
+        # 左端がはみ出したときはループ実装と同じく負のインデックスで参照する
+        cols = np.arange(left, left + newimg_th.shape[1])
+        newimg_th[:max(end, 0)] = img_th[:max(end, 0), cols]
+        newimg_th[height - 3:height] = 0
 
         res = self.pred_dcnt(newimg_th)
         return res
@@ -941,16 +1529,13 @@ class ScreenShot:
         img_th = cv2.dilate(img_th, kernel, iterations=1)
         height, width = img_th.shape[:2]
 
-        end = -1
-        for i in range(height):
-            if end == -1 and img_th[height - i - 1, width - 1] == 255:
-                end = height - i
-                break
+        # 右端の列で一番下にある白画素の直下を end とする
+        white_rows = np.flatnonzero(img_th[:, width - 1] == 255)
+        end = int(white_rows[-1]) + 1 if len(white_rows) > 0 else -1
         start = end - 7
 
-        for j in range(width):
-            for k in range(end - start):
-                img_th[start + k, j] = 0
+        # end が -1 のときはループ実装と同じく下端からの行を消す
+        img_th[np.arange(start, end)] = 0
 
         contours = cv2.findContours(img_th,
                                     cv2.RETR_EXTERNAL,
@@ -1064,6 +1649,144 @@ class ScreenShot:
         return pts
 
 
+class RewardQPScreenShot(ScreenShot):
+    """
+    qpsplit.py の振り分けに必要な情報だけを読む ScreenShot
+    最初のアイテム (報酬QP) とドロップ数、ページ番号だけを認識し、
+    所持QP・獲得QP、二つ目以降のアイテム、ドロップ数との照合は行わない
+    ゲーム画面の位置は ScreenShot と同じく直線検出で求めるが、
+    リサイズと二値化は地域判定と一列目のアイテムに使う左側だけ行う
+    """
+    # リサイズ後に使う左端からの幅 (地域判定の 500 と一列目のアイテム)
+    USED_WIDTH = 640
+
+    def __init__(self, args, img_rgb, svm, svm_chest, svm_dcnt, svm_card,
+                 fileextention, area_hint=None, catalog=None):
+        self.ui_type = "new"
+        self.catalog = default_catalog if catalog is None else catalog
+        threshold = 80
+        try:
+            self.pageinfo = pageinfo.guess_pageinfo(img_rgb)
+        except pageinfo.TooManyAreasDetectedError as e:
+            self.pageinfo = pageinfo.PageInfo(-1, -1, -1, scrollbar=e.scrollbar)
+        self.pagenum, self.pages, self.lines = self.pageinfo
+        self.pageinfo_diag = None
+        self.img_rgb_orig = img_rgb
+        self.img_gray_orig = cv2.cvtColor(img_rgb, cv2.COLOR_BGR2GRAY)
+        # find_notch は左右の端しか見ないので、その部分だけ HSV にする
+        height, width = img_rgb.shape[:2]
+        edge = 150
+        if width > edge * 2:
+            img_rgb = np.hstack((img_rgb[:, :edge], img_rgb[:, width - edge:]))
+        self.img_hsv_orig = cv2.cvtColor(img_rgb, cv2.COLOR_BGR2HSV)
+        _, self.img_th_orig = cv2.threshold(self.img_gray_orig,
+                                            threshold, 255, cv2.THRESH_BINARY)
+
+        game_screen, dcnt_old, dcnt_new = self.extract_game_screen()
+        self.game_screen = game_screen
+        height_g, width_g = game_screen.shape[:2]
+        self.resize_scale = training_scale(game_screen,
+                                           self.TRAINING_IMG_WIDTH)
+        # 左側だけリサイズしても、端から離れた画素は全体をリサイズしたときと同じ
+        used = min(width_g,
+                   math.ceil(self.USED_WIDTH / self.resize_scale) + 4)
+        self.img_rgb = resize_screen(game_screen[:, :used], self.resize_scale)
+        if self.ui_type == "old":
+            dcnt_old_rs = resize_screen(dcnt_old, self.resize_scale)
+        dcnt_new_rs = resize_screen(dcnt_new, self.resize_scale)
+
+        self.img_gray = cv2.cvtColor(self.img_rgb, cv2.COLOR_BGR2GRAY)
+        _, self.img_th = cv2.threshold(self.img_gray,
+                                       threshold, 255, cv2.THRESH_BINARY)
+        mode = self.area_select(area_hint)
+        logger.debug("Area Mode: %s", mode)
+        self.svm = svm
+        self.svm_chest = svm_chest
+        self.svm_dcnt = svm_dcnt
+
+        # img2points などはゲーム画面全体の大きさを使う
+        self.height = self.img_rgb.shape[0]
+        self.width = int(width_g * self.resize_scale + 0.5)
+        if self.ui_type == "old":
+            self.chestnum = self.ocr_tresurechest(dcnt_old_rs)
+            if self.chestnum == -1:
+                self.chestnum = self.ocr_dcnt(dcnt_new_rs)
+        else:
+            self.chestnum = self.ocr_dcnt(dcnt_new_rs)
+        logger.debug("Total Drop (OCR): %d", self.chestnum)
+
+        self.items = []
+        self.current_dropPriority = PRIORITY_REWARD_QP
+        pt = self.img2points()[0]
+        lx, _ = self.find_edge(self.img_th[pt[1]: pt[3], pt[0]: pt[2]],
+                               reverse=True)
+        item_img_th = self.img_th[pt[1] + 37: pt[3] - 30,
+                                  pt[0] + lx: pt[2] + lx]
+        if not self.is_empty_box(item_img_th):
+            item_img_rgb = self.img_rgb[pt[1]: pt[3], pt[0] + lx: pt[2] + lx]
+            item_img_gray = self.img_gray[pt[1]: pt[3], pt[0] + lx: pt[2] + lx]
+            background = classify_backgrounds([item_img_rgb])[0]
+            dropitem = Item(args, 0, None, item_img_rgb, item_img_gray,
+                            svm, svm_card, fileextention,
+                            self.current_dropPriority, mode, background,
+                            None, self.catalog, None)
+            if dropitem.id != -1:
+                self.items.append(dropitem.to_record())
+                dropitem.release()
+
+        self.itemlist = self.makeitemlist()
+        self.total_qp = -1
+        self.qp_gained = -1
+        self.pagenum, self.pages, self.lines = self.correct_pageinfo()
+
+    def detect_scroll_bar(self):
+        """
+        スクロールバーは右端にあるので、ゲーム画面全体をリサイズしてから探す
+        (pageinfo が正しくなく、guess_pageinfo でスクロールバーが
+        見つからなかったときだけ)
+        """
+        self.img_rgb = resize_screen(self.game_screen, self.resize_scale)
+        self.img_gray = cv2.cvtColor(self.img_rgb, cv2.COLOR_BGR2GRAY)
+        return super().detect_scroll_bar()
+
+
+def training_scale(game_screen, training_width):
+    """
+    ゲーム画面を学習データの幅に合わせる倍率
+    """
+    _, width_g = game_screen.shape[:2]
+    wscale = (1.0 * width_g) / training_width
+    return 1 / wscale
+
+
+def resize_screen(img, scale):
+    """
+    学習データの解像度に合わせて拡大・縮小する
+    """
+    if scale > 1:
+        interpolation = cv2.INTER_CUBIC
+    else:
+        interpolation = cv2.INTER_AREA
+    return cv2.resize(img, (0, 0), fx=scale, fy=scale,
+                      interpolation=interpolation)
+
+
+def get_items_template(coarse=False):
+    """
+    地域判定用の 'items_img.png' を読み込む
+    一度読み込んだ画像は使いまわす
+    coarse=True のときは 1/2 に縮小した画像を返す
+    """
+    global items_template, items_template_coarse
+    if items_template is None:
+        template = imread(items_img, 0)
+        items_template_coarse = cv2.pyrDown(template)
+        items_template = template
+    if coarse:
+        return items_template_coarse
+    return items_template
+
+
 def generate_booty_pts(criteria_left, criteria_top, item_width, item_height,
                        margin_width, margin_height):
     """
@@ -1097,29 +1820,80 @@ def generate_booty_pts(criteria_left, criteria_top, item_width, item_height,
     return pts
 
 
+class DropRecord:
+    """
+    認識したドロップ1個分の結果 (変更不可)
+    dropnum は数値で、画像などの認識途中の状態は持たない
+    """
+    __slots__ = ("id", "name", "dropnum", "bonus", "category", "position")
+
+    def __init__(self, id, name, dropnum, bonus, category, position):
+        for key, value in zip(self.__slots__,
+                              (id, name, dropnum, bonus, category, position)):
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("DropRecord is immutable")
+
+    def __eq__(self, other):
+        if not isinstance(other, DropRecord):
+            return NotImplemented
+        return all(getattr(self, key) == getattr(other, key)
+                   for key in self.__slots__)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, key) for key in self.__slots__))
+
+    def __repr__(self):
+        return "DropRecord({})".format(", ".join(
+            "{}={!r}".format(key, getattr(self, key))
+            for key in self.__slots__))
+
+    def __reduce__(self):
+        return (DropRecord, tuple(getattr(self, key)
+                                  for key in self.__slots__))
+
+
 class Item:
     def __init__(self, args, pos, prev_item, img_rgb, img_gray, svm, svm_card,
-                 fileextention, current_dropPriority, mode='jp'):
+                 fileextention, current_dropPriority, mode='jp',
+                 background=None, narrowing=None, catalog=None,
+                 features=None):
         self.position = pos
+        self.narrowing = narrowing
+        self.catalog = default_catalog if catalog is None else catalog
         self.prev_item = prev_item
         self.img_rgb = img_rgb
         self.img_gray = img_gray
-        self.img_hsv = cv2.cvtColor(img_rgb, cv2.COLOR_BGR2HSV)
-        _, img_th = cv2.threshold(self.img_gray, 174, 255, cv2.THRESH_BINARY)
-        self.img_th = cv2.bitwise_not(img_th)
+        if features is None:
+            self.img_hsv = cv2.cvtColor(img_rgb, cv2.COLOR_BGR2HSV)
+            self.img_th = calc_item_th(img_gray)
+            self.hash_item = None
+            self.category_pred = None
+            self.bonus_mask = None
+        else:
+            self.img_hsv = features.img_hsv
+            self.img_th = features.img_th
+            self.hash_item = features.hash_item
+            self.category_pred = features.category
+            self.bonus_mask = features.bonus_mask
         self.fileextention = fileextention
         self.dropnum_cache = []
         self.margin_left = 5
 
         self.height, self.width = img_rgb.shape[:2]
         logger.debug("pos: %d", pos)
+        if background is None:
+            background = classify_backgrounds([img_rgb])[0]
+        self.set_background(*background)
         self.identify_item(args, prev_item, svm_card,
                            current_dropPriority)
         if self.id == -1:
             return
         logger.debug("id: %d", self.id)
         logger.debug("background: %s", self.background)
-        logger.debug("dropPriority: %s", item_dropPriority[self.id])
+        logger.debug("dropPriority: %s",
+                     self.catalog.item_dropPriority[self.id])
         logger.debug("Category: %s", self.category)
         logger.debug("Name: %s", self.name)
 
@@ -1132,10 +1906,40 @@ class Item:
         logger.debug("Bonus: %s", self.bonus)
         logger.debug("Stack: %s", self.dropnum)
 
+    def to_record(self):
+        return DropRecord(self.id, self.name, int(self.dropnum[1:]),
+                          self.bonus, self.category, self.position)
+
+    def release(self):
+        """
+        次のアイテムの判別に使わない画像と前のアイテムへの参照を解放する
+        (hash_item, dropnum_cache, bonus_pts などは残す)
+        """
+        self.img_rgb = None
+        self.img_gray = None
+        self.img_hsv = None
+        self.img_th = None
+        self.bonus_mask = None
+        self.prev_item = None
+
+    def set_background(self, background, margin, second):
+        """
+        背景判別結果を設定する
+        判別が曖昧なときは二番目に近い背景も候補として残す
+        """
+        self.background = background
+        self.background_margin = margin
+        self.background_candidates = [background]
+        if margin < BACKGROUND_MARGIN_MIN:
+            logger.debug("pos %d: background is ambiguous: %s or %s "
+                         "(margin %.3f)",
+                         self.position, background, second, margin)
+            self.background_candidates.append(second)
+
     def identify_item(self, args, prev_item, svm_card,
                       current_dropPriority):
-        self.background = classify_background(self.img_rgb)
-        self.hash_item = compute_hash(self.img_rgb)  # 画像の距離
+        if self.hash_item is None:
+            self.hash_item = compute_hash(self.img_rgb)  # 画像の距離
         if prev_item is not None:
             # [Requirements for Caching]
             # 1. previous item is not a reward QP.
@@ -1152,19 +1956,22 @@ class Item:
                     self.id = prev_item.id
                     self.name = prev_item.name
                     return
-        self.category = self.classify_category(svm_card)
+        if self.category_pred is None:
+            self.category = self.classify_category(svm_card)
+        else:
+            self.category = self.category_pred
         self.id = self.classify_card(self.img_rgb, current_dropPriority)
         if args.lang == "jpn":
-            self.name = item_name[self.id]
+            self.name = self.catalog.item_name[self.id]
         else:
-            if self.id in item_name_eng.keys():
-                self.name = item_name_eng[self.id]
+            if self.id in self.catalog.item_name_eng:
+                self.name = self.catalog.item_name_eng[self.id]
             else:
-                self.name = item_name[self.id]
+                self.name = self.catalog.item_name[self.id]
 
         if self.category == "":
-            if self.id in item_type:
-                self.category = item_type[self.id]
+            if self.id in self.catalog.item_type:
+                self.category = self.catalog.item_type[self.id]
             else:
                 self.category = "Item"
 
@@ -1351,22 +2158,12 @@ class Item:
         """
 
         margin_top = int(self.height*0.72)
-        margin_bottom = int(self.height*0.11)
         margin_left = 8
-        margin_right = 8
-
-        img_hsv_lower = self.img_hsv[margin_top: self.height - margin_bottom,
-                                     margin_left: self.width - margin_right]
 
-        h, w = img_hsv_lower.shape[:2]
-        # 手持ちスクショでうまくいっている範囲
-        # 黄文字がこの数値でマスクできるかが肝
-        # 未対応機種が発生したため[25,180,119] →[25,175,119]に変更
-        lower_yellow = np.array([25, 175, 119])
-        upper_yellow = np.array([37, 255, 255])
-
-        img_hsv_lower_mask = cv2.inRange(img_hsv_lower,
-                                         lower_yellow, upper_yellow)
+        if self.bonus_mask is None:
+            self.bonus_mask = calc_bonus_mask(self.img_hsv)
+        img_hsv_lower_mask = self.bonus_mask
+        h, w = img_hsv_lower_mask.shape[:2]
 
         contours = cv2.findContours(img_hsv_lower_mask, cv2.RETR_TREE,
                                     cv2.CHAIN_APPROX_SIMPLE)[0]
@@ -1777,23 +2574,11 @@ class Item:
         """
         ボーナスの数値をOCRする(エラー訂正有)
         """
-        win_size = (120, 60)
-        block_size = (16, 16)
-        block_stride = (4, 4)
-        cell_size = (4, 4)
-        bins = 9
         lines = ""
 
         for pt in pts:
-            char = []
             tmpimg = self.img_gray[pt[1]:pt[3], pt[0]:pt[2]]
-            tmpimg = cv2.resize(tmpimg, (win_size))
-            hog = cv2.HOGDescriptor(win_size, block_size, block_stride,
-                                    cell_size, bins)
-            char.append(hog.compute(tmpimg))
-            char = np.array(char)
-            pred = self.svm.predict(char)
-            result = int(pred[1][0][0])
+            result = self.svm.predict(tmpimg)
             if result != 0:
                 lines = lines + chr(result)
         logger.debug("OCR Result: %s", lines)
@@ -1841,21 +2626,8 @@ class Item:
         戦利品の数値1文字をOCRする
         白文字検出で使用
         """
-        win_size = (120, 60)
-        block_size = (16, 16)
-        block_stride = (4, 4)
-        cell_size = (4, 4)
-        bins = 9
-        char = []
         tmpimg = self.img_gray[pt[1]:pt[3], pt[0]:pt[2]]
-        tmpimg = cv2.resize(tmpimg, (win_size))
-        hog = cv2.HOGDescriptor(win_size, block_size, block_stride,
-                                cell_size, bins)
-        char.append(hog.compute(tmpimg))
-        char = np.array(char)
-        pred = self.svm.predict(char)
-        result = int(pred[1][0][0])
-        return chr(result)
+        return chr(self.svm.predict(tmpimg))
 
     def ocr_digit(self, mode='jp'):
         """
@@ -1967,8 +2739,9 @@ class Item:
                 logger.debug("margin_right: %d", margin_right)
                 pts = ((self.margin_left, base_line - cut_height),
                        (width - margin_right, base_line))
+                # スクショ全体の画像を参照し続けないよう複製する
                 cached_img = self.img_gray[pts[0][1]:pts[1][1],
-                                           pts[0][0]:pts[1][0]]
+                                           pts[0][0]:pts[1][0]].copy()
                 tmp = {}
                 tmp["dropnum"] = self.dropnum
                 tmp["img"] = cached_img
@@ -1995,23 +2768,28 @@ class Item:
         id を返すように変更
         """
         hash_item = self.hash_item  # 画像の距離
-        ids = {}
         if logger.isEnabledFor(logging.DEBUG):
             hex = ""
             for h in hash_item[0]:
                 hex = hex + "{:02x}".format(h)
             logger.debug("phash: %s", hex)
         # 既存のアイテムとの距離を比較
-        for i in dist_item.keys():
-            itemid = dist_item[i]
-            item_bg = item_background[itemid]
-            d = hasher.compare(hash_item, hex2hash(i))
-            if d <= 12 and item_bg == self.background:
-                # ポイントと種の距離が8という例有り(IMG_0274)→16に
-                # バーガーと脂の距離が10という例有り(IMG_2354)→14に
-                ids[dist_item[i]] = d
+        # ポイントと種の距離が8という例有り(IMG_0274)→16に
+        # バーガーと脂の距離が10という例有り(IMG_2354)→14に
+        ids = []
+        if self.narrowing is not None:
+            # クエストが判明していればまずそのドロップから探す
+            # (クエスト外のアイテムを取り違えないよう近いものだけ)
+            ids = self.narrowing.index_item.search(
+                      hash_item, self.background_candidates,
+                      NARROWING_THRESHOLD, currnet_dropPriority)
+            self.narrowing.record(len(ids) > 0)
+        if len(ids) == 0:
+            # ドロップは dropPriority 順に並ぶので前のアイテム以下の候補から探す
+            ids = self.catalog.index_item.search_with_priority(
+                      hash_item, self.background_candidates, 12,
+                      currnet_dropPriority)
         if len(ids) > 0:
-            ids = sorted(ids.items(), key=lambda x: x[1])
             id_tupple = next(iter(ids))
             id = id_tupple[0]
             if ID_SECRET_GEM_MIN <= id <= ID_SECRET_GEM_MAX:
@@ -2059,34 +2837,49 @@ class Item:
         return ""
 
     def classify_ce(self, img):
-        itemid = self.classify_ce_sub(img, compute_hash_ce, dist_ce, 12)
+        if self.narrowing is not None:
+            # クエストが判明していればまずそのドロップから探す
+            # (クエスト外の礼装を取り違えないよう近いものだけ)
+            itemid = self.classify_ce_sub(img, compute_hash_ce,
+                                          self.narrowing.dist_ce,
+                                          NARROWING_THRESHOLD)
+            self.narrowing.record(itemid != "")
+            if itemid != "":
+                return itemid
+        itemid = self.classify_ce_sub(img, compute_hash_ce,
+                                      self.catalog.dist_ce, 12)
         if itemid == "":
             logger.debug("use narrow image")
             itemid = self.classify_ce_sub(
-                        img, compute_hash_ce_narrow, dist_ce_narrow, 15
+                        img, compute_hash_ce_narrow,
+                        self.catalog.dist_ce_narrow, 15
                         )
         return itemid
 
-    def classify_point(self, img):
+    def classify_point(self, img, currnet_dropPriority=PRIORITY_REWARD_QP):
         """
         imgとの距離を比較して近いアイテムを求める
         """
         hash_item = compute_hash(img)  # 画像の距離
-        itemfiles = {}
         if logger.isEnabledFor(logging.DEBUG):
             hex = ""
             for h in hash_item[0]:
                 hex = hex + "{:02x}".format(h)
             logger.debug("phash: %s", hex)
         # 既存のアイテムとの距離を比較
-        for i in dist_point.keys():
-            itemid = dist_point[i]
-            item_bg = item_background[itemid]
-            d = hasher.compare(hash_item, hex2hash(i))
-            if d <= 12 and item_bg == self.background:
-                itemfiles[itemid] = d
+        itemfiles = []
+        if self.narrowing is not None:
+            # クエストが判明していればまずそのドロップから探す
+            # (クエスト外のアイテムを取り違えないよう近いものだけ)
+            itemfiles = self.narrowing.index_point.search(
+                            hash_item, self.background_candidates,
+                            NARROWING_THRESHOLD, currnet_dropPriority)
+            self.narrowing.record(len(itemfiles) > 0)
+        if len(itemfiles) == 0:
+            itemfiles = self.catalog.index_point.search_with_priority(
+                            hash_item, self.background_candidates, 12,
+                            currnet_dropPriority)
         if len(itemfiles) > 0:
-            itemfiles = sorted(itemfiles.items(), key=lambda x: x[1])
             item = next(iter(itemfiles))
 
             return item[0]
@@ -2117,109 +2910,47 @@ class Item:
 
         return ""
 
-    def make_new_file(self, img, search_dir, dist_dic, dropPriority, category):
+    def make_new_file(self, img, category):
         """
-        ファイル名候補を探す
+        新しいアイテムとして画像を保存し、id を返す
         """
-        i_dic = {"Item": "item", "Craft Essence": "ce", "Point": "point"}
-        initial = i_dic[category]
-        for i in range(999):
-            itemfile = search_dir / (initial + '{:0=3}'.format(i + 1) + '.png')
-            if itemfile.is_file():
-                continue
-            else:
-                cv2.imwrite(itemfile.as_posix(), img)
-                # id 候補を決める
-                for j in range(99999):
-                    id = j + ID_START
-                    if id in item_name.keys():
-                        continue
-                    break
-                if category == "Craft Essence":
-                    hash = compute_hash_ce(img)
-                else:
-                    hash = compute_hash(img)
-                hash_hex = ""
-                for h in hash[0]:
-                    hash_hex = hash_hex + "{:02x}".format(h)
-                dist_dic[hash_hex] = id
-                if category == "Craft Essence":
-                    hash_narrow = compute_hash_ce_narrow(img)
-                    hash_hex_narrow = ""
-                    for h in hash_narrow[0]:
-                        hash_narrow = hash_narrow + "{:02x}".format(h)
-                    dist_ce_narrow[hash_hex_narrow] = id
-                item_name[id] = itemfile.stem
-                item_background[id] = classify_background(img)
-                item_dropPriority[id] = dropPriority
-                item_type[id] = category
-                break
-        return id
+        return self.catalog.make_new_file(img, category)
 
     def classify_category(self, svm_card):
         """
         カード判別器
-       """
-        """
-        カード判別器
-        この場合は画像全域のハッシュをとる
         """
-        # Hog特徴のパラメータ
-        win_size = (120, 60)
-        block_size = (16, 16)
-        block_stride = (4, 4)
-        cell_size = (4, 4)
-        bins = 9
-        test = []
-        carddic = {0: 'Quest Reward', 1: 'Item', 2: 'Point',
-                   3: 'Craft Essence', 4: 'Exp. UP', 99: ""}
-
-        tmpimg = self.img_rgb[int(189/206*self.height):
-                              int(201/206*self.height),
-                              int(78/188*self.width):
-                              int(115/188*self.width)]
-
-        tmpimg = cv2.resize(tmpimg, (win_size))
-        hog = cv2.HOGDescriptor(win_size, block_size, block_stride,
-                                cell_size, bins)
-        test.append(hog.compute(tmpimg))  # 特徴量の格納
-        test = np.array(test)
-        pred = svm_card.predict(test)
-
-        return carddic[pred[1][0][0]]
+        return classify_category(self.img_rgb, svm_card)
 
     def classify_card(self, img, currnet_dropPriority):
         """
         アイテム判別器
         """
         if self.category == "Point":
-            id = self.classify_point(img)
+            id = self.classify_point(img, currnet_dropPriority)
             if id == "":
-                id = self.make_new_file(img, Point_dir, dist_point,
-                                        PRIORITY_POINT, self.category)
+                id = self.make_new_file(img, self.category)
             return id
         elif self.category == "Quest Reward":
             return 5
         elif self.category == "Craft Essence":
             id = self.classify_ce(img)
             if id == "":
-                id = self.make_new_file(img, CE_dir, dist_ce,
-                                        PRIORITY_CE, self.category)
+                id = self.make_new_file(img, self.category)
             return id
         elif self.category == "Exp. UP":
             return self.classify_exp(img)
         elif self.category == "Item":
             id = self.classify_item(img, currnet_dropPriority)
             if id == "":
-                id = self.make_new_file(img, Item_dir, dist_item,
-                                        PRIORITY_ITEM, self.category)
+                id = self.make_new_file(img, self.category)
         else:
             # ここで category が判別できないのは三行目かつ
             # スクロール位置の関係で下部表示が消えている場合
             id = self.classify_item(img, currnet_dropPriority)
             if id != "":
                 return id
-            id = self.classify_point(img)
+            id = self.classify_point(img, currnet_dropPriority)
             if id != "":
                 return id
             id = self.classify_ce(img)
@@ -2229,8 +2960,7 @@ class Item:
             if id != "":
                 return id
         if id == "":
-            id = self.make_new_file(img, Item_dir, dist_item,
-                                    PRIORITY_ITEM, "Item")
+            id = self.make_new_file(img, "Item")
         return id
 
     def compute_exp_rarity_hash(self, img_rgb):
@@ -2241,7 +2971,7 @@ class Item:
         img = img_rgb[int(53/189*self.height):int(136/189*self.height),
                       int(37/206*self.width):int(149/206*self.width)]
 
-        return hasher.compute(img)
+        return get_hasher().compute(img)
 
     def compute_exp_class_hash(self, img_rgb):
         """
@@ -2251,7 +2981,7 @@ class Item:
         """
         img = img_rgb[int(5/135*self.height):int(30/135*self.height),
                       int(5/135*self.width):int(30/135*self.width)]
-        return hasher.compute(img)
+        return get_hasher().compute(img)
 
     def compute_gem_hash(self, img_rgb):
         """
@@ -2266,52 +2996,158 @@ class Item:
                       int((132-52*0.8)/2/132*width):
                       int((132+52*0.8)/2/132*width)]
 
-        return hasher.compute(img)
+        return get_hasher().compute(img)
 
 
-def classify_background(img_rgb):
+def calc_background_hists(imgs):
     """
-    背景判別
+    背景判別に使う領域のヒストグラムをまとめて計算する
+    戻り値は (画像, チャンネル, 256) の配列
     """
-    img = img_rgb[30:119, 7:25]
-    target_hist = img_hist(img)
-    bg_score = []
-    score_z = calc_hist_score(target_hist, hist_zero)
-    bg_score.append({"background": "zero", "dist": score_z})
-    score_g = calc_hist_score(target_hist, hist_gold)
-    bg_score.append({"background": "gold", "dist": score_g})
-    score_s = calc_hist_score(target_hist, hist_silver)
-    bg_score.append({"background": "silver", "dist": score_s})
-    score_b = calc_hist_score(target_hist, hist_bronze)
-    bg_score.append({"background": "bronze", "dist": score_b})
-
-    bg_score = sorted(bg_score, key=lambda x: x['dist'])
-    # logger.debug("background dist: %s", bg_score)
-    return (bg_score[0]["background"])
+    pixels = []
+    for i, img_rgb in enumerate(imgs):
+        img = img_rgb[30:119, 7:25].reshape(-1, 3).astype(np.intp)
+        # 画像・チャンネルごとに別のビンになるようずらす
+        pixels.append((img + (i * 3 + np.arange(3)) * 256).ravel())
+    if len(pixels) == 0:
+        return np.zeros((0, 3, 256))
+    hists = np.bincount(np.concatenate(pixels), minlength=len(imgs) * 3 * 256)
+    return hists.reshape(len(imgs), 3, 256).astype(np.float64)
+
+
+def calc_background_dists(hists):
+    """
+    各ヒストグラムと参照ヒストグラム行列との Bhattacharyya 距離を計算する
+    cv2.compareHist(HISTCMP_BHATTACHARYYA) をチャンネル平均したものと同じ
+    戻り値は (画像, 背景) の配列
+    """
+    num = np.einsum('ncb,kcb->nkc', np.sqrt(hists), np.sqrt(hist_background))
+    denom = np.sqrt(hists.sum(axis=2)[:, None, :]
+                    * hist_background.sum(axis=2)[None, :, :])
+    ratio = np.divide(num, denom, out=num.copy(), where=denom > 0)
+    dists = np.sqrt(np.clip(1 - ratio, 0, None))
+    return dists.mean(axis=2)
 
 
-def compute_hash(img_rgb):
+def classify_backgrounds(imgs):
     """
-    判別器
-    この判別器は下部のドロップ数を除いた部分を比較するもの
-    記述した比率はiPhone6S画像の実測値
+    背景判別 (スクショ一枚分のアイテムをまとめて処理)
+    戻り値は (背景, 確信度マージン, 二番目に近い背景) のリスト
+    確信度マージンは二番目に近い背景との距離の差
     """
-    height, width = img_rgb.shape[:2]
-    img = img_rgb[int(22/135*height):
-                  int(77/135*height),
-                  int(23/135*width):
-                  int(112/135*width)]
-    return hasher.compute(img)
+    dists = calc_background_dists(calc_background_hists(imgs))
+    results = []
+    for dist in dists:
+        order = np.argsort(dist, kind='stable')
+        margin = float(dist[order[1]] - dist[order[0]])
+        results.append((BACKGROUNDS[order[0]], margin,
+                        BACKGROUNDS[order[1]]))
+    return results
 
 
-def compute_hash_ce(img_rgb):
+def classify_background(img_rgb):
+    """
+    背景判別
+    """
+    return classify_backgrounds([img_rgb])[0][0]
+
+
+def get_hasher():
+    """
+    スレッドごとの PHash を返す
+    compute は内部のバッファを使うのでスレッド間で共有しない
+    """
+    h = getattr(hasher_local, "hasher", None)
+    if h is None:
+        h = cv2.img_hash.PHash_create()
+        hasher_local.hasher = h
+    return h
+
+
+def calc_item_th(img_gray):
+    """
+    アイテム画像の文字部分の二値化
+    """
+    _, img_th = cv2.threshold(img_gray, 174, 255, cv2.THRESH_BINARY)
+    return cv2.bitwise_not(img_th)
+
+
+def calc_bonus_mask(img_hsv):
+    """
+    アイテム画像下段の黄文字(ボーナス)のマスク
+    """
+    height, width = img_hsv.shape[:2]
+    margin_top = int(height*0.72)
+    margin_bottom = int(height*0.11)
+    margin_left = 8
+    margin_right = 8
+
+    img_hsv_lower = img_hsv[margin_top: height - margin_bottom,
+                            margin_left: width - margin_right]
+
+    # 手持ちスクショでうまくいっている範囲
+    # 黄文字がこの数値でマスクできるかが肝
+    # 未対応機種が発生したため[25,180,119] →[25,175,119]に変更
+    lower_yellow = np.array([25, 175, 119])
+    upper_yellow = np.array([37, 255, 255])
+
+    return cv2.inRange(img_hsv_lower, lower_yellow, upper_yellow)
+
+
+def classify_category(img_rgb, svm_card):
+    """
+    カード判別器
+    この場合は画像全域のハッシュをとる
+    """
+    carddic = {0: 'Quest Reward', 1: 'Item', 2: 'Point',
+               3: 'Craft Essence', 4: 'Exp. UP', 99: ""}
+
+    height, width = img_rgb.shape[:2]
+    tmpimg = img_rgb[int(189/206*height):
+                     int(201/206*height),
+                     int(78/188*width):
+                     int(115/188*width)]
+
+    return carddic[svm_card.predict(tmpimg)]
+
+
+class CellFeatures:
+    """
+    アイテム枠ごとに独立に計算できる特徴量
+    (HSV画像, 二値化画像, pHash, カード種別, ボーナスのマスク)
+    前のアイテムに依存しないのでスレッドプールでまとめて計算できる
+    """
+
+    def __init__(self, img_rgb, img_gray, svm_card):
+        self.img_hsv = cv2.cvtColor(img_rgb, cv2.COLOR_BGR2HSV)
+        self.img_th = calc_item_th(img_gray)
+        self.hash_item = compute_hash(img_rgb)
+        self.category = classify_category(img_rgb, svm_card)
+        self.bonus_mask = calc_bonus_mask(self.img_hsv)
+
+
+def compute_hash(img_rgb):
+    """
+    判別器
+    この判別器は下部のドロップ数を除いた部分を比較するもの
+    記述した比率はiPhone6S画像の実測値
+    """
+    height, width = img_rgb.shape[:2]
+    img = img_rgb[int(22/135*height):
+                  int(77/135*height),
+                  int(23/135*width):
+                  int(112/135*width)]
+    return get_hasher().compute(img)
+
+
+def compute_hash_ce(img_rgb):
     """
     判別器
     この判別器は下部のドロップ数を除いた部分を比較するもの
     記述した比率はiPpd2018画像の実測値
     """
     img = img_rgb[12:176, 9:182]
-    return hasher.compute(img)
+    return get_hasher().compute(img)
 
 
 def compute_hash_ce_narrow(img_rgb):
@@ -2321,56 +3157,7 @@ def compute_hash_ce_narrow(img_rgb):
     height, width = img_rgb.shape[:2]
     img = img_rgb[int(30/206*height):int(155/206*height),
                   int(5/188*width):int(183/188*width)]
-    return hasher.compute(img)
-
-
-def search_file(search_dir, dist_dic, dropPriority, category):
-    """
-    Item, Craft Essence, Pointの各ファイルを探す
-    """
-    files = search_dir.glob('**/*.png')
-    for fname in files:
-        img = imread(fname)
-        # id 候補を決める
-        # 既存のデータがあったらそれを使用
-        if fname.stem in item_name.values():
-            id = [k for k, v in item_name.items() if v == fname.stem][0]
-        elif fname.stem in item_shortname.values():
-            id = [k for k, v in item_shortname.items() if v == fname.stem][0]
-        else:
-            for j in range(99999):
-                id = j + ID_START
-                if id in item_name.keys():
-                    continue
-                break
-        # priotiry は固定
-            item_name[id] = fname.stem
-            item_dropPriority[id] = dropPriority
-            item_type[id] = category
-        if category == "Craft Essence":
-            hash = compute_hash_ce(img)
-        else:
-            hash = compute_hash(img)
-        hash_hex = ""
-        for h in hash[0]:
-            hash_hex = hash_hex + "{:02x}".format(h)
-        dist_dic[hash_hex] = id
-        if category == "Item" or category == "Point":
-            item_background[id] = classify_background(img)
-        if category == "Craft Essence":
-            hash_narrow = compute_hash_ce_narrow(img)
-            hash_hex_narrow = ""
-            for h in hash_narrow[0]:
-                hash_hex_narrow = hash_hex_narrow + "{:02x}".format(h)
-            dist_ce_narrow[hash_hex_narrow] = id
-
-
-def calc_hist_score(hist1, hist2):
-    scores = []
-    for channel1, channel2 in zip(hist1, hist2):
-        score = cv2.compareHist(channel1, channel2, cv2.HISTCMP_BHATTACHARYYA)
-        scores.append(score)
-    return np.mean(scores)
+    return get_hasher().compute(img)
 
 
 def img_hist(img):
@@ -2381,13 +3168,13 @@ def img_hist(img):
     return hist1, hist2, hist3
 
 
-def calc_dist_local():
+def calc_dist_local(catalog=None):
     """
     既所持のアイテム画像の距離(一次元配列)の辞書を作成して保持
     """
-    search_file(Item_dir, dist_item, PRIORITY_ITEM, "Item")
-    search_file(CE_dir, dist_ce, PRIORITY_CE, "Craft Essence")
-    search_file(Point_dir, dist_point, PRIORITY_POINT, "Point")
+    if catalog is None:
+        catalog = default_catalog
+    catalog.calc_dist_local()
 
 
 def hex2hash(hexstr):
@@ -2397,47 +3184,216 @@ def hex2hash(hexstr):
     return np.array([hashlist], dtype='uint8')
 
 
+def hash2hex(hash):
+    hash_hex = ""
+    for h in hash[0]:
+        hash_hex = hash_hex + "{:02x}".format(h)
+    return hash_hex
+
+
 def out_name(args, id):
-    if args.lang == "eng":
-        if id in item_name_eng.keys():
-            return item_name_eng[id]
-    if id in item_shortname.keys():
-        name = item_shortname[id]
-    else:
-        name = item_name[id]
-    return name
+    return default_catalog.out_name(args.lang, id)
 
 
-def imread(filename, flags=cv2.IMREAD_COLOR, dtype=np.uint8):
+def imread(filename, flags=cv2.IMREAD_COLOR, dtype=np.uint8, reduce=1):
     """
     OpenCVのimreadが日本語ファイル名が読めない対策
+    読み込みは pageinfo.imread と共通 (reduce で縮小して読める)
     """
     try:
-        n = np.fromfile(filename, dtype)
-        img = cv2.imdecode(n, flags)
-        return img
+        return pageinfo.imread(filename, flags, reduce, dtype)
     except Exception as e:
         logger.exception(e)
         return None
 
 
-def get_exif(img):
-    exif = img._getexif()
+def parse_exif_datetime(exif):
+    """
+    PIL の Exif から DateTimeOriginal を datetime で返す
+    """
+    val = exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL)
+    if val is None:
+        val = exif.get(EXIF_DATETIME_ORIGINAL)
+    if val is None:
+        return "NON"
     try:
-        for id, val in exif.items():
-            tg = TAGS.get(id, id)
-            if tg == "DateTimeOriginal":
-                return datetime.datetime.strptime(val, '%Y:%m:%d %H:%M:%S')
-    except AttributeError:
+        return datetime.datetime.strptime(val.strip("\x00 "),
+                                          '%Y:%m:%d %H:%M:%S')
+    except ValueError:
         return "NON"
-    return "NON"
 
 
-def get_output(filenames, args):
+def read_png_capture_time(f):
     """
-    出力内容を作成
+    PNG のチャンクを IDAT の手前まで読み、eXIf の DateTimeOriginal か
+    tIME (UTC) を返す
+    """
+    dt = "NON"
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            break
+        length, ctype = struct.unpack(">I4s", head)
+        if ctype in (b"IDAT", b"IEND"):
+            break
+        if ctype == b"eXIf":
+            exif = Image.Exif()
+            exif.load(f.read(length))
+            exif_dt = parse_exif_datetime(exif)
+            if exif_dt != "NON":
+                return exif_dt
+        elif ctype == b"tIME" and length == 7:
+            year, month, day, hour, minute, second = \
+                struct.unpack(">HBBBBB", f.read(length))
+            try:
+                dt = datetime.datetime(year, month, day, hour, minute,
+                                       second,
+                                       tzinfo=datetime.timezone.utc)
+                dt = dt.astimezone().replace(tzinfo=None)
+            except ValueError:
+                dt = "NON"
+        else:
+            f.seek(length, os.SEEK_CUR)
+            f.seek(4, os.SEEK_CUR)
+            continue
+        f.seek(4, os.SEEK_CUR)  # CRC
+    return dt
+
+
+def read_capture_time(fp):
+    """
+    スクショの撮影日時 (Exif DateTimeOriginal または PNG tIME) を返す
+    ヘッダ部分だけを読み、画素はデコードしない
+    fp はファイル名またはバイナリのファイルオブジェクト
+    取得できないときは "NON"
+    """
+    try:
+        if isinstance(fp, (str, os.PathLike)):
+            with open(fp, "rb") as f:
+                return read_capture_time(f)
+        if fp.read(8) == PNG_SIGNATURE:
+            return read_png_capture_time(fp)
+        fp.seek(0)
+        # Image.open はヘッダしか読まない
+        with Image.open(fp) as img:
+            return parse_exif_datetime(img.getexif())
+    except Exception as e:
+        logger.debug("cannot read capture time: %s", e)
+        return "NON"
+
+
+class CaptureTimes:
+    """
+    ファイルごとの撮影日時のキャッシュ
+    並べ替えのときに読んだ値を認識のときに使い回す
+    (認識に渡したものは pop して、処理中のファイル分だけを持つ)
+    """
+
+    def __init__(self, threads=None):
+        if threads is None:
+            threads = min(32, (os.cpu_count() or 1) * 4)
+        self.threads = threads
+        self.times = {}
+        self.lock = threading.Lock()
+
+    def put(self, filename, dt):
+        with self.lock:
+            self.times[os.fspath(filename)] = dt
+
+    def pop(self, filename):
+        """
+        キャッシュにあればその撮影日時を返して取り除く、なければ None
+        """
+        with self.lock:
+            return self.times.pop(os.fspath(filename), None)
+
+    def scan(self, filenames):
+        """
+        撮影日時をスレッドで並列に読み (ファイル名, 撮影日時) を返す
+        """
+        with ThreadPoolExecutor(self.threads) as executor:
+            yield from zip(filenames,
+                           executor.map(read_capture_time, filenames))
+
+    def prescan(self, filenames):
+        """
+        撮影日時を並列に読んでキャッシュに入れる
+        """
+        for filename, dt in self.scan(filenames):
+            self.put(filename, dt)
+
+
+capture_times = CaptureTimes()
+
+
+def capture_key(filename, dt):
+    """
+    撮影日時順の並べ替えキー
+    撮影日時が取れないファイルは作成日時を使う
+    """
+    if dt == "NON":
+        return Path(filename).stat().st_ctime
+    return dt.timestamp()
+
+
+class HogSvm:
+    """
+    学習済みSVMと、それに入力する HOG 特徴量の形状
+    HOGDescriptor は読み込み時に一度だけ作る
+    """
+
+    def __init__(self, svm, win_size, block_size, block_stride, cell_size,
+                 bins):
+        self.svm = svm
+        self.win_size = tuple(win_size)
+        self.hog = cv2.HOGDescriptor(self.win_size, tuple(block_size),
+                                     tuple(block_stride), tuple(cell_size),
+                                     bins)
+
+    @classmethod
+    def load(cls, path):
+        """
+        path のSVMと、同じ名前の .json に書かれた HOG の形状を読み込む
+        """
+        path = Path(path)
+        config = {}
+        config_path = path.with_suffix(".json")
+        if config_path.exists():
+            with open(config_path, encoding="UTF-8") as f:
+                config = json.load(f)
+        kwargs = {key: config.get(key, value)
+                  for key, value in DEFAULT_HOG.items()}
+        return cls(cv2.ml.SVM_load(str(path)), **kwargs)
+
+    def compute(self, img):
+        """
+        画像1枚の特徴量 (1行の配列)
+        """
+        tmpimg = cv2.resize(img, self.win_size)
+        return self.hog.compute(tmpimg).reshape(1, -1)
+
+    def predict(self, img):
+        """
+        画像1枚のラベルを返す
+        """
+        pred = self.svm.predict(self.compute(img))
+        return int(pred[1][0][0])
+
+
+def compact_model(path):
+    """
+    makemodels.py --compact で作る小さい特徴量のモデル (例: item_compact.xml)
+    """
+    return path.with_name(path.stem + "_compact" + path.suffix)
+
+
+def load_svms(compact=False):
+    """
+    学習済みSVMを読み込む
+    戻り値は (svm, svm_chest, svm_dcnt, svm_card) で、それぞれ HogSvm
+    compact=True なら数字を読むモデル (item, chest, dcnt) に小さい特徴量の
+    モデルがあればそれを使う
     """
-    calc_dist_local()
     if train_item.exists() is False:
         logger.critical("item.xml is not found")
         logger.critical("Try to run 'python makeitem.py'")
@@ -2454,41 +3410,529 @@ def get_output(filenames, args):
         logger.critical("card.xml is not found")
         logger.critical("Try to run 'python makecard.py'")
         sys.exit(1)
-    svm = cv2.ml.SVM_load(str(train_item))
-    svm_chest = cv2.ml.SVM_load(str(train_chest))
-    svm_dcnt = cv2.ml.SVM_load(str(train_dcnt))
-    svm_card = cv2.ml.SVM_load(str(train_card))
+    paths = [train_item, train_chest, train_dcnt]
+    if compact:
+        for i, path in enumerate(paths):
+            if compact_model(path).exists():
+                paths[i] = compact_model(path)
+            else:
+                logger.warning("%s is not found, use %s",
+                               compact_model(path).name, path.name)
+    svm, svm_chest, svm_dcnt = [HogSvm.load(path) for path in paths]
+    svm_card = HogSvm.load(train_card)
+    return svm, svm_chest, svm_dcnt, svm_card
 
-    fileoutput = []  # 出力
-    prev_pages = 0
-    prev_pagenum = 0
-    prev_total_qp = QP_UNKNOWN
-    prev_itemlist = []
-    prev_datetime = datetime.datetime(year=2015, month=7, day=30, hour=0)
-    prev_qp_gained = 0
-    prev_chestnum = 0
-    all_list = []
 
-    for filename in filenames:
+class ScreenShotResult:
+    """
+    スクショ一枚の認識結果のうち、ファイル間の照合に使うもの
+    並列処理ではワーカーからこの形で受け取る
+    """
+
+    def __init__(self, filename, status, sc=None, dt="NON"):
+        self.filename = filename
+        self.status = status
+        self.datetime = dt
+        self.token = None
+        self.pending = []
+        self.narrowing_stats = None
+        self.worker = None
+        self.pageinfo_diag = None
+        if sc is not None:
+            self.pageinfo_diag = sc.pageinfo_diag
+            self.itemlist = sc.itemlist
+            self.pagenum = sc.pagenum
+            self.pages = sc.pages
+            self.lines = sc.lines
+            self.total_qp = sc.total_qp
+            self.qp_gained = sc.qp_gained
+            self.chestnum = sc.chestnum
+
+
+class Recognizer:
+    """
+    スクショを一枚ずつ認識する
+    領域の位置やクエストの推定など、続けて処理するファイル間で
+    引き継ぐ状態を持つ (並列処理ではワーカーごとに作成する)
+    """
+
+    def __init__(self, args, svms, catalog, policy=None):
+        self.args = args
+        self.svm, self.svm_chest, self.svm_dcnt, self.svm_card = svms
+        self.catalog = catalog
+        # reward_only で使う catalog の複製 (RewardQPScreenShot 用)
+        self.reward_catalog = None
+        self.area_hint = None
+        self.tracker = QuestTracker(catalog) \
+            if getattr(args, "adaptive", False) else None
+        self.executor = None
+        if policy is not None and policy.cell_threads > 1:
+            self.executor = ThreadPoolExecutor(policy.cell_threads)
+
+    def recognize(self, filename, dt=None):
+        """
+        dt は並べ替えのときに読んだ撮影日時 (None なら読み直す)
+        """
         logger.debug("filename: %s", filename)
         f = Path(filename)
 
         if f.exists() is False:
-            output = {'filename': str(filename) + ': not found'}
-            all_list.append([])
+            result = ScreenShotResult(filename, "not found")
         elif f.is_dir():  # for ZIP file from MacOS
-            pass
+            result = ScreenShotResult(filename, "dir")
         elif f.suffix.upper() not in ['.PNG', '.JPG', '.JPEG']:
-            output = {'filename': str(filename) + ': Not Supported'}
-            all_list.append([])
+            result = ScreenShotResult(filename, "not supported")
         else:
             img_rgb = imread(filename)
             fileextention = Path(filename).suffix
 
             try:
-                sc = ScreenShot(args, img_rgb,
-                                svm, svm_chest, svm_dcnt, svm_card,
-                                fileextention)
+                sc = self.recognize_image(img_rgb, fileextention)
+                if dt is None:
+                    dt = read_capture_time(filename)
+                result = ScreenShotResult(filename, "ok", sc, dt)
+            except Exception as e:
+                logger.error(filename)
+                logger.error(e, exc_info=True)
+                result = ScreenShotResult(filename, "not valid")
+        if self.catalog.pending is not None:
+            # 新しいアイテムは NewItemRegistry で確定させる
+            result.token = self.catalog.token
+            result.pending = self.catalog.take_pending()
+        if self.tracker is not None:
+            result.narrowing_stats = self.tracker.stats()
+        return result
+
+    def recognize_image(self, img_rgb, fileextention):
+        """
+        読み込み済みの画像を認識して ScreenShot を返す
+        """
+        if getattr(self.args, "reward_only", False):
+            if self.reward_catalog is None:
+                # 知らないアイテムはファイルを作らずに仮の id で登録して捨てる
+                # (qpsplit.py は最初のアイテムが報酬QPかどうかだけを使うので、
+                # 並列に動くワーカーが item フォルダに書き込まないようにする)
+                self.reward_catalog = self.catalog.fork()
+            sc = RewardQPScreenShot(self.args, img_rgb,
+                                    self.svm, self.svm_chest, self.svm_dcnt,
+                                    self.svm_card, fileextention,
+                                    area_hint=self.area_hint,
+                                    catalog=self.reward_catalog)
+            self.reward_catalog.take_pending()
+            self.area_hint = sc.area_hint
+            return sc
+        sc = ScreenShot(self.args, img_rgb,
+                        self.svm, self.svm_chest, self.svm_dcnt,
+                        self.svm_card,
+                        fileextention,
+                        area_hint=self.area_hint,
+                        narrowing=None if self.tracker is None
+                        else self.tracker.narrowing,
+                        catalog=self.catalog,
+                        executor=self.executor)
+        self.area_hint = sc.area_hint
+        if self.tracker is not None:
+            self.tracker.update(sc.itemlist)
+        return sc
+
+    def close(self):
+        """
+        アイテム枠を処理するスレッドプールを終了する
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Options:
+    """
+    認識処理の設定
+    argparse の args と同じ属性を持つので、args の代わりに
+    ScreenShot, get_output, make_csv_header などにも渡せる
+    """
+
+    def __init__(self, lang=DEFAULT_ITEM_LANG, timeout=TIMEOUT,
+                 adaptive=False, policy="auto", jobs=None, cell_threads=None,
+                 reward_only=False, compact_models=False):
+        self.lang = lang
+        self.timeout = timeout
+        self.adaptive = adaptive
+        self.policy = policy
+        self.jobs = jobs
+        self.cell_threads = cell_threads
+        # qpsplit.py 用: RewardQPScreenShot で最初のアイテム(報酬QP)・ドロップ数・
+        # ページ番号だけを認識する
+        self.reward_only = reward_only
+        # 数字を読むSVMに小さい特徴量のモデル (*_compact.xml) を使う
+        self.compact_models = compact_models
+
+
+class Result:
+    """
+    スクショ一枚の認識結果
+    CSV 用の文字列ではなく数値のまま保持する
+    """
+
+    def __init__(self, sc, dt="NON", filename=None):
+        self.filename = filename
+        self.pagenum = sc.pagenum
+        self.pages = sc.pages
+        self.lines = sc.lines
+        self.chestnum = sc.chestnum
+        self.total_qp = sc.total_qp
+        self.qp_gained = sc.qp_gained
+        self.datetime = None if dt == "NON" else dt
+        self.drops = list(sc.items)
+
+    def __repr__(self):
+        return "Result(filename={!r}, pagenum={}, drops={})".format(
+            self.filename, self.pagenum, len(self.drops))
+
+
+class Engine:
+    """
+    ライブラリとして使うための認識処理
+    カタログと学習済みモデルは作成時に一度だけ読み込む
+    """
+
+    def __init__(self, options=None, catalog=None):
+        self.options = Options() if options is None else options
+        self.catalog = default_catalog if catalog is None else catalog
+        calc_dist_local(self.catalog)
+        policy = make_policy(self.options.policy, self.options.jobs,
+                             self.options.cell_threads)
+        policy.apply()
+        self.recognizer = Recognizer(
+            self.options, load_svms(self.options.compact_models),
+            self.catalog, policy)
+
+    def recognize(self, image, filename=None):
+        """
+        画像ファイルの中身 (bytes) を認識して Result を返す
+        認識できなければ例外を送出する
+        """
+        img_rgb = cv2.imdecode(np.frombuffer(image, np.uint8),
+                               cv2.IMREAD_COLOR)
+        if img_rgb is None:
+            raise CannotReadImageError("cannot decode image: {}"
+                                       .format(filename))
+        if image[:8] == PNG_SIGNATURE:
+            fileextention = ".png"
+        else:
+            fileextention = ".jpg"
+        sc = self.recognizer.recognize_image(img_rgb, fileextention)
+        dt = read_capture_time(io.BytesIO(image))
+        return Result(sc, dt, filename)
+
+    def recognize_file(self, filename):
+        with open(filename, "rb") as f:
+            return self.recognize(f.read(), str(filename))
+
+    def recognize_many(self, images):
+        """
+        bytes またはファイル名を順に認識して Result を返すイテレータ
+        """
+        for image in images:
+            if isinstance(image, (bytes, bytearray, memoryview)):
+                yield self.recognize(bytes(image))
+            else:
+                yield self.recognize_file(image)
+
+    def close(self):
+        self.recognizer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+default_engine = None
+
+
+def get_engine(options=None):
+    """
+    options が同じ間は作成済みの Engine を使い回す
+    """
+    global default_engine
+    if default_engine is None or (options is not None
+                                  and options is not default_engine.options):
+        if default_engine is not None:
+            default_engine.close()
+        default_engine = Engine(options)
+    return default_engine
+
+
+def recognize(image, options=None):
+    """
+    画像ファイルの中身 (bytes) を認識して Result を返す
+    """
+    return get_engine(options).recognize(image)
+
+
+def recognize_many(images, options=None):
+    """
+    bytes またはファイル名を順に認識して Result を返すイテレータ
+    """
+    return get_engine(options).recognize_many(images)
+
+
+def get_rss():
+    """
+    現在のプロセスの常駐メモリ量(バイト)を返す 取得できなければ -1
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return -1
+
+
+class ExecutionPolicy:
+    """
+    並列処理の方針
+    "threads": 1プロセスで順に処理し、OpenCV の内部スレッドを使う
+    "processes": jobs 個のプロセスで並列に処理し、OpenCV の内部スレッドは
+                 各プロセス cv_threads 本に抑える
+    """
+    MODES = ("threads", "processes")
+
+    def __init__(self, mode="threads", jobs=1, cv_threads=None,
+                 cell_threads=1):
+        if mode not in self.MODES:
+            raise ValueError("unknown policy: {}".format(mode))
+        cpus = os.cpu_count() or 1
+        if mode == "threads":
+            jobs = 1
+        elif jobs is None or jobs < 1:
+            jobs = cpus
+        if cv_threads is None:
+            cv_threads = cpus if mode == "threads" else max(1, cpus // jobs)
+        self.mode = mode
+        self.jobs = jobs
+        self.cv_threads = cv_threads
+        # 1より大きいとスクショ内のアイテム枠をスレッドプールで処理する
+        self.cell_threads = cell_threads
+
+    def __str__(self):
+        return "{} (jobs {}, OpenCV threads {}, cell threads {})".format(
+            self.mode, self.jobs, self.cv_threads, self.cell_threads)
+
+    def apply(self):
+        """
+        このプロセスの OpenCV のスレッド数を設定する
+        """
+        cv2.setNumThreads(self.cv_threads)
+
+    def to_dict(self):
+        return {"mode": self.mode, "jobs": self.jobs,
+                "cv_threads": self.cv_threads,
+                "cell_threads": self.cell_threads}
+
+    @classmethod
+    def load(cls, path=policy_file):
+        """
+        benchmark.py policy が保存した方針を読み込む 無ければ None
+        """
+        try:
+            with open(path, encoding='UTF-8') as f:
+                d = json.load(f)
+            return cls(d["mode"], d.get("jobs"), d.get("cv_threads"),
+                       d.get("cell_threads", 1))
+        except (OSError, ValueError, KeyError) as e:
+            if Path(path).exists():
+                logger.warning("Cannot read %s: %s", path, e)
+            return None
+
+    def save(self, path=policy_file):
+        with open(path, "w", encoding='UTF-8') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def make_policy(policy="auto", jobs=None, cell_threads=None):
+    """
+    CLI の --policy, --jobs, --cell-threads から ExecutionPolicy を決める
+    auto では jobs の指定があればそれに従い、無ければ benchmark.py policy
+    の結果 (policy.json) を使う
+    """
+    if isinstance(policy, ExecutionPolicy):
+        return policy
+    if policy == "auto":
+        if jobs is not None:
+            policy = "processes" if jobs != 1 else "threads"
+        else:
+            loaded = ExecutionPolicy.load()
+            if loaded is not None:
+                if cell_threads is not None:
+                    loaded.cell_threads = cell_threads
+                return loaded
+            policy = "threads"
+    elif policy == "threads" and jobs is not None and jobs != 1:
+        logger.warning("--jobs %d is ignored with --policy threads", jobs)
+    return ExecutionPolicy(policy, jobs,
+                           cell_threads=1 if cell_threads is None
+                           else cell_threads)
+
+
+# ワーカープロセスに fork で引き継ぐ学習済みモデル
+worker_svms = None
+# ワーカープロセス内の Recognizer と起動情報
+worker_recognizer = None
+worker_info = None
+# ワーカーが登録済みの NewItemRegistry.additions の件数
+worker_applied = 0
+
+
+def init_worker(args, created, policy):
+    """
+    ワーカープロセスの初期化
+    fork で起動した場合は親プロセスで読み込んだカタログとモデルを
+    そのまま使い、それ以外では読み込み直す
+    """
+    global worker_svms, worker_recognizer, worker_info, worker_applied
+    policy.apply()
+    if worker_recognizer is not None:
+        worker_recognizer.close()
+    if worker_svms is None:
+        calc_dist_local(default_catalog)
+        default_catalog.build_indexes()
+        worker_svms = load_svms(getattr(args, "compact_models", False))
+    worker_recognizer = Recognizer(args, worker_svms, default_catalog.fork(),
+                                   policy)
+    worker_info = {"pid": os.getpid(), "startup": time.time() - created}
+    worker_applied = 0
+
+
+def recognize_in_worker(task):
+    """
+    additions は NewItemRegistry.additions の start 件目以降
+    """
+    global worker_applied
+    filename, start, additions, dt = task
+    if start + len(additions) > worker_applied:
+        worker_recognizer.catalog.apply_additions(
+            additions[max(worker_applied - start, 0):])
+        worker_applied = start + len(additions)
+    result = worker_recognizer.recognize(filename, dt)
+    result.worker = dict(worker_info, rss=get_rss(), applied=worker_applied)
+    return result
+
+
+def recognize_parallel(filenames, args, svms, registry, policy):
+    """
+    ワーカープロセスで並列に認識し、結果を入力順に返す
+    """
+    global worker_svms
+    try:
+        context = multiprocessing.get_context("fork")
+    except ValueError:
+        context = multiprocessing.get_context()
+    if context.get_start_method() == "fork":
+        default_catalog.build_indexes()
+        worker_svms = svms
+    workers = {}
+
+    def collect(async_result):
+        result = async_result.get()
+        info = workers.setdefault(result.worker["pid"],
+                                  dict(result.worker, files=0))
+        info["files"] += 1
+        info["rss"] = max(info["rss"], result.worker["rss"])
+        info["applied"] = result.worker["applied"]
+        return result
+
+    def applied():
+        """
+        全てのワーカーが登録済みのアイテムの件数
+        """
+        if len(workers) < policy.jobs:
+            return 0
+        return min(info["applied"] for info in workers.values())
+
+    # 処理中のタスク数を抑えて、結果がメモリに溜まらないようにする
+    window = policy.jobs * 2
+    running = deque()
+    with context.Pool(policy.jobs, initializer=init_worker,
+                      initargs=(args, time.time(), policy)) as pool:
+        for filename in filenames:
+            # 確定済みの新しいアイテムのうち、まだ登録していない
+            # ワーカーがあるものをタスクと一緒に渡す
+            start = applied()
+            task = (filename, start, registry.additions_since(start),
+                    capture_times.pop(filename))
+            running.append(pool.apply_async(recognize_in_worker, (task,)))
+            if len(running) >= window:
+                yield collect(running.popleft())
+        while running:
+            yield collect(running.popleft())
+    for pid, info in sorted(workers.items()):
+        logger.info("worker %d: start-up %.3f s, RSS %.1f MiB, files %d",
+                    pid, info["startup"], info["rss"] / 2**20, info["files"])
+
+
+class Reconciler:
+    """
+    認識結果を入力順に受け取り、重複や抜けているページを判定して
+    出力する行を作る
+    前のスクショの情報を状態として持つ
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.prev_pages = 0
+        self.prev_pagenum = 0
+        self.prev_total_qp = QP_UNKNOWN
+        self.prev_itemlist = []
+        self.prev_datetime = datetime.datetime(year=2015, month=7, day=30,
+                                               hour=0)
+        self.prev_qp_gained = 0
+        self.prev_chestnum = 0
+
+    def get_state(self):
+        state = {k: v for k, v in self.__dict__.items()
+                 if k.startswith("prev_")}
+        if state["prev_datetime"] != "NON":
+            state["prev_datetime"] = state["prev_datetime"].isoformat()
+        return state
+
+    def set_state(self, state):
+        self.__dict__.update(state)
+        if self.prev_datetime != "NON":
+            self.prev_datetime = \
+                datetime.datetime.fromisoformat(self.prev_datetime)
+
+    def feed(self, sc):
+        """
+        ScreenShotResult を一つ受け取り、[(出力内容, アイテムリスト), ...]
+        を返す
+        """
+        filename = sc.filename
+        rows = []
+        if sc.status == "not found":
+            output = {'filename': str(filename) + ': not found'}
+            rows.append((output, []))
+        elif sc.status == "dir":  # for ZIP file from MacOS
+            pass
+        elif sc.status == "not supported":
+            output = {'filename': str(filename) + ': Not Supported'}
+            rows.append((output, []))
+        elif sc.status == "not valid":
+            output = ({'filename': str(filename) + ': not valid'})
+            rows.append((output, []))
+        else:
+            try:
                 if sc.itemlist[0]["id"] != ID_REWARD_QP and sc.pagenum == 1:
                     logger.warning(
                                    "Page count recognition is failing: %s",
@@ -2497,70 +3941,66 @@ def get_output(filenames, args):
                 # ドロップ内容が同じで下記のとき、重複除外
                 # QPカンストじゃない時、QPが前と一緒
                 # QPカンストの時、Exif内のファイル作成時間が15秒未満
-                pilimg = Image.open(filename)
-                dt = get_exif(pilimg)
-                if dt == "NON" or prev_datetime == "NON":
+                dt = sc.datetime
+                if dt == "NON" or self.prev_datetime == "NON":
                     td = datetime.timedelta(days=1)
                 else:
-                    td = dt - prev_datetime
+                    td = dt - self.prev_datetime
                 if sc.pages - sc.pagenum == 0:
                     sc.itemlist = sc.itemlist[14-(sc.lines+2) % 3*7:]
-                if prev_itemlist == sc.itemlist:
+                if self.prev_itemlist == sc.itemlist:
                     if (sc.total_qp != -1 and sc.total_qp != 999999999
-                        and sc.total_qp == prev_total_qp) \
+                        and sc.total_qp == self.prev_total_qp) \
                         or ((sc.total_qp == -1 or sc.total_qp == 999999999)
-                            and td.total_seconds() < args.timeout):
-                        logger.debug("args.timeout: %s", args.timeout)
+                            and td.total_seconds() < self.args.timeout):
+                        logger.debug("args.timeout: %s", self.args.timeout)
                         logger.debug("filename: %s", filename)
-                        logger.debug("prev_itemlist: %s", prev_itemlist)
+                        logger.debug("prev_itemlist: %s", self.prev_itemlist)
                         logger.debug("sc.itemlist: %s", sc.itemlist)
                         logger.debug("sc.total_qp: %s", sc.total_qp)
-                        logger.debug("prev_total_qp: %s", prev_total_qp)
+                        logger.debug("prev_total_qp: %s", self.prev_total_qp)
                         logger.debug("datetime: %s", dt)
-                        logger.debug("prev_datetime: %s", prev_datetime)
+                        logger.debug("prev_datetime: %s", self.prev_datetime)
                         logger.debug("td.total_second: %s", td.total_seconds())
-                        fileoutput.append(
-                            {'filename': str(filename) + ': duplicate'})
-                        all_list.append([])
-                        continue
+                        rows.append(
+                            ({'filename': str(filename) + ': duplicate'},
+                             []))
+                        return rows
 
                 # 2頁目以前のスクショが無い場合に migging と出力
                 # 1. 前頁が最終頁じゃない&前頁の続き頁数じゃない
                 # または前頁が最終頁なのに1頁じゃない
                 # 2. 前頁の続き頁なのに獲得QPが違う
                 if (
-                    prev_pages - prev_pagenum > 0
-                    and sc.pagenum - prev_pagenum != 1) \
-                    or (prev_pages - prev_pagenum == 0
+                    self.prev_pages - self.prev_pagenum > 0
+                    and sc.pagenum - self.prev_pagenum != 1) \
+                    or (self.prev_pages - self.prev_pagenum == 0
                         and sc.pagenum != 1) \
                     or sc.pagenum != 1 \
-                        and sc.pagenum - prev_pagenum == 1 \
+                        and sc.pagenum - self.prev_pagenum == 1 \
                         and (
-                                prev_qp_gained != sc.qp_gained
+                                self.prev_qp_gained != sc.qp_gained
                             ):
-                    logger.debug("prev_pages: %s", prev_pages)
-                    logger.debug("prev_pagenum: %s", prev_pagenum)
+                    logger.debug("prev_pages: %s", self.prev_pages)
+                    logger.debug("prev_pagenum: %s", self.prev_pagenum)
                     logger.debug("sc.pagenum: %s", sc.pagenum)
-                    logger.debug("prev_qp_gained: %s", prev_qp_gained)
+                    logger.debug("prev_qp_gained: %s", self.prev_qp_gained)
                     logger.debug("sc.qp_gained: %s", sc.qp_gained)
-                    logger.debug("prev_chestnum: %s", prev_chestnum)
+                    logger.debug("prev_chestnum: %s", self.prev_chestnum)
                     logger.debug("sc.chestnum: %s", sc.chestnum)
-                    fileoutput.append({'filename': 'missing'})
-                    all_list.append([])
+                    rows.append(({'filename': 'missing'}, []))
 
-                all_list.append(sc.itemlist)
-
-                prev_pages = sc.pages
-                prev_pagenum = sc.pagenum
-                prev_total_qp = sc.total_qp
-                prev_itemlist = sc.itemlist
-                prev_datetime = dt
-                prev_qp_gained = sc.qp_gained
-                prev_chestnum = sc.chestnum
+                self.prev_pages = sc.pages
+                self.prev_pagenum = sc.pagenum
+                self.prev_total_qp = sc.total_qp
+                self.prev_itemlist = sc.itemlist
+                self.prev_datetime = dt
+                self.prev_qp_gained = sc.qp_gained
+                self.prev_chestnum = sc.chestnum
 
                 sumdrop = len([d for d in sc.itemlist
                                if d["id"] != ID_REWARD_QP])
-                if args.lang == "jpn":
+                if self.args.lang == "jpn":
                     drop_count = "ドロ数"
                 else:
                     drop_count = "drop_count"
@@ -2572,16 +4012,235 @@ def get_output(filenames, args):
                         output[drop_count] = str(output[drop_count]) + "+"
                 elif sc.pagenum == 2 and sc.lines >= 7:
                     output[drop_count] = str(output[drop_count]) + "+"
+                rows.append((output, sc.itemlist))
 
             except Exception as e:
                 logger.error(filename)
                 logger.error(e, exc_info=True)
                 output = ({'filename': str(filename) + ': not valid'})
-                all_list.append([])
+                rows.append((output, []))
+        return rows
+
+
+def iter_output(filenames, args, policy=None, checkpoint=None):
+    """
+    出力内容を (出力内容, アイテムリスト) の組で入力順に返すイテレータ
+    policy (ExecutionPolicy) を省略すると args.policy と args.jobs から決める
+    checkpoint (Checkpoint) を渡すと、1ファイル分の出力内容が
+    使われるたびに処理済みとして記録し、再開時は処理済みのファイルを飛ばす
+    """
+    start = time.perf_counter()
+    if policy is None:
+        policy = make_policy(getattr(args, "policy", "auto"),
+                             getattr(args, "jobs", None),
+                             getattr(args, "cell_threads", None))
+    policy.apply()
+    catalog = default_catalog
+    registry = NewItemRegistry(catalog)
+    reconciler = Reconciler(args)
+    if checkpoint is not None:
+        checkpoint.attach("catalog", catalog)
+        checkpoint.attach("registry", registry)
+        checkpoint.attach("reconciler", reconciler)
+        filenames = checkpoint.skip(filenames)
+    calc_dist_local(catalog)
+    svms = load_svms(getattr(args, "compact_models", False))
+    recognizer = None
+    if policy.mode == "processes":
+        if checkpoint is not None and getattr(args, "adaptive", False):
+            # クエストの推定はワーカーごとに持つので記録できない
+            logger.warning("--adaptive with worker processes: "
+                           "quest narrowing restarts on --resume")
+        results = recognize_parallel(filenames, args, svms, registry, policy)
+    else:
+        recognizer = Recognizer(args, svms, catalog, policy)
+        if checkpoint is not None and recognizer.tracker is not None:
+            checkpoint.attach("tracker", recognizer.tracker)
+        results = (recognizer.recognize(filename, capture_times.pop(filename))
+                   for filename in filenames)
+
+    narrowing_stats = {}
+    pageinfo_corrections = Counter()
+    nfiles = 0
+
+    try:
+        for sc in results:
+            nfiles += 1
+            if sc.status == "ok":
+                registry.resolve(sc.token, sc.pending, sc.itemlist)
+            else:
+                registry.resolve(sc.token, sc.pending, [])
+            if sc.narrowing_stats is not None:
+                narrowing_stats[sc.token] = sc.narrowing_stats
+            if sc.pageinfo_diag is not None:
+                # guess_pageinfo の推定と補正後の値が食い違ったファイル
+                pageinfo_corrections[sc.pageinfo_diag["source"]] += 1
+                logger.info("%s: pageinfo %s -> %s (%s)", sc.filename,
+                            sc.pageinfo_diag["guess"],
+                            sc.pageinfo_diag["corrected"],
+                            sc.pageinfo_diag["source"])
+            for row in reconciler.feed(sc):
+                yield row
+            if checkpoint is not None:
+                checkpoint.done(sc.filename)
+    finally:
+        if recognizer is not None:
+            recognizer.close()
+    if getattr(args, "adaptive", False):
+        hits = sum(h for h, _ in narrowing_stats.values())
+        total = sum(t for _, t in narrowing_stats.values())
+        logger.info("quest narrowing: fast path %d / %d", hits, total)
+    elapsed = time.perf_counter() - start
+    logger.info("policy: %s, files: %d, elapsed: %.3f s", policy,
+                nfiles, elapsed)
+    logger.info("pageinfo corrected: %d / %d %s",
+                sum(pageinfo_corrections.values()), nfiles,
+                dict(pageinfo_corrections))
+
+
+def get_output(filenames, args, policy=None):
+    """
+    出力内容を作成
+    """
+    fileoutput = []  # 出力
+    all_list = []
+    for output, itemlist in iter_output(filenames, args, policy):
         fileoutput.append(output)
+        all_list.append(itemlist)
     return fileoutput, all_list
 
 
+class Checkpoint:
+    """
+    長時間の処理を中断したところから再開するためのチェックポイント
+    interval ファイルごとに、処理済みのファイル数と attach() したものの
+    状態 (照合・集計の状態や新しく登録したアイテム) を path に書き出す
+    出力済みの行は path に .rows を付けたファイルに追記しておく
+    """
+    VERSION = 2
+
+    def __init__(self, args, path, interval=CHECKPOINT_INTERVAL):
+        self.args = args
+        self.path = Path(path)
+        self.rows_path = Path(str(self.path) + ".rows")
+        self.interval = interval
+        self.state = None
+        self.components = {}
+        self.rows = None
+        self.nfiles = 0
+        self.last = None
+
+    def options(self):
+        """
+        再開前後で一致していないと結果が変わるオプション
+        """
+        return {"lang": self.args.lang, "timeout": self.args.timeout,
+                "ordering": str(getattr(self.args, "ordering",
+                                        Ordering.NOTSPECIFIED)),
+                "compact_models": getattr(self.args, "compact_models",
+                                          False),
+                "adaptive": getattr(self.args, "adaptive", False)}
+
+    def load(self):
+        """
+        書き出したチェックポイントを読み込む (--resume)
+        """
+        if not self.path.is_file() or not self.rows_path.is_file():
+            raise CheckpointError("checkpoint is not found: {}"
+                                  .format(self.path))
+        with open(self.path, encoding='UTF-8') as f:
+            state = json.load(f)
+        if state.get("version") != self.VERSION:
+            raise CheckpointError("unsupported checkpoint: {}"
+                                  .format(self.path))
+        if state["options"] != self.options():
+            raise CheckpointError("options differ from the checkpoint: {}"
+                                  .format(state["options"]))
+        self.state = state
+        self.nfiles = state["nfiles"]
+        self.last = state["last"]
+        logger.info("resume from %s: %d files done", self.path, self.nfiles)
+
+    def attach(self, name, obj):
+        """
+        get_state() と set_state(state) を持つ obj を記録の対象にする
+        再開時は読み込んだ状態を obj に戻す
+        """
+        self.components[name] = obj
+        if self.state is None:
+            pass
+        elif name in self.state:
+            obj.set_state(self.state[name])
+        else:
+            logger.warning("%s is not in the checkpoint", name)
+
+    def open_rows(self):
+        """
+        出力済みの行を書き出すファイルを開く
+        再開時はチェックポイントの時点まで切り詰める
+        """
+        if self.state is None:
+            self.rows = open(self.rows_path, "w+", encoding='UTF-8')
+        else:
+            self.rows = open(self.rows_path, "r+", encoding='UTF-8')
+            self.rows.seek(self.state["rows"])
+            self.rows.truncate()
+        return self.rows
+
+    def skip(self, filenames):
+        """
+        処理済みのファイルを読み飛ばしたイテレータを返す
+        """
+        it = iter(filenames)
+        filename = None
+        for _ in range(self.nfiles):
+            filename = next(it, None)
+            if filename is None:
+                raise CheckpointError("fewer files than the checkpoint")
+            capture_times.pop(filename)
+        if filename is not None and os.fspath(filename) != self.last:
+            raise CheckpointError("files differ from the checkpoint: {}"
+                                  .format(filename))
+        return it
+
+    def done(self, filename):
+        """
+        1ファイル分の出力が終わったときに呼ぶ
+        """
+        self.nfiles += 1
+        self.last = os.fspath(filename)
+        if self.interval > 0 and self.nfiles % self.interval == 0:
+            self.save()
+
+    def save(self):
+        """
+        一時ファイルに書いてから置き換え、書きかけの状態を残さない
+        """
+        state = {"version": self.VERSION, "options": self.options(),
+                 "nfiles": self.nfiles, "last": self.last}
+        if self.rows is not None:
+            self.rows.flush()
+            os.fsync(self.rows.fileno())
+            state["rows"] = self.rows.tell()
+        for name, obj in self.components.items():
+            state[name] = obj.get_state()
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w", encoding='UTF-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        logger.debug("checkpoint: %d files", self.nfiles)
+
+    def remove(self):
+        """
+        最後まで出力できたらチェックポイントを消す
+        """
+        for path in (self.path, self.rows_path):
+            if path.exists():
+                path.unlink()
+
+
 def sort_files(files, ordering):
     if ordering == Ordering.NOTSPECIFIED:
         return files
@@ -2589,9 +4248,95 @@ def sort_files(files, ordering):
         return sorted(files)
     elif ordering == Ordering.TIMESTAMP:
         return sorted(files, key=lambda f: Path(f).stat().st_ctime)
+    elif ordering == Ordering.CAPTURETIME:
+        capture_times.prescan(files)
+        keys = {f: capture_key(f, capture_times.times[os.fspath(f)])
+                for f in files}
+        return sorted(files, key=keys.get)
     raise ValueError(f'Unsupported ordering: {ordering}')
 
 
+def spill_chunk(chunk):
+    """
+    並べ替えた (key, value) のリストを一時ファイルに書き出す
+    """
+    f = tempfile.TemporaryFile("w+", encoding='UTF-8')
+    for pair in sorted(chunk):
+        f.write(json.dumps(pair, ensure_ascii=False) + "\n")
+    f.seek(0)
+    return f
+
+
+def read_chunk(f):
+    with f:
+        for line in f:
+            yield tuple(json.loads(line))
+
+
+def external_sort(pairs, chunk_size=SORT_CHUNK_SIZE):
+    """
+    (key, value) を key 順に返すイテレータ
+    chunk_size 件ごとに並べ替えて一時ファイルに書き出し、最後にマージする
+    key と value は JSON で表せるものに限る
+    """
+    chunks = []
+    chunk = []
+    for pair in pairs:
+        chunk.append(pair)
+        if len(chunk) >= chunk_size:
+            chunks.append(spill_chunk(chunk))
+            chunk = []
+    if len(chunks) == 0:
+        yield from sorted(chunk)
+        return
+    if len(chunk) > 0:
+        chunks.append(spill_chunk(chunk))
+    yield from heapq.merge(*[read_chunk(f) for f in chunks])
+
+
+def iter_folder(folder, ordering=Ordering.NOTSPECIFIED,
+                chunk_size=SORT_CHUNK_SIZE):
+    """
+    フォルダ内のファイルを ordering の順に返すイテレータ
+    全ファイルの一覧をメモリに持たないよう os.scandir で順に読み、
+    並べ替えが必要なときは external_sort を使う
+    """
+    def scan():
+        with os.scandir(folder) as it:
+            yield from it
+
+    if ordering == Ordering.NOTSPECIFIED:
+        for entry in scan():
+            yield Path(entry.path)
+        return
+    elif ordering == Ordering.FILENAME:
+        pairs = ((os.path.normcase(entry.name), entry.path)
+                 for entry in scan())
+    elif ordering == Ordering.TIMESTAMP:
+        pairs = ((entry.stat().st_ctime, entry.path) for entry in scan())
+    elif ordering == Ordering.CAPTURETIME:
+        # 撮影日時も一緒に並べ替え、認識のときに読み直さないようにする
+        def capture_pairs():
+            paths = (entry.path for entry in scan())
+            while True:
+                chunk = list(itertools.islice(paths, chunk_size))
+                if len(chunk) == 0:
+                    break
+                for path, dt in capture_times.scan(chunk):
+                    iso = "NON" if dt == "NON" else dt.isoformat()
+                    yield (capture_key(path, dt), path, iso)
+        for _, path, iso in external_sort(capture_pairs(), chunk_size):
+            dt = "NON" if iso == "NON" else \
+                datetime.datetime.fromisoformat(iso)
+            capture_times.put(path, dt)
+            yield Path(path)
+        return
+    else:
+        raise ValueError(f'Unsupported ordering: {ordering}')
+    for _, path in external_sort(pairs, chunk_size):
+        yield Path(path)
+
+
 def change_value(args, line):
     if args.lang == 'jpn':
         line = re.sub('000000$', "百万", str(line))
@@ -2736,100 +4481,314 @@ def deside_quest(item_list):
     return quest_candidate
 
 
-def make_csv_header(args, item_list):
+class QuestNarrowing:
     """
-    CSVのヘッダ情報を作成
-    礼装のドロップが無いかつ恒常以外のアイテムが有るとき礼装0をつける
+    周回中のクエストが判明したときに、そのクエストのドロップだけを
+    先に探すための候補集合
     """
-    if args.lang == 'jpn':
-        drop_count = 'ドロ数'
-        ce_str = '礼装'
-    else:
-        drop_count = 'drop_count'
-        ce_str = 'CE'
-    if item_list == [[]]:
-        return ['filename', drop_count], False, ""
-    # リストを一次元に
-    flat_list = list(itertools.chain.from_iterable(item_list))
-    # 余計な要素を除く
-    short_list = [{"id": a["id"], "name": a["name"], "category": a["category"],
-                   "dropPriority": a["dropPriority"], "dropnum": a["dropnum"]}
-                  for a in flat_list]
-    # 概念礼装のカテゴリのアイテムが無くかつイベントアイテム(>ID_EXM_MAX)がある
-    if args.lang == 'jpn':
-        no_ce_exp_list = [
-                          k for k in flat_list
-                          if not k["name"].startswith("概念礼装EXPカード：")
-                          ]
-    else:
-        no_ce_exp_list = [
-                          k for k in flat_list
-                          if not k["name"].startswith("CE EXP Card:")
-                          ]
-    ce0_flag = ("Craft Essence"
-                not in [
-                        d.get('category') for d in no_ce_exp_list
-                       ]
-                ) and (
-                       max([d.get("id") for d in flat_list]) > ID_EXP_MAX
-                )
-    if ce0_flag:
-        short_list.append({"id": 99999990, "name": ce_str,
-                           "category": "Craft Essence",
-                           "dropPriority": 9005, "dropnum": 0})
-    # 重複する要素を除く
-    unique_list = list(map(json.loads, set(map(json.dumps, short_list))))
-    # ソート
-    new_list = sorted(sorted(sorted(unique_list, key=itemgetter('dropnum')),
-                             key=itemgetter('id'), reverse=True),
-                      key=itemgetter('dropPriority'), reverse=True)
-    header = []
-    for nlist in new_list:
-        if nlist['category'] in ['Quest Reward', 'Point'] \
-           or nlist["name"] == "QP":
-            tmp = out_name(args, nlist['id']) \
-                  + "(+" + change_value(args, nlist["dropnum"]) + ")"
-        elif nlist["dropnum"] > 1:
-            tmp = out_name(args, nlist['id']) \
-                  + "(x" + change_value(args, nlist["dropnum"]) + ")"
-        elif nlist["name"] == ce_str:
-            tmp = ce_str
+
+    def __init__(self, quest, catalog):
+        self.quest = quest
+        ids = {d["id"] for d in quest["drop"]}
+        self.index_item = catalog.index_item.narrow(ids)
+        self.index_point = catalog.index_point.narrow(ids)
+        self.dist_ce = {k: v for k, v in catalog.dist_ce.items() if v in ids}
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit):
+        if hit:
+            self.hits += 1
         else:
-            tmp = out_name(args, nlist['id'])
-        header.append(tmp)
-    # クエスト名判定
-    quest = deside_quest(new_list)
-    quest_output = make_quest_output(quest)
-    return ['filename', drop_count] + header, ce0_flag, quest_output
+            self.misses += 1
 
 
-def make_csv_data(args, sc_list, ce0_flag):
-    if sc_list == []:
-        return [{}], [{}]
-    csv_data = []
-    allitem = []
-    for sc in sc_list:
-        tmp = []
-        for item in sc:
-            if item['category'] in ['Quest Reward', 'Point'] \
-               or item["name"] == "QP":
-                tmp.append(out_name(args, item['id'])
-                           + "(+" + change_value(args, item["dropnum"]) + ")")
-            elif item["dropnum"] > 1:
-                tmp.append(out_name(args, item['id'])
-                           + "(x" + change_value(args, item["dropnum"]) + ")")
+class QuestTracker:
+    """
+    認識済みのドロップからクエストを推定し、同じクエストが
+    confirm 回続けて推定されたら QuestNarrowing を作成する
+    推定できていたクエストに合わなくなったら (クエストが変わった、
+    他のアイテムが出た) 集めたドロップと絞り込みを捨て、
+    次のスクショから推定をやり直す
+    """
+
+    def __init__(self, catalog, confirm=3):
+        self.catalog = catalog
+        self.confirm = confirm
+        self.items = {}
+        self.quest_id = None
+        self.count = 0
+        self.narrowing = None
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, itemlist):
+        for item in itemlist:
+            key = (item["id"], item["dropnum"])
+            if key not in self.items:
+                self.items[key] = item
+        quest = deside_quest(list(self.items.values()))
+        if quest == "" or "drop" not in quest:
+            if self.quest_id is not None:
+                # 推定できていたクエストのドロップ以外が出た
+                logger.debug("quest narrowing: reset")
+                self.reset()
+            return
+        if quest["id"] == self.quest_id:
+            self.count += 1
+        else:
+            if self.quest_id is not None:
+                self.drop_narrowing()
+            self.quest_id = quest["id"]
+            self.count = 1
+        if self.count >= self.confirm and self.narrowing is None:
+            logger.debug("quest narrowing: %s", quest["name"])
+            self.narrowing = QuestNarrowing(quest, self.catalog)
+
+    def drop_narrowing(self):
+        if self.narrowing is not None:
+            self.hits += self.narrowing.hits
+            self.misses += self.narrowing.misses
+            self.narrowing = None
+
+    def reset(self):
+        """
+        集めたドロップと絞り込みを捨てる
+        """
+        self.drop_narrowing()
+        self.items = {}
+        self.quest_id = None
+        self.count = 0
+
+    def get_state(self):
+        state = {"items": list(self.items.values()),
+                 "quest_id": self.quest_id, "count": self.count,
+                 "hits": self.hits, "misses": self.misses,
+                 "narrowing": None}
+        if self.narrowing is not None:
+            state["narrowing"] = {"quest": self.narrowing.quest,
+                                  "hits": self.narrowing.hits,
+                                  "misses": self.narrowing.misses}
+        return state
+
+    def set_state(self, state):
+        """
+        チェックポイントから再開するときに calc_dist_local の後に呼ぶ
+        (絞り込みの候補集合を catalog から作り直す)
+        """
+        self.items = {(item["id"], item["dropnum"]): item
+                      for item in state["items"]}
+        self.quest_id = state["quest_id"]
+        self.count = state["count"]
+        self.hits = state["hits"]
+        self.misses = state["misses"]
+        self.narrowing = None
+        if state["narrowing"] is not None:
+            self.narrowing = QuestNarrowing(state["narrowing"]["quest"],
+                                            self.catalog)
+            self.narrowing.hits = state["narrowing"]["hits"]
+            self.narrowing.misses = state["narrowing"]["misses"]
+
+    def stats(self):
+        """
+        クエストのドロップだけで判別できた回数と全体の回数を返す
+        """
+        hits = self.hits
+        misses = self.misses
+        if self.narrowing is not None:
+            hits += self.narrowing.hits
+            misses += self.narrowing.misses
+        return hits, hits + misses
+
+
+def csv_label(args, item):
+    """
+    アイテムの CSV の列名
+    """
+    if item['category'] in ['Quest Reward', 'Point'] \
+       or item["name"] == "QP":
+        return out_name(args, item['id']) \
+            + "(+" + change_value(args, item["dropnum"]) + ")"
+    elif item["dropnum"] > 1:
+        return out_name(args, item['id']) \
+            + "(x" + change_value(args, item["dropnum"]) + ")"
+    return out_name(args, item['id'])
+
+
+class CsvAggregator:
+    """
+    CSV のヘッダと合計行に必要な情報をファイルごとに集計する
+    全ファイルのアイテムリストを保持せずにヘッダと合計を作れる
+    """
+
+    def __init__(self, args):
+        self.args = args
+        if args.lang == 'jpn':
+            self.ce_exp_prefix = "概念礼装EXPカード："
+        else:
+            self.ce_exp_prefix = "CE EXP Card:"
+        self.items = set()
+        self.has_ce = False
+        self.max_id = None
+        self.total = Counter()
+        self.nrows = 0
+
+    def get_state(self):
+        return {"items": sorted(self.items), "has_ce": self.has_ce,
+                "max_id": self.max_id, "total": dict(self.total),
+                "nrows": self.nrows}
+
+    def set_state(self, state):
+        self.items = {tuple(a) for a in state["items"]}
+        self.has_ce = state["has_ce"]
+        self.max_id = state["max_id"]
+        self.total = Counter(state["total"])
+        self.nrows = state["nrows"]
+
+    def add(self, itemlist):
+        """
+        1ファイル分を集計し、そのファイルの行 {列名: 個数} を返す
+        """
+        self.nrows += 1
+        for a in itemlist:
+            self.items.add((a["id"], a["name"], a["category"],
+                            a["dropPriority"], a["dropnum"]))
+            if a["category"] == "Craft Essence" \
+                    and not a["name"].startswith(self.ce_exp_prefix):
+                self.has_ce = True
+            if self.max_id is None or a["id"] > self.max_id:
+                self.max_id = a["id"]
+        row = dict(Counter([csv_label(self.args, a) for a in itemlist]))
+        self.total.update(row)
+        return row
+
+    def ce0_flag(self):
+        """
+        概念礼装のカテゴリのアイテムが無くかつイベントアイテム(>ID_EXM_MAX)がある
+        """
+        return not self.has_ce and self.max_id is not None \
+            and self.max_id > ID_EXP_MAX
+
+    def csv_sum(self, ce0_flag):
+        csv_sum = dict(self.total)
+        if ce0_flag:
+            if self.args.lang == 'jpn':
+                ce_str = '礼装'
             else:
-                tmp.append(out_name(args, item['id']))
-        allitem = allitem + tmp
-        csv_data.append(dict(Counter(tmp)))
-    csv_sum = dict(Counter(allitem))
-    if ce0_flag:
+                ce_str = 'CE'
+            csv_sum.update({ce_str: 0})
+        return csv_sum
+
+    def header(self):
+        """
+        CSVのヘッダ情報を作成
+        礼装のドロップが無いかつ恒常以外のアイテムが有るとき礼装0をつける
+        """
+        args = self.args
         if args.lang == 'jpn':
+            drop_count = 'ドロ数'
             ce_str = '礼装'
         else:
+            drop_count = 'drop_count'
             ce_str = 'CE'
-        csv_sum.update({ce_str: 0})
-    return csv_sum, csv_data
+        if len(self.items) == 0:
+            return ['filename', drop_count], False, ""
+        unique_list = [{"id": a[0], "name": a[1], "category": a[2],
+                        "dropPriority": a[3], "dropnum": a[4]}
+                       for a in sorted(self.items)]
+        ce0_flag = self.ce0_flag()
+        if ce0_flag:
+            unique_list.append({"id": 99999990, "name": ce_str,
+                                "category": "Craft Essence",
+                                "dropPriority": 9005, "dropnum": 0})
+        # ソート
+        new_list = sorted(sorted(sorted(unique_list,
+                                        key=itemgetter('dropnum')),
+                                 key=itemgetter('id'), reverse=True),
+                          key=itemgetter('dropPriority'), reverse=True)
+        header = []
+        for nlist in new_list:
+            if nlist["name"] == ce_str and nlist["id"] == 99999990:
+                tmp = ce_str
+            else:
+                tmp = csv_label(args, nlist)
+            header.append(tmp)
+        # クエスト名判定
+        quest = deside_quest(new_list)
+        quest_output = make_quest_output(quest)
+        return ['filename', drop_count] + header, ce0_flag, quest_output
+
+
+def make_csv_header(args, item_list):
+    """
+    CSVのヘッダ情報を作成
+    礼装のドロップが無いかつ恒常以外のアイテムが有るとき礼装0をつける
+    """
+    aggregator = CsvAggregator(args)
+    for itemlist in item_list:
+        aggregator.add(itemlist)
+    return aggregator.header()
+
+
+def make_csv_data(args, sc_list, ce0_flag):
+    if sc_list == []:
+        return [{}], [{}]
+    aggregator = CsvAggregator(args)
+    csv_data = [aggregator.add(sc) for sc in sc_list]
+    return aggregator.csv_sum(ce0_flag), csv_data
+
+
+def write_csv(filenames, args, file=None, policy=None, checkpoint=None):
+    """
+    CSV を出力する
+    各行は一時ファイルに書き出しておき、全ファイルの集計でヘッダと
+    合計行が決まってから出力する (ファイル数に比例するメモリを使わない)
+    checkpoint (Checkpoint) を渡すと、行はチェックポイントのファイルに
+    書き出して途中から再開できるようにする
+    """
+    if file is None:
+        file = sys.stdout
+    if args.lang == 'jpn':
+        drop_count = 'ドロ数'
+    else:
+        drop_count = 'drop_count'
+    aggregator = CsvAggregator(args)
+    if checkpoint is None:
+        spool = tempfile.TemporaryFile("w+", encoding='UTF-8')
+    else:
+        checkpoint.attach("aggregator", aggregator)
+        spool = checkpoint.open_rows()
+    with spool:
+        for output, itemlist in iter_output(filenames, args, policy,
+                                            checkpoint):
+            output.update(aggregator.add(itemlist))
+            spool.write(json.dumps(output, ensure_ascii=False) + "\n")
+        nrows = aggregator.nrows
+
+        # CSVヘッダーをつくる
+        csv_heder, ce0_flag, questname = aggregator.header()
+        writer = csv.DictWriter(file, fieldnames=csv_heder,
+                                lineterminator='\n')
+        writer.writeheader()
+        if nrows > 1:  # ファイル一つのときは合計値は出さない
+            if questname == "":
+                if args.lang == 'jpn':
+                    questname = "合計"
+                else:
+                    questname = "SUM"
+            a = {'filename': questname, drop_count: ''}
+            a.update(aggregator.csv_sum(ce0_flag))
+            writer.writerow(a)
+        spool.seek(0)
+        fo = {}
+        for line in spool:
+            fo = json.loads(line)
+            writer.writerow(fo)
+    if drop_count in fo.keys():  # issue: #55
+        if nrows > 1 and str(fo[drop_count]).endswith('+'):
+            writer.writerow({'filename': 'missing'})
+    if checkpoint is not None:
+        checkpoint.remove()
 
 
 if __name__ == '__main__':
@@ -2852,12 +4811,42 @@ if __name__ == '__main__':
     text_timeout = 'Duplicate check interval at QP MAX (sec): Default '
     parser.add_argument('-t', '--timeout', type=int, default=TIMEOUT,
                         help=text_timeout + str(TIMEOUT) + ' sec')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Search the drops of the identified quest first')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='Number of worker processes (0: number of CPUs)')
+    parser.add_argument('--policy', default='auto',
+                        choices=('auto',) + ExecutionPolicy.MODES,
+                        help='threads: OpenCV threads in one process, '
+                             'processes: one image per worker process, '
+                             'auto: use -j or policy.json from benchmark.py'
+                             ': Default auto')
+    parser.add_argument('--cell-threads', type=int,
+                        help='Number of threads for the item cells '
+                             'in one screenshot: Default 1')
+    parser.add_argument('--compact-models', action='store_true',
+                        help='Use *_compact.xml (makemodels.py --compact) '
+                             'for digit recognition if they exist')
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='Write checkpoints to FILE (and FILE.rows) '
+                             'so that an interrupted run can be resumed: '
+                             'Default no checkpoint')
+    parser.add_argument('--checkpoint-interval', type=int,
+                        default=CHECKPOINT_INTERVAL,
+                        help='Write a checkpoint every N files '
+                             'with --checkpoint: Default '
+                             + str(CHECKPOINT_INTERVAL))
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume from the --checkpoint FILE of '
+                             'an interrupted run')
     parser.add_argument('--version', action='version',
                         version=PROGNAME + " " + VERSION)
     parser.add_argument('-l', '--loglevel',
                         choices=('debug', 'info'), default='info')
 
     args = parser.parse_args()    # 引数を解析
+    if args.resume and args.checkpoint is None:
+        parser.error('--resume requires --checkpoint FILE')
     lformat = '%(name)s <%(filename)s-L%(lineno)s> [%(levelname)s] %(message)s'
     logging.basicConfig(
         level=logging.INFO,
@@ -2870,36 +4859,17 @@ if __name__ == '__main__':
             ndir.mkdir(parents=True)
 
     if args.folder:
-        inputs = [x for x in Path(args.folder).iterdir()]
+        inputs = iter_folder(args.folder, args.ordering)
     else:
-        inputs = args.filenames
-
-    inputs = sort_files(inputs, args.ordering)
-    fileoutput, all_new_list = get_output(inputs, args)
-
-    # CSVヘッダーをつくる
-    csv_heder, ce0_flag, questname = make_csv_header(args, all_new_list)
-    csv_sum, csv_data = make_csv_data(args, all_new_list, ce0_flag)
-
-    writer = csv.DictWriter(sys.stdout, fieldnames=csv_heder,
-                            lineterminator='\n')
-    writer.writeheader()
-    if args.lang == 'jpn':
-        drop_count = 'ドロ数'
-    else:
-        drop_count = 'drop_count'
-    if len(all_new_list) > 1:  # ファイル一つのときは合計値は出さない
-        if questname == "":
-            if args.lang == 'jpn':
-                questname = "合計"
-            else:
-                questname = "SUM"
-        a = {'filename': questname, drop_count: ''}
-        a.update(csv_sum)
-        writer.writerow(a)
-    for fo, cd in zip(fileoutput, csv_data):
-        fo.update(cd)
-        writer.writerow(fo)
-    if drop_count in fo.keys():  # issue: #55
-        if len(fileoutput) > 1 and str(fo[drop_count]).endswith('+'):
-            writer.writerow({'filename': 'missing'})
+        inputs = sort_files(args.filenames, args.ordering)
+    checkpoint = None
+    if args.checkpoint is not None:
+        checkpoint = Checkpoint(args, args.checkpoint,
+                                args.checkpoint_interval)
+    try:
+        if args.resume:
+            checkpoint.load()
+        write_csv(inputs, args, checkpoint=checkpoint)
+    except CheckpointError as e:
+        logger.critical(e)
+        sys.exit(1)
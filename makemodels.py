@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# FGO戦利品スクショの文字を読む機械学習モデル (item, chest, dcnt, card) を作成
+#
+# data/<モデル名>/input/<ラベル>/*.png を学習データとして <モデル名>.xml を出力する。
+# HOG 特徴量はプロセスプールで計算し、画像ごとにファイルのハッシュをキーとして
+# data/<モデル名>/hog_cache_<HOG の形状>.npz にキャッシュする。再作成時は新しい画像だけ計算する。
+#
+# 以下のサイトを参考にした
+# https://algorithm.joho.info/programming/python/hog-svm-classifier-py/
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MODELS = ('item', 'chest', 'dcnt', 'card')
+DATA_DIR = Path('data')
+
+# SVM のパラメータ
+SVM_C = 0.5
+
+
+class HogConfig:
+    """
+    HOG 特徴量の形状 (ウィンドウ、ブロック、ストライド、セルの大きさとビン数)
+    """
+
+    def __init__(self, win_size, block_size, block_stride, cell_size, bins):
+        self.win_size = tuple(win_size)
+        self.block_size = tuple(block_size)
+        self.block_stride = tuple(block_stride)
+        self.cell_size = tuple(cell_size)
+        self.bins = bins
+
+    def params(self):
+        return (*self.win_size, *self.block_size, *self.block_stride, *self.cell_size, self.bins)
+
+    @classmethod
+    def from_params(cls, params):
+        p = [int(v) for v in params]
+        return cls(p[0:2], p[2:4], p[4:6], p[6:8], p[8])
+
+    def __eq__(self, other):
+        if not isinstance(other, HogConfig):
+            return NotImplemented
+        return self.params() == other.params()
+
+    def __hash__(self):
+        return hash(self.params())
+
+    def __repr__(self):
+        return 'HogConfig(win_size={}, block_size={}, block_stride={}, cell_size={}, bins={})'.format(
+            self.win_size, self.block_size, self.block_stride, self.cell_size, self.bins)
+
+    def key(self):
+        """
+        ファイル名などに使う文字列 (例: 120x60_16x16_4x4_4x4_9)
+        """
+        return '{}x{}_{}x{}_{}x{}_{}x{}_{}'.format(*self.params())
+
+    def is_valid(self):
+        """
+        cv2.HOGDescriptor が受け付ける形状かどうか
+        """
+        for win, block, stride, cell in zip(self.win_size, self.block_size,
+                                            self.block_stride, self.cell_size):
+            if block > win or block % cell != 0 or (win - block) % stride != 0:
+                return False
+        return self.bins > 0
+
+    def make_hog(self):
+        return cv2.HOGDescriptor(self.win_size, self.block_size, self.block_stride, self.cell_size, self.bins)
+
+    def to_json(self):
+        return {'win_size': self.win_size, 'block_size': self.block_size,
+                'block_stride': self.block_stride, 'cell_size': self.cell_size, 'bins': self.bins}
+
+
+# Hog特徴のパラメータ (fgosccnt.py の DEFAULT_HOG と同じであること)
+DEFAULT_HOG = HogConfig((120, 60), (16, 16), (4, 4), (4, 4), 9)
+
+# 数字を読むモデルの小さい特徴量 (--compact で <モデル名>_compact.xml を作成)
+# benchmark.py svm で選んだ形状。特徴量の次元は 46656 から 504 になる
+COMPACT_HOG = {
+    'item': HogConfig((40, 20), (16, 16), (4, 4), (8, 8), 9),
+    'chest': HogConfig((40, 20), (16, 16), (4, 4), (8, 8), 9),
+    'dcnt': HogConfig((40, 20), (16, 16), (4, 4), (8, 8), 9),
+}
+
+
+def list_samples(name):
+    """
+    学習データのファイル名とラベルのリストを返す
+    順序は従来の make*.py と同じ (ラベルのフォルダ順、フォルダ内の glob 順)
+    """
+    p_label_dir = DATA_DIR / name / 'input'
+    samples = []
+    for dir in p_label_dir.iterdir():
+        if not dir.is_dir():
+            continue
+        for file in dir.glob('*.png'):
+            samples.append((file, int(dir.name)))
+    return samples
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def read_gray(path):
+    with open(path, 'rb') as f:
+        buf = np.frombuffer(f.read(), np.uint8)
+    img = cv2.imdecode(buf, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise ValueError(f'Cannot read file: {path}')
+    return img
+
+
+def compute_feature_from_image(img, config, hog):
+    """
+    グレースケール画像の HOG 特徴量を1次元の float32 配列で返す
+    """
+    img = cv2.resize(img, config.win_size)
+    return hog.compute(img).ravel()
+
+
+# ワーカープロセスごとの HOGDescriptor (HOG の形状ごと)
+_hogs = {}
+
+
+def _init_worker():
+    # プロセスで並列に処理するので OpenCV の内部スレッドは使わない
+    cv2.setNumThreads(1)
+
+
+def _compute_feature_in_worker(task):
+    path, params = task
+    config = HogConfig.from_params(params)
+    if config not in _hogs:
+        _hogs[config] = config.make_hog()
+    return compute_feature_from_image(read_gray(path), config, _hogs[config])
+
+
+class FeatureCache:
+    """
+    ファイルのハッシュ -> HOG 特徴量 のキャッシュ
+    HOG の形状ごとに別のファイル (hog_cache_<形状>.npz) にする
+    """
+
+    def __init__(self, dirname, config):
+        self.path = Path(dirname) / 'hog_cache_{}.npz'.format(config.key())
+        self.config = config
+        self.features = {}
+
+    def load(self):
+        if not self.path.exists():
+            return
+        with np.load(self.path) as npz:
+            if tuple(npz['params']) != self.config.params():
+                logger.info('%s: HOG parameters changed, ignore cache', self.path)
+                return
+            self.features = dict(zip(npz['hashes'], npz['features']))
+
+    def save(self, hashes):
+        """
+        hashes の分だけ保存する (使わなくなった画像の分は捨てる)
+        """
+        features = np.array([self.features[h] for h in hashes], dtype=np.float32)
+        tmp = self.path.with_name(self.path.name + '.tmp.npz')
+        np.savez(tmp, params=np.array(self.config.params()), hashes=np.array(hashes), features=features)
+        os.replace(tmp, self.path)
+
+
+def extract_features(samples, pool, cache):
+    """
+    samples の特徴量を (特徴量の2次元配列, ハッシュのリスト) で返す
+    キャッシュにない画像だけ pool で計算する
+    """
+    hashes = [file_hash(path) for path, _ in samples]
+    missing = {}
+    for (path, _), h in zip(samples, hashes):
+        if h not in cache.features and h not in missing:
+            missing[h] = path
+    logger.info('%d samples, %d cached, %d to compute',
+                len(samples), len(samples) - len(missing), len(missing))
+    if missing:
+        config = cache.config
+        if pool is None:
+            hog = config.make_hog()
+            computed = [compute_feature_from_image(read_gray(path), config, hog)
+                        for path in missing.values()]
+        else:
+            computed = pool.map(_compute_feature_in_worker,
+                                [(path, config.params()) for path in missing.values()])
+        cache.features.update(zip(missing.keys(), computed))
+    train = np.array([cache.features[h] for h in hashes], dtype=np.float32)
+    return train, hashes
+
+
+def train_svm(train, label, c=SVM_C):
+    # Hog特徴からSVM識別器の作成
+    svm = cv2.ml.SVM_create()
+    svm.setKernel(cv2.ml.SVM_LINEAR)
+    svm.setType(cv2.ml.SVM_C_SVC)
+    svm.setC(c)
+    svm.train(train, cv2.ml.ROW_SAMPLE, label)
+    return svm
+
+
+def build_model(name, pool=None, use_cache=True, output_dir='.', config=DEFAULT_HOG, c=SVM_C, suffix=''):
+    """
+    data/<name>/input から <name><suffix>.xml を作成する
+    HOG の形状は同じ名前の .json に書き出す (fgosccnt.py はこれを読んで特徴量を作る)
+    """
+    logger.info('building %s%s.xml', name, suffix)
+    samples = list_samples(name)
+    if len(samples) == 0:
+        raise FileNotFoundError(f'No training data in {DATA_DIR / name / "input"}')
+    cache = FeatureCache(DATA_DIR / name, config)
+    if use_cache:
+        cache.load()
+    train, hashes = extract_features(samples, pool, cache)
+    if use_cache:
+        cache.save(hashes)
+    label = np.array([lbl for _, lbl in samples], dtype=int)
+    svm = train_svm(train, label, c)
+    output = Path(output_dir) / (name + suffix + '.xml')
+    svm.save(str(output))
+    with open(output.with_suffix('.json'), 'w', encoding='UTF-8') as f:
+        json.dump(dict(config.to_json(), C=c), f, indent=2)
+    return output
+
+
+def main(args):
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    if jobs == 1:
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs, initializer=_init_worker)
+    try:
+        for name in args.models:
+            output = build_model(name, pool, not args.no_cache, args.output_dir)
+            logger.info('wrote %s', output)
+            if args.compact and name in COMPACT_HOG:
+                output = build_model(name, pool, not args.no_cache, args.output_dir,
+                                     COMPACT_HOG[name], suffix='_compact')
+                logger.info('wrote %s', output)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def parse_args(models=None):
+    """
+    models を指定すると (makeitem.py などから) そのモデルだけを作成し、
+    コマンドラインでのモデルの指定は受け付けない
+    """
+    parser = argparse.ArgumentParser(description='Build SVM models for fgosccnt.py')
+    if models is None:
+        parser.add_argument('models', nargs='*',
+                            help='models to build ({}) [default: {}]'.format(
+                                ', '.join(MODELS), ' '.join(MODELS)))
+    else:
+        parser.set_defaults(models=list(models))
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='number of worker processes (0: number of CPUs) [default: 0]')
+    parser.add_argument('--compact', action='store_true',
+                        help='also build <model>_compact.xml with smaller HOG features '
+                             'for the digit models ({})'.format(', '.join(COMPACT_HOG)))
+    parser.add_argument('--no-cache', action='store_true',
+                        help='compute all features without reading or writing the cache')
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help='output directory for xml files [default: .]')
+    parser.add_argument('-l', '--loglevel', choices=('debug', 'info', 'warning'), default='info')
+    args = parser.parse_args()
+    if not args.models:
+        args.models = list(MODELS)
+    for name in args.models:
+        if name not in MODELS:
+            parser.error(f'invalid model: {name} (choose from {", ".join(MODELS)})')
+    return args
+
+
+def run(models=None):
+    args = parse_args(models)
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
+    logger.setLevel(args.loglevel.upper())
+    main(args)
+
+
+if __name__ == '__main__':
+    run()
@@ -26,16 +26,31 @@
 import argparse
 import csv
 import enum
+import functools
 import logging
+import multiprocessing
 import os
 import sys
 
 import cv2
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
 NOSCROLL_PAGE_INFO = (1, 1, 0)
 
+# imread の reduce に対応するデコード時に縮小するフラグ
+REDUCED_COLOR_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+REDUCED_GRAYSCALE_FLAGS = {
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
 
 class QPDetectionMode(enum.Enum):
     JP = 'jp'
@@ -54,7 +69,64 @@ class PageInfoError(Exception):
 
 
 class TooManyAreasDetectedError(PageInfoError):
-    pass
+    def __init__(self, message, scrollbar=None):
+        super().__init__(message)
+        # スクロール可能領域が複数検出された場合、検出済みのスクロールバーの矩形
+        self.scrollbar = scrollbar
+
+
+class PageInfo(tuple):
+    """
+        guess_pageinfo の推定結果
+
+        (現ページ数, 全体ページ数, 全体行数) のタプルとして扱える。
+        加えて、推定に使ったスクロールバーとスクロール可能領域の矩形
+        (x, y, width, height) を元画像の座標で持つ。検出できなかった方は None
+    """
+
+    def __new__(cls, pagenum, pages, lines, scrollbar=None, scrollable_area=None):
+        self = super().__new__(cls, (pagenum, pages, lines))
+        self.scrollbar = scrollbar
+        self.scrollable_area = scrollable_area
+        return self
+
+    def __getnewargs__(self):
+        return (*self, self.scrollbar, self.scrollable_area)
+
+    def __repr__(self):
+        return f'PageInfo({self[0]}, {self[1]}, {self[2]}, scrollbar={self.scrollbar}, ' \
+            f'scrollable_area={self.scrollable_area})'
+
+    @property
+    def pagenum(self):
+        return self[0]
+
+    @property
+    def pages(self):
+        return self[1]
+
+    @property
+    def lines(self):
+        return self[2]
+
+
+def imread(filename, flags=cv2.IMREAD_COLOR, reduce=1, dtype=np.uint8):
+    """
+        ファイルを一度だけ読み込んでからデコードする。
+        cv2.imread と違い日本語ファイル名も読める。
+
+        reduce に 2, 4, 8 を指定すると 1/reduce に縮小しながらデコードする。
+        JPEG は DCT の段階で縮小されるので、等倍で読んでから縮小するより速い。
+        読み込めない場合は None を返す。
+    """
+    if reduce != 1:
+        if flags == cv2.IMREAD_GRAYSCALE:
+            flags = REDUCED_GRAYSCALE_FLAGS[reduce]
+        else:
+            flags = REDUCED_COLOR_FLAGS[reduce]
+    with open(filename, 'rb') as f:
+        buf = np.frombuffer(f.read(), dtype)
+    return cv2.imdecode(buf, flags)
 
 
 def filter_contour_qp(contour, im):
@@ -78,7 +150,56 @@ def filter_contour_qp(contour, im):
     return True
 
 
-def detect_qp_region(im, mode=QPDetectionMode.JP.value, debug_draw_image=False, debug_image_name=None):
+def downscale_image(im, downscale):
+    """
+        輪郭検出用に画像を 1/downscale に縮小する
+        平均を取ると二値化の閾値付近の画素の値が変わってしまうので、
+        画素を間引いて縮小する
+    """
+    if downscale == 1:
+        return im
+    return cv2.resize(im, None, fx=1/downscale, fy=1/downscale, interpolation=cv2.INTER_NEAREST)
+
+
+def _detect_qp_contours(im, binary_threshold):
+    im_gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
+    _, th1 = cv2.threshold(im_gray, binary_threshold, 255, cv2.THRESH_BINARY)
+    contours, _ = cv2.findContours(th1, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return [c for c in contours if filter_contour_qp(c, im)]
+
+
+def _refine_qp_contour(im, rect, downscale, binary_threshold):
+    """
+        縮小画像で見つけた "所持 QP" 領域の矩形 rect の周辺だけを
+        元の解像度で二値化し、輪郭を取り直す
+
+        取り直した輪郭のうち判定を通るものが一つに決まらない場合や、
+        それが切り出した範囲の切れ目に接する (範囲の外まで続いている) 場合は
+        画像全体で取った輪郭と一致しないので None を返す。
+    """
+    im_h, im_w = im.shape[:2]
+    x, y, w, h = rect
+    # 縮小による境界のずれは縮小率程度なので、その倍の余白を取る
+    pad = downscale * 2
+    x0 = max(0, x * downscale - pad)
+    y0 = max(0, y * downscale - pad)
+    x1 = min(im_w, (x + w) * downscale + pad)
+    y1 = min(im_h, (y + h) * downscale + pad)
+    im_gray = cv2.cvtColor(im[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+    _, th1 = cv2.threshold(im_gray, binary_threshold, 255, cv2.THRESH_BINARY)
+    contours, _ = cv2.findContours(th1, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+    filtered = [c for c in contours if filter_contour_qp(c, im)]
+    if len(filtered) != 1:
+        return None
+    cx, cy, cw, ch = cv2.boundingRect(filtered[0])
+    if (x0 > 0 and cx == x0) or (y0 > 0 and cy == y0) \
+            or (x1 < im_w and cx + cw == x1) or (y1 < im_h and cy + ch == y1):
+        return None
+    return filtered[0]
+
+
+def detect_qp_region(im, mode=QPDetectionMode.JP.value, debug_draw_image=False, debug_image_name=None,
+                     downscale=1):
     """
         "所持 QP" 領域を検出し、その座標を返す。
 
@@ -86,6 +207,10 @@ def detect_qp_region(im, mode=QPDetectionMode.JP.value, debug_draw_image=False,
         つまり ((topleft_x, topleft_y), (bottomright_x, bottomright_y))
         領域が検出されなかった場合は None を返す。
         複数箇所が検出された場合は TooManyAreasDetectedError が発生する。
+
+        downscale に 2 以上を指定すると 1/downscale に縮小した画像で領域を探し、
+        見つかった領域の周辺だけを元の解像度で取り直す。取り直せなかった場合や
+        一箇所に決まらなかった場合は、元の解像度で画像全体から探し直す。
     """
     # 縦横2分割して4領域に分け、左下の領域だけ使う。
     # QP の領域を調べたいならそれで十分。
@@ -97,12 +222,18 @@ def detect_qp_region(im, mode=QPDetectionMode.JP.value, debug_draw_image=False,
     cropped = im[int(im_h/2):im_h, 0:int(im_w/1.93)]
     cr_h, cr_w = cropped.shape[:2]
     logger.debug('cropped image size (for qp): (width, height) = (%s, %s)', cr_w, cr_h)
-    im_gray = cv2.cvtColor(cropped, cv2.COLOR_BGR2GRAY)
     binary_threshold = 50
-    _, th1 = cv2.threshold(im_gray, binary_threshold, 255, cv2.THRESH_BINARY)
-    contours, _ = cv2.findContours(th1, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    filtered_contours = [c for c in contours if filter_contour_qp(c, im_gray)]
+    if downscale == 1:
+        filtered_contours = _detect_qp_contours(cropped, binary_threshold)
+    else:
+        filtered_contours = _detect_qp_contours(downscale_image(cropped, downscale), binary_threshold)
+        if len(filtered_contours) == 1:
+            refined = _refine_qp_contour(
+                cropped, cv2.boundingRect(filtered_contours[0]), downscale, binary_threshold)
+            filtered_contours = None if refined is None else [refined]
+        if filtered_contours is None or len(filtered_contours) != 1:
+            logger.debug('qp region is not settled in downscaled image, use entire image')
+            filtered_contours = _detect_qp_contours(cropped, binary_threshold)
     candidate = None
 
     for contour in filtered_contours:
@@ -237,12 +368,14 @@ def filter_contour_scrollbar(contour, im):
     return contour
 
 
-def filter_contour_scrollable_area(contour, scrollbar_contour, im):
+def filter_contour_scrollable_area(contour, scrollbar_contour, im, scale=1):
     """
         スクロール可能領域を拾い、それ以外を除外するフィルター
 
         適合する場合は contour オブジェクトを、適合しない場合は None を返す。
         ただし contour オブジェクトは近似図形に補正されることがある。
+        縮小した画像で判定する場合は scale に縮小率を渡す (画素数で決めている
+        許容幅を縮小率で割る)。
     """
     im_w, im_h = im.shape[:2]
     # 画像全体に対する検出領域の面積比が一定以上であること。
@@ -266,15 +399,15 @@ def filter_contour_scrollable_area(contour, scrollbar_contour, im):
     logger.debug('approx rectangle: (x, y, width, height) = (%s, %s, %s, %s)', ax, ay, aw, ah)
 
     # 近似図形の幅はスクロールバーの幅+5以下
-    if aw > sw + 5:
+    if aw > sw + 5 / scale:
         logger.debug('NG: approx width %s is greater than scrollbar %s + 5', aw, sw)
         return None
 
     # 近似図形の x 座標はスクロールバーの幅 + 10 に収まること
-    if ax < sx - 10:
+    if ax < sx - 10 / scale:
         logger.debug('NG: approx x %s is more left than scrollbar %s - 10 = %s', ax, sx, sx - 10)
         return None
-    if ax > sx + sw + 10:
+    if ax > sx + sw + 10 / scale:
         logger.debug('NG: approx x %s is more right than scrollbar %s + width %s + 10 = %s', ax, sx, sw, sx + sw + 10)
         return None
 
@@ -310,17 +443,68 @@ def _detect_scrollbar_region(im, binary_threshold):
     return [c for c in filtered if c is not None]
 
 
-def _detect_scrollable_area(im, binary_threshold, scrollbar_contour):
+def _detect_scrollable_area(im, binary_threshold, scrollbar_contour, scale=1):
     _, th1 = cv2.threshold(im, binary_threshold, 255, cv2.THRESH_BINARY)
     contours, _ = cv2.findContours(th1, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    filtered = [filter_contour_scrollable_area(c, scrollbar_contour, im) for c in contours]
+    filtered = [filter_contour_scrollable_area(c, scrollbar_contour, im, scale) for c in contours]
     return [c for c in filtered if c is not None]
 
 
-def _likely_to_same_contour(contour0, contour1):
+def _scrollable_area_columns(im, scrollbar_contour, scale=1):
+    """
+        スクロール可能領域として判定されうる輪郭が通る列の範囲と、
+        その範囲に余白をつけて実際に輪郭を取る列の範囲を返す
+
+        filter_contour_scrollable_area は近似図形の x 座標をスクロールバーの
+        x 座標 -10 から右端 +10 まで、幅をスクロールバーの幅 +5 までに制限して
+        いる。近似図形の頂点は輪郭上の点なので、この範囲を通らない輪郭は
+        判定を通らない。
+    """
+    im_w = im.shape[1]
+    sx, _, sw, _ = cv2.boundingRect(scrollbar_contour)
+    relevant = (int(sx - 10 / scale), int(sx + sw + 10 / scale + sw + 5 / scale) + 1)
+    margin = max(8, sw)
+    columns = (max(0, relevant[0] - margin), min(im_w, relevant[1] + margin))
+    return relevant, columns
+
+
+def _detect_scrollable_area_in_columns(im, binary_threshold, scrollbar_contour, relevant, columns, scale=1):
+    """
+        _detect_scrollable_area と同じ判定を columns の列範囲だけで行う
+
+        範囲の切れ目に接する輪郭は画像全体で取った輪郭と一致しない。
+        それが relevant の列範囲にもかかっていると判定が変わりうるので None を
+        返す。かかっていなければ、範囲外まで続く領域は relevant を通らない
+        (通るなら切れ目から relevant までつながった部分が見えるはず) ので、
+        全体で取ったときも判定は通らない。切れ目に接しない輪郭は、全体で
+        取った輪郭と点列まで同じになる。
+    """
+    im_w = im.shape[1]
+    x0, x1 = columns
+    _, th1 = cv2.threshold(im[:, x0:x1], binary_threshold, 255, cv2.THRESH_BINARY)
+    contours, _ = cv2.findContours(th1, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, 0))
+    for c in contours:
+        x, _, w, _ = cv2.boundingRect(c)
+        if not ((x0 > 0 and x == x0) or (x1 < im_w and x + w == x1)):
+            continue
+        if x < relevant[1] and x + w > relevant[0]:
+            return None
+    filtered = [filter_contour_scrollable_area(c, scrollbar_contour, im, scale) for c in contours]
+    return [c for c in filtered if c is not None]
+
+
+def _detect_scrollable_area_fast(im, binary_threshold, scrollbar_contour, relevant, columns, scale=1):
+    contours = _detect_scrollable_area_in_columns(im, binary_threshold, scrollbar_contour, relevant, columns, scale)
+    if contours is None:
+        logger.debug(f'th {binary_threshold}: contour crosses the columns {columns}, use entire image')
+        contours = _detect_scrollable_area(im, binary_threshold, scrollbar_contour, scale)
+    return contours
+
+
+def _likely_to_same_contour(contour0, contour1, scale=1):
     x0, y0, w0, h0 = cv2.boundingRect(contour0)
     x1, y1, w1, h1 = cv2.boundingRect(contour1)
-    threshold = 3
+    threshold = 3 / scale
     if abs(x1 - x0) > threshold:
         return False
     elif abs(y1 - y0) > threshold:
@@ -332,12 +516,15 @@ def _likely_to_same_contour(contour0, contour1):
     return True
 
 
-def _try_to_detect_scrollbar(im_gray, im_orig_for_debug=None, **kwargs):
+def _try_to_detect_scrollbar(im_gray, im_orig_for_debug=None, fast=True, scale=1, **kwargs):
     """
         スクロールバーおよびスクロール可能領域の検出
 
         debug 画像を出力したい場合は im_orig_for_debug に二値化
         される前の元画像 (crop されたもの) を渡すこと。
+        fast=False にすると、閾値ごとに画像全体で輪郭を取る従来の方法で
+        検出する (結果は同じ。ベンチマークでの比較用)。
+        im_gray を縮小している場合は scale に縮小率を渡すこと。
     """
     # 二値化の閾値を高めにするとスクロールバー本体の領域を検出できる。
     # 低めにするとスクロールバー可能領域を検出できる。
@@ -362,9 +549,30 @@ def _try_to_detect_scrollbar(im_gray, im_orig_for_debug=None, **kwargs):
 
     actual_scrollbar_contour = actual_scrollbar_contours[0]
 
+    if fast:
+        # スクロール可能領域の候補はスクロールバー周辺の列にしかないので、
+        # その列だけで輪郭を取る。また、二値化の結果が一つ上の閾値と
+        # 変わらない (その輝度の画素がない) 閾値は結果も同じなので飛ばす。
+        relevant, columns = _scrollable_area_columns(im_gray, actual_scrollbar_contour, scale)
+        detect = functools.partial(_detect_scrollable_area_fast,
+                                   scrollbar_contour=actual_scrollbar_contour,
+                                   relevant=relevant, columns=columns, scale=scale)
+        hist = cv2.calcHist([im_gray], [0], None, [256], [0, 256]).ravel()
+    else:
+        detect = functools.partial(_detect_scrollable_area,
+                                   scrollbar_contour=actual_scrollbar_contour, scale=scale)
+        hist = None
+
     scrollable_area_contour = None
+    prev_th = None
     for th in thresholds_for_entire:
-        scrollable_area_contours = _detect_scrollable_area(im_gray, th, actual_scrollbar_contour)
+        if hist is not None and prev_th is not None \
+                and hist[th + 1:prev_th + 1].sum() == 0:
+            logger.debug(f'th {th}: same binary image as th {prev_th}, skip')
+            prev_th = th
+            continue
+        prev_th = th
+        scrollable_area_contours = detect(im_gray, th)
 
         if len(scrollable_area_contours) == 0:
             logger.debug(f'th {th}: scrollbar was found, but scrollable area is not found, retry')
@@ -375,10 +583,11 @@ def _try_to_detect_scrollbar(im_gray, im_orig_for_debug=None, **kwargs):
                 cv2.drawContours(im_orig_for_debug, scrollable_area_contours, -1, (255, 0, 0), 3)
 
             n = len(scrollable_area_contours)
-            raise TooManyAreasDetectedError(f'{n} scrollable areas are detected')
+            raise TooManyAreasDetectedError(f'{n} scrollable areas are detected',
+                                            cv2.boundingRect(actual_scrollbar_contour))
 
         scrollable_area_contour = scrollable_area_contours[0]
-        same_contour = _likely_to_same_contour(actual_scrollbar_contour, scrollable_area_contour)
+        same_contour = _likely_to_same_contour(actual_scrollbar_contour, scrollable_area_contour, scale)
         if same_contour:
             # 同じ領域を検出してしまっている場合、誤検出とみなして
             # 閾値を下げてリトライする
@@ -398,17 +607,37 @@ def _try_to_detect_scrollbar(im_gray, im_orig_for_debug=None, **kwargs):
     return actual_scrollbar_contour, scrollable_area_contour
 
 
-def guess_pageinfo(im, debug_draw_image=False, debug_image_name=None, **kwargs):
+def guess_pageinfo(im, debug_draw_image=False, debug_image_name=None, downscale=1, **kwargs):
     """
         ページ情報を推定する。
-        返却値は (現ページ数, 全体ページ数, 全体行数)
+        返却値は (現ページ数, 全体ページ数, 全体行数) として扱える PageInfo
         スクロールバーがない場合は全体行数の推定は不可能。その場合は
         NOSCROLL_PAGE_INFO すなわち (1, 1, 0) を返す
+        (スクロールバーだけ検出できた場合は PageInfo.scrollbar にその矩形が入る)
+
+        downscale に 2 以上を指定すると 1/downscale に縮小した画像で検出する。
+        推定は矩形の比率で行うので、矩形を元の座標に戻すだけで取り直しはしない。
+        スクロールバーとスクロール可能領域の両方が一つずつ見つからなかった
+        場合は、元の解像度で検出し直す。
+        縮小すると二値化の境目にある画素の扱いが変わるため、元の解像度と
+        推定結果が一致しないことがある (benchmark.py downscale で確認できる)。
     """
+    if downscale != 1:
+        try:
+            pageinfo = _guess_pageinfo(im, debug_draw_image, debug_image_name, downscale, **kwargs)
+            if pageinfo.scrollable_area is not None:
+                return pageinfo
+        except TooManyAreasDetectedError:
+            pass
+        logger.debug('scrollbar is not settled in downscaled image, use entire image')
+    return _guess_pageinfo(im, debug_draw_image, debug_image_name, 1, **kwargs)
+
+
+def _guess_pageinfo(im, debug_draw_image, debug_image_name, downscale, **kwargs):
     # 縦4分割して4領域に分け、一番右の領域だけ使う。
     # スクロールバーの領域を調べたいならそれで十分。
     im_h, im_w = im.shape[:2]
-    cropped = im[0:im_h, int(im_w*3/4):im_w]
+    cropped = downscale_image(im[0:im_h, int(im_w*3/4):im_w], downscale)
     cr_h, cr_w = cropped.shape[:2]
     logger.debug('cropped image size (for scrollbar): (width, height) = (%s, %s)', cr_w, cr_h)
     im_gray = cv2.cvtColor(cropped, cv2.COLOR_BGR2GRAY)
@@ -418,26 +647,42 @@ def guess_pageinfo(im, debug_draw_image=False, debug_image_name=None, **kwargs):
     else:
         im_orig_for_debug = None
 
+    # 矩形は切り出す前の座標で返す
+    offset_x = int(im_w*3/4)
+
+    def to_rect(contour):
+        x, y, w, h = cv2.boundingRect(contour)
+        return (x * downscale + offset_x, y * downscale, w * downscale, h * downscale)
+
     try:
         actual_scrollbar_region, scrollable_area_region = \
-            _try_to_detect_scrollbar(im_gray, im_orig_for_debug, **kwargs)
+            _try_to_detect_scrollbar(im_gray, im_orig_for_debug, scale=downscale, **kwargs)
+    except TooManyAreasDetectedError as e:
+        if e.scrollbar is not None:
+            x, y, w, h = e.scrollbar
+            e.scrollbar = (x * downscale + offset_x, y * downscale, w * downscale, h * downscale)
+        raise
     finally:
         if debug_draw_image:
             logger.debug('writing debug image: %s', debug_image_name)
             cv2.imwrite(debug_image_name, cropped)
 
-    if actual_scrollbar_region is None or scrollable_area_region is None:
-        # スクロールバーが検出できない or スクロールバー誤検出（と推定）
-        # どちらの場合もスクロールバーなしとして扱う。
-        return NOSCROLL_PAGE_INFO
+    if actual_scrollbar_region is None:
+        return PageInfo(*NOSCROLL_PAGE_INFO)
+    if scrollable_area_region is None:
+        # スクロールバー誤検出（と推定）
+        # スクロールバーなしとして扱う。
+        return PageInfo(*NOSCROLL_PAGE_INFO, scrollbar=to_rect(actual_scrollbar_region))
 
-    _, asr_y, _, asr_h = cv2.boundingRect(actual_scrollbar_region)
-    _, esr_y, _, esr_h = cv2.boundingRect(scrollable_area_region)
+    scrollbar = to_rect(actual_scrollbar_region)
+    scrollable_area = to_rect(scrollable_area_region)
+    _, asr_y, _, asr_h = scrollbar
+    _, esr_y, _, esr_h = scrollable_area
 
     pages = guess_pages(asr_h, esr_h)
     pagenum = guess_pagenum(asr_y, esr_y, esr_h)
     lines = guess_lines(asr_h, esr_h)
-    return (pagenum, pages, lines)
+    return PageInfo(pagenum, pages, lines, scrollbar, scrollable_area)
 
 
 def look_into_file_for_page(filename, im, args):
@@ -453,7 +698,8 @@ def look_into_file_for_page(filename, im, args):
         'draw_greenline': not args.debug_disable_greenline,
         'draw_blueline': not args.debug_disable_blueline,
     }
-    pagenum, pages, lines = guess_pageinfo(im, args.debug_sc, debug_image, **kwargs)
+    pagenum, pages, lines = guess_pageinfo(
+        im, args.debug_sc, debug_image, getattr(args, 'downscale', 1), **kwargs)
     logger.debug('pagenum: %s, pages: %s, lines: %s', pagenum, pages, lines)
     return (pagenum, pages, lines)
 
@@ -467,16 +713,21 @@ def look_into_file_for_qp(filename, im, args):
         logger.debug('debug image path: %s', debug_image)
     else:
         debug_image = None
-    result = detect_qp_region(im, args.mode, args.debug_sc, debug_image)
+    result = detect_qp_region(im, args.mode, args.debug_sc, debug_image, getattr(args, 'downscale', 1))
     if result is None:
         return ('', '') , ('', '')
-    return result
+    # 縮小して読んだ場合は元の画像の座標に戻す
+    reduce = getattr(args, 'reduce', 1)
+    return tuple((x * reduce, y * reduce) for x, y in result)
 
 
 def look_into_file(filename, args):
     logger.debug(f'===== {filename}')
 
-    im = cv2.imread(filename)
+    try:
+        im = imread(filename, reduce=getattr(args, 'reduce', 1))
+    except OSError:
+        im = None
     if im is None:
         raise FileNotFoundError(f'Cannot read file: {filename}')
 
@@ -486,21 +737,72 @@ def look_into_file(filename, args):
     return args.func(filename, im, args)
 
 
-def main(args):
-    csvdata = []
-
-    for filename in args.filename:
+def iter_files(filenames):
+    """
+        ファイルとディレクトリの指定を展開してファイル名を返す
+    """
+    for filename in filenames:
         if os.path.isdir(filename):
             for child in os.listdir(filename):
-                path = os.path.join(filename, child)
-                result = look_into_file(path, args)
-                csvdata.append((path, *result))
+                yield os.path.join(filename, child)
         else:
-            result = look_into_file(filename, args)
-            csvdata.append((filename, *result))
+            yield filename
+
 
+def make_row(filename, args):
+    """
+        CSV の1行を返す
+        1ファイルの失敗で全体が止まらないよう、検出や読み込みのエラーは
+        その行にメッセージを書く
+    """
+    try:
+        result = look_into_file(filename, args)
+    except (PageInfoError, FileNotFoundError) as e:
+        logger.warning('%s: %s', filename, e)
+        return (filename, f'error: {e}')
+    return (filename, *result)
+
+
+# ワーカープロセスごとの args (出力先のファイルは渡さない)
+_worker_args = None
+
+
+def _init_worker(args):
+    global _worker_args
+    _worker_args = args
+    # プロセスで並列に処理するので OpenCV の内部スレッドは使わない
+    cv2.setNumThreads(1)
+
+
+def _make_row_in_worker(filename):
+    return make_row(filename, _worker_args)
+
+
+def main(args):
     csv_writer = csv.writer(args.output, lineterminator='\n')
-    csv_writer.writerows(csvdata)
+    filenames = iter_files(args.filename)
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+
+    if jobs == 1:
+        rows = (make_row(filename, args) for filename in filenames)
+        for row in rows:
+            csv_writer.writerow(row)
+            if args.stream:
+                args.output.flush()
+        return
+
+    worker_args = argparse.Namespace(**{k: v for k, v in vars(args).items() if k != 'output'})
+    with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(worker_args,)) as pool:
+        if args.stream:
+            # 終わった順に書き出す
+            rows = pool.imap_unordered(_make_row_in_worker, filenames)
+        else:
+            # 入力順に書き出す
+            rows = pool.imap(_make_row_in_worker, filenames)
+        for row in rows:
+            csv_writer.writerow(row)
+            if args.stream:
+                args.output.flush()
 
 
 def parse_args():
@@ -536,6 +838,31 @@ def parse_args():
             default=sys.stdout,
             help='output file [default: STDOUT]',
         )
+        p.add_argument(
+            '-j', '--jobs',
+            type=int,
+            default=1,
+            help='number of worker processes (0: number of CPUs) [default: 1]',
+        )
+        p.add_argument(
+            '--stream',
+            action='store_true',
+            help='write each row as soon as it is done (not in input order when --jobs > 1)',
+        )
+        p.add_argument(
+            '--reduce',
+            type=int,
+            choices=(1, 2, 4, 8),
+            default=1,
+            help='decode images at 1/N resolution; results may differ from 1 [default: 1]',
+        )
+        p.add_argument(
+            '--downscale',
+            type=int,
+            choices=(1, 2, 4),
+            default=1,
+            help='search contours at 1/N resolution and map them back [default: 1]',
+        )
 
     page_parser = subparsers.add_parser('page')
     add_common_arguments(page_parser)
@@ -1,88 +1,190 @@
 import argparse
-import cv2
 from pathlib import Path
+import os
 import shutil
 import logging
+import multiprocessing
 
-import fgosccnt
+# fgosccnt (OpenCV) は認識するプロセスでだけ読み込む
+# qpsplit_gui.py の画面のプロセスは振り分けと移動しか使わない
 
 logger = logging.getLogger(__name__)
 
-training = Path(__file__).resolve().parent / Path("item.xml")
-train_item = Path(__file__).resolve().parent / Path("item.xml")  # アイテム下部
-train_chest = Path(__file__).resolve().parent / Path("chest.xml")  # ドロップ数
-train_card = Path(__file__).resolve().parent / Path("card.xml")  # ドロップ数
-train_dcnt = Path(__file__).resolve().parent / Path("dcnt.xml")
 
+class RewardQP:
+    """
+    報酬QPによる振り分けに必要な認識結果
+    qp は最初のアイテムが報酬QPのときその値、そうでなければ None
+    status は "ok", "not found", "not valid" のいずれか
+    """
 
-def file_Assignment(args, files):
-    svm = cv2.ml.SVM_load(str(train_item))
-    svm_chest = cv2.ml.SVM_load(str(train_chest))
-    svm_card = cv2.ml.SVM_load(str(train_card))
-    svm_dcnt = cv2.ml.SVM_load(str(train_dcnt))
+    def __init__(self, filename, status, qp=None, pagenum=0, chestnum=0):
+        self.filename = filename
+        self.status = status
+        self.qp = qp
+        self.pagenum = pagenum
+        self.chestnum = chestnum
+
+    def __repr__(self):
+        return "RewardQP(filename={!r}, status={!r}, qp={}, pagenum={}, " \
+               "chestnum={})".format(self.filename, self.status, self.qp,
+                                     self.pagenum, self.chestnum)
+
+
+def make_engine(lang, policy="auto"):
+    """
+    報酬QPだけを認識する Engine
+    (fgosccnt.RewardQPScreenShot で最初のアイテム・ドロップ数・ページ番号だけを読む)
+    lang が None なら fgosccnt.DEFAULT_ITEM_LANG
+    """
+    import fgosccnt
+    if lang is None:
+        lang = fgosccnt.DEFAULT_ITEM_LANG
+    return fgosccnt.Engine(fgosccnt.Options(lang=lang, reward_only=True,
+                                            policy=policy))
+
+
+def recognize_reward_qp(engine, filename):
+    import fgosccnt
+    f = Path(filename)
+    if f.exists() is False:
+        return RewardQP(filename, "not found")
+    try:
+        a = engine.recognize_file(f)
+    except Exception as e:
+        logger.debug("%s: %s", filename, e, exc_info=True)
+        return RewardQP(filename, "not valid")
+    if len(a.drops) == 0:
+        return RewardQP(filename, "not valid")
+    if a.drops[0].id == fgosccnt.ID_REWARD_QP:
+        qp = a.drops[0].dropnum
+    else:
+        qp = None
+    return RewardQP(filename, "ok", qp, a.pagenum, a.chestnum)
+
+
+# ワーカープロセス内の Engine
+worker_engine = None
+
+
+def make_worker_policy(jobs):
+    import fgosccnt
+    return fgosccnt.ExecutionPolicy("processes", jobs)
+
+
+def init_worker(lang, jobs):
+    global worker_engine
+    policy = make_worker_policy(jobs)
+    if worker_engine is None:
+        worker_engine = make_engine(lang, policy)
+    else:
+        policy.apply()
 
+
+def recognize_in_worker(filename):
+    return recognize_reward_qp(worker_engine, filename)
+
+
+def make_pool(lang, jobs=0, context=multiprocessing):
+    """
+    報酬QPを認識するプロセスプール (recognize_in_worker を map する)
+    jobs が 0 なら CPU 数
+    context の起動方法が fork の場合、ワーカーは親プロセスで読み込んだ
+    カタログとモデルをそのまま使う
+    spawn の場合は親プロセスで fgosccnt を読み込まない
+    """
+    global worker_engine
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
+    if context.get_start_method() == "fork":
+        worker_engine = make_engine(lang, make_worker_policy(jobs))
+    return context.Pool(jobs, initializer=init_worker,
+                        initargs=(lang, jobs))
+
+
+def iter_reward_qp(files, lang, jobs=1):
+    """
+    files の RewardQP を入力順に返す
+    jobs が 1 以外ならプロセスプールで認識する (0 は CPU 数)
+    """
+    if jobs == 1:
+        with make_engine(lang) as engine:
+            for filename in files:
+                yield recognize_reward_qp(engine, filename)
+        return
+    with make_pool(lang, jobs) as pool:
+        yield from pool.imap(recognize_in_worker, files)
+
+
+def iter_destinations(results):
+    """
+    入力順の RewardQP から (RewardQP, 移動先フォルダ) を返す
+    報酬QPが見えないページは、直前に振り分けたファイルの次のページ
+    (ドロップ数が同じでページ数が一つ後) のときだけ同じフォルダにする
+    移動しないファイルの移動先は None
+    """
+    qp_dir = None
     prev_pagenum = 0
     prev_chestnum = 0
 
-    for filename in files:
-        f = Path(filename)
-        if f.exists() is False:
-            print(filename + ' is not found.')
+    for r in results:
+        if r.status != "ok":
+            yield r, None
+        elif r.qp is not None:
+            qp_dir = Path("QP" + "(+" + str(r.qp) + ")")
+            prev_pagenum = r.pagenum
+            prev_chestnum = r.chestnum
+            yield r, qp_dir
         else:
-            img_rgb = fgosccnt.imread(filename)
-            fileextention = f.suffix
-            try:
-                a = fgosccnt.ScreenShot(
-                                        args, img_rgb,
-                                        svm, svm_chest, svm_dcnt, svm_card,
-                                        fileextention,
-                                        reward_only=True
-                                        )
-            except Exception:
-                print(Path(f).name, end=": ")
-                print("正常なFGOのバトルリザルトのスクショではありません")
-                continue
-            if a.itemlist[0]["id"] == fgosccnt.ID_REWARD_QP:
-                Qp_dir = Path(
-                              "QP" + "(+" + str(
-                                                a.itemlist[0]["dropnum"]
-                                                ) + ")"
-                              )
-                if not Qp_dir.is_dir():
-                    Qp_dir.mkdir()
-                dstfile = Qp_dir / Path(f).name
-                shutil.move(Path(f), Path(dstfile))
-                print(Path(f).name, end=" => ")
-                print(Qp_dir)
-                prev_pagenum = a.pagenum
-                prev_chestnum = a.chestnum
+            logger.debug("prev_chestnum: %s", prev_chestnum)
+            logger.debug("a.chestnum: %s", r.chestnum)
+            logger.debug("prev_pagenum: %s", prev_pagenum)
+            logger.debug("a.pagenum: %s", r.pagenum)
+            if qp_dir is not None and prev_chestnum == r.chestnum \
+               and prev_pagenum == r.pagenum - 1:
+                prev_pagenum = r.pagenum
+                prev_chestnum = r.chestnum
+                yield r, qp_dir
             else:
-                logger.debug("prev_chestnum: %s", prev_chestnum)
-                logger.debug("a.chestnum: %s", a.chestnum)
-                logger.debug("prev_pagenum: %s", prev_pagenum)
-                logger.debug("a.pagenum: %s", a.pagenum)
-                if prev_chestnum == a.chestnum \
-                   and prev_pagenum == a.pagenum - 1:
-                    dstfile = Qp_dir / Path(f).name
-                    shutil.move(Path(f), Path(dstfile))
-                    print(Path(f).name, end=" => ")
-                    print(Qp_dir)
-                    prev_pagenum = a.pagenum
-                    prev_chestnum = a.chestnum
-                else:
-                    print(Path(f).name, end=" => ")
-                    print("移動無し(1ページ目不明)")
-                    prev_pagenum = 0
-                    prev_chestnum = 0
+                prev_pagenum = 0
+                prev_chestnum = 0
+                yield r, None
+
+
+def move_file(r, qp_dir):
+    """
+    振り分けを実行し、表示するメッセージを返す
+    """
+    name = Path(r.filename).name
+    if r.status == "not found":
+        return str(r.filename) + ' is not found.'
+    if r.status != "ok":
+        return name + ": 正常なFGOのバトルリザルトのスクショではありません"
+    if qp_dir is None:
+        return name + " => 移動無し(1ページ目不明)"
+    if not qp_dir.is_dir():
+        qp_dir.mkdir()
+    shutil.move(Path(r.filename), qp_dir / name)
+    return name + " => " + str(qp_dir)
+
+
+def file_Assignment(args, files):
+    results = iter_reward_qp(files, args.lang, getattr(args, "jobs", 1))
+    # 認識は並列でも、移動は入力順に行う
+    for r, qp_dir in iter_destinations(results):
+        print(move_file(r, qp_dir))
 
 
 if __name__ == '__main__':
+    import fgosccnt
     parser = argparse.ArgumentParser(description='FGOスクショからアイテムをCSV出力する')
     parser.add_argument('--lang', default=fgosccnt.DEFAULT_ITEM_LANG,
                         choices=('jpn', 'eng'),
                         help='Language to be used for output: Default '
                              + fgosccnt.DEFAULT_ITEM_LANG)
     parser.add_argument('filenames', help='入力ファイル', nargs='*')    # 必須の引数を追加
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='並列に処理するプロセス数 (0: CPU数): Default 1')
     parser.add_argument('-l', '--loglevel',
                         choices=('debug', 'info'), default='info')
     args = parser.parse_args()    # 引数を解析
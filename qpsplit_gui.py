@@ -4,103 +4,209 @@ import os
 import qpsplit
 import configparser
 import sys
+import multiprocessing
+import queue
+import threading
+import time
 from pathlib import Path
 
-sg.Print(do_not_reroute_stdout=True)
-
-config = configparser.ConfigParser()
-settingfile = Path(__file__).resolve().parent / 'setting.ini'
-output_folder = "出力先フォルダ"
-try:
-    if not settingfile.exists():
-        settingfile.touch()
-        
-    config.read(settingfile)
-    section0 = "default"
-    if section0 not in config.sections():
-        config.add_section(section0)
-    section0cfg = config[section0]
-
-    output_folder = section0cfg.get("output_folder", output_folder)
-
-
-except :
-    print("[エラー] setting.iniに不備があります。")
-    sys.exit(1)
-
-##print("output_folder:")
-##print(output_folder)
-
-col1 = [[sg.Button('実行')],
-        [sg.Button('終了')]]
-
-
-layout = [[sg.Text('ファイル選択', size=(15, 1), justification='right'),
-          sg.InputText('ファイル一覧', enable_events=True, key='-FILES-',),
-          sg.FilesBrowse('ファイルを追加', file_types=(('PNG ファイル', '*.png'),))],
-          
-          [sg.Text('出力先フォルダ', size=(15, 1), justification='right'),
-          sg.InputText(output_folder, enable_events=True, key='-FOLDER-'),
-          sg.FolderBrowse('出力フォルダを変更')],
-          [sg.Button('ログをコピー'), sg.Button('ログをクリア')],
-          [sg.Output(size=(100, 5), key='-MULTILINE-')],
-          [sg.Button('入力一覧をクリア')],
-          [sg.Listbox([], size=(100, 10), enable_events=True, key='-LIST-')],
-          [sg.Column(col1)]]
-##          [sg.Frame('処理内容', frame1), sg.Column(col1)]]
-
-window = sg.Window('バトルリザルトのQPによる振り分け', layout)
-
-new_files = []
-new_file_names = []
-
-while True:             # Event Loop
-    event, values = window.read()
-    if event in (None, '終了'):
-        if values['-FOLDER-'] != "":
-            config.set(section0, "output_folder", values['-FOLDER-'])
-            with open(settingfile, "w") as file:
-                config.write(file)
-        break
-
-    if event == '実行':
-        print('処理を実行')
-        print('処理対象ファイル：', new_files)
-
-        if values['-FOLDER-'] != "出力先フォルダ":
-            os.chdir(values['-FOLDER-'])
-        print("作業フォルダ: ", end="")
-        print(os.getcwd())
-##        sg.popup(new_files)
-        qpsplit.file_Assignment(new_files)
-
-        # ポップアップ
-        sg.popup('処理が正常終了しました')
-    elif event == 'ログをクリア':
-        print('ログをクリア')
-        window.FindElement('-MULTILINE-').Update('')
-    elif event == 'ログをコピー':
-        window.FindElement('-MULTILINE-').Widget.clipboard_append(window.find_element('-MULTILINE-').Get())
-        sg.popup('ログをコピーしました')
-    elif event == '入力一覧をクリア':
-        print('入力一覧をクリア')
-
-        new_files.clear()
-        new_file_names.clear()
-        window['-LIST-'].update('')
-    elif event == '-FILES-':
-        print('FilesBrowse')
-
-        # TODO:実運用には同一ファイルかどうかの処理が必要
-        for f in values['-FILES-'].split(';'):
-            if f not in new_files:
-                new_files.append(f)
-        new_file_names = [basename(file_path) for file_path in new_files]
-
-        print('ファイルを追加')
-        window['-LIST-'].update(new_file_names)  # リストボックスに表示します
-    elif event == '-FOLDER-':
-        print('FolderChange')
-        print(values['-FOLDER-'])
-
-window.close()
+
+class SplitWorker(threading.Thread):
+    """
+    振り分けをバックグラウンドで実行するスレッド
+    認識はワーカープロセスで行い、ファイルごとの結果を results (queue) で
+    画面のスレッドに渡す。画面のスレッドからは cancel() だけを呼ぶ
+
+    results に入るのは次のタプル
+    ("file", メッセージ, 処理済み件数, 経過秒)
+    ("error", メッセージ, 処理済み件数, 経過秒)
+    ("done", キャンセルしたか, 処理済み件数, 経過秒)
+    """
+
+    def __init__(self, files, results, lang=None, jobs=0):
+        super().__init__(daemon=True)
+        self.files = list(files)
+        self.results = results
+        self.lang = lang
+        self.jobs = jobs
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        start = time.perf_counter()
+        done = 0
+        pool = None
+        try:
+            # 画面のプロセスで OpenCV を使わないよう、ワーカーは spawn で起動して
+            # それぞれカタログとモデルを読み込む
+            pool = qpsplit.make_pool(self.lang, self.jobs,
+                                     multiprocessing.get_context("spawn"))
+            records = pool.imap(qpsplit.recognize_in_worker, self.files)
+            # 認識は並列でも、移動は入力順に行う
+            for r, qp_dir in qpsplit.iter_destinations(records):
+                if self.cancelled.is_set():
+                    break
+                try:
+                    message = qpsplit.move_file(r, qp_dir)
+                except OSError as e:
+                    message = basename(r.filename) + ": 移動できません " + str(e)
+                done += 1
+                self.results.put(("file", message, done,
+                                  time.perf_counter() - start))
+        except Exception as e:
+            self.results.put(("error", "[エラー] " + str(e), done,
+                              time.perf_counter() - start))
+        finally:
+            if pool is not None:
+                if self.cancelled.is_set():
+                    pool.terminate()
+                else:
+                    pool.close()
+                pool.join()
+            self.results.put(("done", self.cancelled.is_set(), done,
+                              time.perf_counter() - start))
+
+
+def progress_text(done, total, elapsed):
+    if elapsed > 0:
+        rate = done / elapsed
+    else:
+        rate = 0
+    return '{} / {} 件 ({:.1f} 件/秒)'.format(done, total, rate)
+
+
+def main():
+    sg.Print(do_not_reroute_stdout=True)
+
+    config = configparser.ConfigParser()
+    settingfile = Path(__file__).resolve().parent / 'setting.ini'
+    output_folder = "出力先フォルダ"
+    try:
+        if not settingfile.exists():
+            settingfile.touch()
+
+        config.read(settingfile)
+        section0 = "default"
+        if section0 not in config.sections():
+            config.add_section(section0)
+        section0cfg = config[section0]
+
+        output_folder = section0cfg.get("output_folder", output_folder)
+        # 認識に使うプロセス数 (0: CPU数)
+        jobs = section0cfg.getint("jobs", 0)
+
+    except :
+        print("[エラー] setting.iniに不備があります。")
+        sys.exit(1)
+
+    col1 = [[sg.Button('実行'), sg.Button('キャンセル', disabled=True)],
+            [sg.Button('終了')]]
+
+    layout = [[sg.Text('ファイル選択', size=(15, 1), justification='right'),
+              sg.InputText('ファイル一覧', enable_events=True, key='-FILES-',),
+              sg.FilesBrowse('ファイルを追加', file_types=(('PNG ファイル', '*.png'),))],
+
+              [sg.Text('出力先フォルダ', size=(15, 1), justification='right'),
+              sg.InputText(output_folder, enable_events=True, key='-FOLDER-'),
+              sg.FolderBrowse('出力フォルダを変更')],
+              [sg.Button('ログをコピー'), sg.Button('ログをクリア')],
+              [sg.Output(size=(100, 5), key='-MULTILINE-')],
+              [sg.Button('入力一覧をクリア')],
+              [sg.Listbox([], size=(100, 10), enable_events=True, key='-LIST-')],
+              [sg.ProgressBar(1, orientation='h', size=(50, 20), key='-PROGRESS-'),
+               sg.Text('', size=(30, 1), key='-STATUS-')],
+              [sg.Column(col1)]]
+
+    window = sg.Window('バトルリザルトのQPによる振り分け', layout)
+
+    new_files = []
+    new_file_names = []
+    worker = None
+    results = queue.Queue()
+
+    while True:             # Event Loop
+        # 処理中はワーカーの結果を受け取るため定期的に戻る
+        event, values = window.read(timeout=100 if worker is not None else None)
+        if event in (None, '終了'):
+            if worker is not None:
+                worker.cancel()
+                worker.join()
+            if values is not None and values['-FOLDER-'] != "":
+                config.set(section0, "output_folder", values['-FOLDER-'])
+                with open(settingfile, "w") as file:
+                    config.write(file)
+            break
+
+        while worker is not None:
+            try:
+                kind, message, done, elapsed = results.get_nowait()
+            except queue.Empty:
+                break
+            window['-STATUS-'].update(progress_text(done, len(worker.files), elapsed))
+            window['-PROGRESS-'].update(current_count=done, max=len(worker.files))
+            if kind == 'done':
+                worker = None
+                window['実行'].update(disabled=False)
+                window['キャンセル'].update(disabled=True)
+                if message:
+                    sg.popup('処理をキャンセルしました')
+                else:
+                    # ポップアップ
+                    sg.popup('処理が正常終了しました')
+            else:
+                print(message)
+
+        if event == '実行' and worker is None:
+            print('処理を実行')
+            print('処理対象ファイル：', new_files)
+
+            if values['-FOLDER-'] != "出力先フォルダ":
+                os.chdir(values['-FOLDER-'])
+            print("作業フォルダ: ", end="")
+            print(os.getcwd())
+            worker = SplitWorker(new_files, results, jobs=jobs)
+            window['-PROGRESS-'].update(current_count=0, max=max(1, len(new_files)))
+            window['-STATUS-'].update(progress_text(0, len(new_files), 0))
+            window['実行'].update(disabled=True)
+            window['キャンセル'].update(disabled=False)
+            worker.start()
+        elif event == 'キャンセル' and worker is not None:
+            print('キャンセル')
+            worker.cancel()
+            window['キャンセル'].update(disabled=True)
+        elif event == 'ログをクリア':
+            print('ログをクリア')
+            window.FindElement('-MULTILINE-').Update('')
+        elif event == 'ログをコピー':
+            window.FindElement('-MULTILINE-').Widget.clipboard_append(window.find_element('-MULTILINE-').Get())
+            sg.popup('ログをコピーしました')
+        elif event == '入力一覧をクリア':
+            print('入力一覧をクリア')
+
+            new_files.clear()
+            new_file_names.clear()
+            window['-LIST-'].update('')
+        elif event == '-FILES-':
+            print('FilesBrowse')
+
+            # TODO:実運用には同一ファイルかどうかの処理が必要
+            for f in values['-FILES-'].split(';'):
+                if f not in new_files:
+                    new_files.append(f)
+            new_file_names = [basename(file_path) for file_path in new_files]
+
+            print('ファイルを追加')
+            window['-LIST-'].update(new_file_names)  # リストボックスに表示します
+        elif event == '-FOLDER-':
+            print('FolderChange')
+            print(values['-FOLDER-'])
+
+    window.close()
+
+
+if __name__ == '__main__':
+    # spawn で起動するワーカーがこのスクリプトを読み込んでも画面を作らないようにする
+    multiprocessing.freeze_support()
+    main()